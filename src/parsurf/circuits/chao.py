@@ -1,9 +1,58 @@
-from typing import Any, Iterable, Iterator, List, Optional
+from typing import Any, Iterator, List, Optional, Tuple
 
 import sinter
 import stim
 
-from parsurf.tools import Builder, AtLayer, NoiseModel, surface_code_tiles, Tile, not_nones
+from parsurf.tools import Builder, NoiseModel, surface_code_tiles, Tile, DecompositionSchedule, \
+    Role, ResetOp, MeasureOp, MeasureProductOp, FeedbackOp, GroupOp, compile_schedule_by_basis, append_schedule_moments, \
+    CompiledDetectors, CompiledObservable, compile_for_roles
+
+
+def _chao_schedule() -> DecompositionSchedule:
+    a = Role('a')
+    b = Role('b')
+    c = Role('c')
+    d = Role('d')
+    m1 = Role('m1')
+    m2 = Role('m2')
+    return DecompositionSchedule(
+        steps=(
+            ('R', (ResetOp(basis='opp', qubits=('m1',)),)),
+            ('P1_a', (MeasureProductOp(basis='bas', qubits=('a', 'm1'), key=('a_m1', a, m1)),)),
+            ('P1_b', (FeedbackOp(basis='opp', controls=(('a_m1', a, m1),), targets=('m1',)),)),
+            ('P1_c', (ResetOp(basis='bas', qubits=('m2',)),)),
+            ('P2_a', (MeasureProductOp(basis='opp', qubits=('m1', 'm2'), key=('m1_m2_1', m1, m2)),)),
+            ('P2_b', (FeedbackOp(basis='bas', controls=(('m1_m2_1', m1, m2),), targets=('a', 'm1')),)),
+            ('P3_a', (MeasureProductOp(basis='bas', qubits=('b', 'm1'), key=('b_m1', b, m1)),)),
+            ('P3_b', (FeedbackOp(basis='opp', controls=(('b_m1', b, m1),), targets=('m1', 'm2')),)),
+            ('M1_a', (MeasureOp(basis='opp', qubits=('m1',), key=('anc1', m1)),)),
+            ('M1_b', (FeedbackOp(basis='bas', controls=(('anc1', m1),), targets=('b',)),)),
+            ('R3', (ResetOp(basis='opp', qubits=('m1',)),)),
+            ('P4_a', (MeasureProductOp(basis='bas', qubits=('c', 'm1'), key=('c_m1', c, m1)),)),
+            ('P4_b', (FeedbackOp(basis='opp', controls=(('c_m1', c, m1),), targets=('m1',)),)),
+            ('P5_a', (MeasureProductOp(basis='opp', qubits=('m1', 'm2'), key=('m1_m2_2', m1, m2)),)),
+            ('P5_b', (FeedbackOp(basis='bas', controls=(('m1_m2_2', m1, m2),), targets=('c', 'm1')),)),
+            ('P6_a', (MeasureProductOp(basis='bas', qubits=('d', 'm1'), key=('d_m1', d, m1)),)),
+            ('P6_b', (MeasureOp(basis='bas', qubits=('m2',), key=('anc2', m2)),)),
+            ('M2_a', (MeasureOp(basis='opp', qubits=('m1',), key=('anc2', m1)),)),
+            ('M2_b', (FeedbackOp(basis='bas', controls=(('anc2', m1),), targets=('d',)),)),
+            ('C', (GroupOp(sub_keys=(('d_m1', d, m1), ('anc2', m2)), key=Role('key')),)),
+        ),
+        # Visits the tile's data qubits in the order a, c, b, d.
+        roles=lambda tile: {
+            'a': tile.a,
+            'b': tile.c,
+            'c': tile.b,
+            'd': tile.d,
+            'm1': tile.center,
+            'm2': tile.center + 1,
+            'key': tile.center,
+        },
+    )
+
+
+# Decomposes a four body measurement into two body measurements using two measurement qubits.
+CHAO_SCHEDULE = _chao_schedule()
 
 
 def iter_chao_decompose_mpp4(
@@ -16,78 +65,44 @@ def iter_chao_decompose_mpp4(
         m2: complex,
         key: Any,
         basis: str,
-        builder: Builder, layer: int):
-    bas = basis
-    opp = 'Z' if bas == 'X' else 'X'
-    builder.gate(f"R{opp}", [m1])
-    yield 'R'
-
-    builder.measure_pauli_product(qs={bas: not_nones([a, m1])}, key=('a_m1', a, m1), layer=layer)
-    yield 'P1_a'
-    builder.classical_paulis(control_keys=[AtLayer(('a_m1', a, m1), layer=layer)], targets=[m1], basis=opp)
-    yield 'P1_b'
-    builder.gate(f"R{bas}", [m2])
-    yield 'P1_c'
-    builder.measure_pauli_product(qs={opp: [m1, m2]}, key=('m1_m2_1', m1, m2), layer=layer)
-    yield 'P2_a'
-    builder.classical_paulis(control_keys=[AtLayer(('m1_m2_1', m1, m2), layer=layer)], targets=not_nones([a, m1]), basis=bas)
-    yield 'P2_b'
-    builder.measure_pauli_product(qs={bas: not_nones([b, m1])}, key=('b_m1', b, m1), layer=layer)
-    yield 'P3_a'
-    builder.classical_paulis(control_keys=[AtLayer(('b_m1', b, m1), layer=layer)], targets=[m1, m2], basis=opp)
-    yield 'P3_b'
-
-    builder.measure([m1], basis=opp, tracker_key=lambda _: ('anc1', m1), layer=layer)
-    yield 'M1_a'
-    builder.classical_paulis(control_keys=[AtLayer(('anc1', m1), layer=layer)], targets=not_nones([b]), basis=bas)
-    yield 'M1_b'
-    builder.gate(f"R{opp}", [m1])
-    yield 'R3'
-
-    builder.measure_pauli_product(qs={bas: not_nones([c, m1])}, key=('c_m1', c, m1), layer=layer)
-    yield 'P4_a'
-    builder.classical_paulis(control_keys=[AtLayer(('c_m1', c, m1), layer=layer)], targets=[m1], basis=opp)
-    yield 'P4_b'
-    builder.measure_pauli_product(qs={opp: [m1, m2]}, key=('m1_m2_2', m1, m2), layer=layer)
-    yield 'P5_a'
-    builder.classical_paulis(control_keys=[AtLayer(('m1_m2_2', m1, m2), layer=layer)], targets=not_nones([c, m1]), basis=bas)
-    yield 'P5_b'
-    builder.measure_pauli_product(qs={bas: not_nones([d, m1])}, key=('d_m1', d, m1), layer=layer)
-    yield 'P6_a'
-    builder.measure([m2], basis=bas, tracker_key=lambda _: ('anc2', m2), layer=layer)
-    yield 'P6_b'
-
-    builder.measure([m1], basis=opp, tracker_key=lambda _: ('anc2', m1), layer=layer)
-    yield 'M2_a'
-    builder.classical_paulis(control_keys=[AtLayer(('anc2', m1), layer=layer)], targets=not_nones([d]), basis=bas)
-    yield 'M2_b'
-    builder.tracker.make_measurement_group([
-        AtLayer(('d_m1', d, m1), layer=layer),
-        AtLayer(('anc2', m2), layer=layer),
-    ], key=AtLayer(key, layer=layer))
-    yield 'C'
-
-
-def forever_iter_chao_decompose_mpp_tile(
-        *,
-        tile: Tile,
-        builder: Builder):
-    a = tile.a
-    b = tile.c
-    c = tile.b
-    d = tile.d
-
-    layer = 0
-    while True:
-        yield from iter_chao_decompose_mpp4(
-            a=a,
-            b=b,
-            c=c,
-            d=d,
-            m1=tile.center,
-            m2=tile.center + 1,
-            key=tile.center, basis=tile.basis, builder=builder, layer=layer)
-        layer += 1
+        builder: Builder, layer: int) -> Iterator[str]:
+    """Appends `CHAO_SCHEDULE` for a single tile one step at a time, yielding each step's name."""
+    compiled = compile_for_roles(
+        schedule=CHAO_SCHEDULE,
+        roles=dict(a=a, b=b, c=c, d=d, m1=m1, m2=m2, key=key),
+        basis=basis,
+        builder=builder,
+        layer=layer)
+    for step in compiled.step_names:
+        compiled.append_step(step)
+        yield step
+
+# Moments of one round of the memory experiment. Each moment runs its steps on the X tiles, then the Z tiles.
+CHAO_ROUND_MOMENTS = [
+    [(b, step) for b in 'XZ' for step in steps]
+    for steps in [
+        ['R'],
+        ['P1_a', 'P1_b', 'P1_c'],
+        ['P2_a', 'P2_b'],
+        ['P3_a', 'P3_b'],
+        ['M1_a', 'M1_b'],
+        ['R3'],
+        ['P4_a', 'P4_b'],
+        ['P5_a', 'P5_b'],
+        ['P6_a', 'P6_b'],
+        ['M2_a', 'M2_b', 'C'],
+    ]
+]
+
+
+def chao_detector_stencil(tile: Tile) -> List[Tuple[Any, int]]:
+    """Each round compares a tile's stabilizer measurement with the previous round's."""
+    return [(tile.center, 0), (tile.center, -1)]
+
+
+def chao_final_detector_stencil(tile: Tile) -> List[Tuple[Any, int]]:
+    """The data measurements are compared with the last round's stabilizer measurements."""
+    return [(q, 0) for q in [*tile.data_set, tile.center]]
 
 
 def chao_memory_experiment_circuit(*, diam: int, basis: str, rounds: int) -> stim.Circuit:
@@ -97,50 +112,27 @@ def chao_memory_experiment_circuit(*, diam: int, basis: str, rounds: int) -> sti
     used_set = data_set | measure_set
     builder = Builder.for_qubits(used_set)
 
-    iter_xs = []
-    iter_zs = []
-    for tile in tiles:
-        it = forever_iter_chao_decompose_mpp_tile(tile=tile, builder=builder)
-        if tile.basis == 'X':
-            iter_xs.append(it)
-        else:
-            iter_zs.append(it)
-
-    def append_partial_layer(expected: str, basis_iters: Iterable[Iterator[str]]):
-        for it in basis_iters:
-            ran_layer = next(it)
-            if ran_layer != expected:
-                raise ValueError(f"Expected layer {expected} but got {ran_layer}")
-
-    def append_layers(layers: List[str], tick: bool = True):
-        for x in layers:
-            append_partial_layer(x, iter_xs)
-        for z in layers:
-            append_partial_layer(z, iter_zs)
-        if tick:
-            builder.tick()
+    schedules = compile_schedule_by_basis(schedule=CHAO_SCHEDULE, tiles=tiles, builder=builder)
+    basis_tiles = [tile for tile in tiles if tile.basis == basis]
+    first_detectors = CompiledDetectors(stencil=chao_detector_stencil, tiles=basis_tiles, builder=builder)
+    round_detectors = CompiledDetectors(stencil=chao_detector_stencil, tiles=tiles, builder=builder)
+    final_detectors = CompiledDetectors(stencil=chao_final_detector_stencil, tiles=basis_tiles, builder=builder)
+
+    if basis == 'X':
+        obs_qubits = [d for d in data_set if d.imag == 0]
+    elif basis == 'Z':
+        obs_qubits = [d for d in data_set if d.real == 0]
+    else:
+        raise NotImplementedError(f'{basis=}')
+    observable = CompiledObservable(terms=[(d, 0) for d in obs_qubits], builder=builder)
 
     builder.gate(f"R{basis}", data_set)
     circuit_so_far = stim.Circuit()
     for layer in range(min(2, rounds)):
         circuit_so_far += builder.circuit
         builder.circuit.clear()
-        append_layers(['R'])
-        append_layers(['P1_a', 'P1_b', 'P1_c'])
-        append_layers(['P2_a', 'P2_b'])
-        append_layers(['P3_a', 'P3_b'])
-        append_layers(['M1_a', 'M1_b'])
-        append_layers(['R3'])
-        append_layers(['P4_a', 'P4_b'])
-        append_layers(['P5_a', 'P5_b'])
-        append_layers(['P6_a', 'P6_b'])
-        append_layers(['M2_a', 'M2_b', 'C'], tick=False)
-        for tile in tiles:
-            if layer == 0:
-                if tile.basis == basis:
-                    builder.detector([AtLayer(tile.center, layer=layer)], pos=tile.center)
-            else:
-                builder.detector([AtLayer(tile.center, layer=layer), AtLayer(tile.center, layer=layer - 1)], pos=tile.center)
+        append_schedule_moments(builder=builder, schedules=schedules, moments=CHAO_ROUND_MOMENTS, tick_after_last=False)
+        (first_detectors if layer == 0 else round_detectors).append_layer(layer)
         builder.shift_coords(dt=1)
         builder.tick()
 
@@ -149,18 +141,8 @@ def chao_memory_experiment_circuit(*, diam: int, basis: str, rounds: int) -> sti
 
     last_layer = min(1, rounds - 1)
     builder.measure(data_set, basis=basis, layer=last_layer)
-    for tile in tiles:
-        if tile.basis == basis:
-            builder.detector([AtLayer(q, layer=last_layer) for q in [*tile.data_set, tile.center]], pos=tile.center)
-
-    if basis == 'X':
-        obs_qubits = [d for d in data_set if d.imag == 0]
-    elif basis == 'Z':
-        obs_qubits = [d for d in data_set if d.real == 0]
-    else:
-        raise NotImplementedError(f'{basis=}')
-
-    builder.obs_include([AtLayer(d, layer=last_layer) for d in obs_qubits], obs_index=0)
+    final_detectors.append_layer(last_layer)
+    observable.append_layer(last_layer)
 
     return circuit_so_far + builder.circuit
 
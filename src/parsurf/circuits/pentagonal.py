@@ -1,9 +1,55 @@
-from typing import Optional, Iterator, Any, List, Iterable
+from typing import Any, Iterator, List, Optional, Tuple
 
 import sinter
 import stim
 
-from parsurf.tools import Builder, AtLayer, NoiseModel, Tile, surface_code_tiles, not_nones
+from parsurf.tools import Builder, AtLayer, NoiseModel, Tile, surface_code_tiles, DecompositionSchedule, \
+    Role, ResetOp, MeasureOp, MeasureProductOp, FeedbackOp, GroupOp, compile_schedule_by_basis, append_schedule_moments, \
+    CompiledDetectors, CompiledObservable, compile_for_roles
+
+
+def pentagonal_schedule(*, use_classical_feedback: bool) -> DecompositionSchedule:
+    """Decomposes a four body measurement into two body measurements using two measurement qubits.
+
+    Args:
+        use_classical_feedback: Whether or not classical feedback operations are used to make
+            the parity measurements exactly correct, instead of requiring the detector and
+            observable structure to change.
+    """
+    key = Role('key')
+    feedback = (
+        FeedbackOp(basis='bas', controls=(Role('m1'),), targets=('c',)),
+        FeedbackOp(basis='bas', controls=(Role('m2'),), targets=('d',)),
+        FeedbackOp(basis='bas', controls=(('|', key),), targets=('a', 'c')),
+    ) if use_classical_feedback else ()
+    return DecompositionSchedule(
+        steps=(
+            ('R', (ResetOp(basis='opp', qubits=('m1', 'm2')),)),
+            ('AB', (
+                MeasureProductOp(basis='bas', qubits=('a', 'm1'), key=('a', key)),
+                MeasureProductOp(basis='bas', qubits=('b', 'm2'), key=('b', key)),
+            )),
+            ('|', (MeasureProductOp(basis='opp', qubits=('m1', 'm2'), key=('|', key), require_all=True),)),
+            ('CD', (
+                MeasureProductOp(basis='bas', qubits=('c', 'm1'), key=('c', key)),
+                MeasureProductOp(basis='bas', qubits=('d', 'm2'), key=('d', key)),
+            )),
+            ('M', (MeasureOp(basis='opp', qubits=('m1', 'm2')),)),
+            ('C', (
+                GroupOp(sub_keys=(('a', key), ('b', key), ('c', key), ('d', key)), key=key),
+                *feedback,
+            )),
+        ),
+        roles=lambda tile: {
+            'a': tile.a,
+            'b': tile.b,
+            'c': tile.c,
+            'd': tile.d,
+            'm1': tile.m1(),
+            'm2': tile.m2(),
+            'key': tile.center,
+        },
+    )
 
 
 def iter_pentagonal_decompose_mpp4(
@@ -18,12 +64,11 @@ def iter_pentagonal_decompose_mpp4(
         basis: str,
         builder: Builder,
         layer: int,
-        use_classical_feedback: bool):
+        use_classical_feedback: bool) -> Iterator[str]:
     """Iteratively appends operations into a builder, implementing a four body pauli product measurement.
 
-    The intent is for a caller to start this generator alongside many others, and then
-    incrementally advance them in synchronized steps in order to produce a circuit that measures
-    all the tiles simultaneously.
+    This runs `pentagonal_schedule` on a single tile. The memory circuit instead compiles the
+    schedule for all tiles at once, emitting each step for every tile together.
 
     Args:
         builder: Where to put the operations.
@@ -43,88 +88,67 @@ def iter_pentagonal_decompose_mpp4(
     Yields:
         A series of strings indicating what was just appended into the builder.
     """
-    opp = 'Z' if basis == 'X' else 'X'
-
-    builder.gate(f"R{opp}", not_nones([m1, m2]))
-    yield 'R'
-
-    builder.measure_pauli_product(qs={basis: not_nones([a, m1])}, key=('a', key), layer=layer)
-    builder.measure_pauli_product(qs={basis: not_nones([b, m2])}, key=('b', key), layer=layer)
-    yield 'AB'
-
-    builder.measure_pauli_product(qs={opp: [m1, m2] * (m1 is not None and m2 is not None)}, key=('|', key), layer=layer)
-    yield '|'
-
-    builder.measure_pauli_product(qs={basis: not_nones([c, m1])}, key=('c', key), layer=layer)
-    builder.measure_pauli_product(qs={basis: not_nones([d, m2])}, key=('d', key), layer=layer)
-    yield 'CD'
-
-    builder.measure(not_nones([m1, m2]), basis=opp, layer=layer)
-    yield 'M'
-
-    builder.tracker.make_measurement_group(
-        [
-            AtLayer(('a', key), layer),
-            AtLayer(('b', key), layer),
-            AtLayer(('c', key), layer),
-            AtLayer(('d', key), layer),
-        ],
-        key=AtLayer(key, layer),
-    )
-    if use_classical_feedback:
-        builder.classical_paulis(control_keys=[AtLayer(m1, layer)], targets=not_nones([c]), basis=basis)
-        builder.classical_paulis(control_keys=[AtLayer(m2, layer)], targets=not_nones([d]), basis=basis)
-        builder.classical_paulis(control_keys=[AtLayer(('|', key), layer)], targets=not_nones([a, c]), basis=basis)
-    yield 'C'
-
-
-def forever_iter_pentagonal_decompose_mpp_tile(
-        *,
-        tile: Tile,
-        builder: Builder,
-        use_classical_feedback: bool):
-    a = tile.a
-    b = tile.b
-    c = tile.c
-    d = tile.d
-    m1 = tile.m1()
-    m2 = tile.m2()
-
-    layer = 0
-    while True:
-        yield from iter_pentagonal_decompose_mpp4(
-            a=a,
-            b=b,
-            c=c,
-            d=d,
-            m1=m1,
-            m2=m2,
-            key=tile.center,
-            basis=tile.basis,
-            builder=builder,
-            layer=layer,
-            use_classical_feedback=use_classical_feedback)
-        layer += 1
-
-
-def possible_tile_detector_keys(*, tile: Tile, layer: int, use_classical_feedback: bool) -> List[AtLayer]:
+    compiled = compile_for_roles(
+        schedule=pentagonal_schedule(use_classical_feedback=use_classical_feedback),
+        roles=dict(a=a, b=b, c=c, d=d, m1=m1, m2=m2, key=key),
+        basis=basis,
+        builder=builder,
+        layer=layer)
+    for step in compiled.step_names:
+        compiled.append_step(step)
+        yield step
+
+
+# Moments (lists of (tile basis, step) entries, each list ending in a TICK) used by the memory experiment.
+PENTAGONAL_START_MOMENTS = [
+    [('X', 'R')],
+    [('X', 'AB')],
+]
+PENTAGONAL_ROUND_MOMENTS = [
+    [('X', '|')],
+    [('Z', 'R'), ('X', 'CD')],
+    [('X', 'M'), ('X', 'C'), ('Z', 'AB')],
+    [('Z', '|')],
+    [('X', 'R'), ('Z', 'CD')],
+    [('Z', 'M'), ('Z', 'C'), ('X', 'AB')],
+]
+PENTAGONAL_END_MOMENTS = [
+    [('X', '|')],
+    [('Z', 'R'), ('X', 'CD')],
+    [('X', 'M'), ('X', 'C'), ('Z', 'AB')],
+    [('Z', '|')],
+    [('Z', 'CD')],
+    [('Z', 'M'), ('Z', 'C')],
+]
+
+
+def pentagonal_detector_stencil(tile: Tile, *, use_classical_feedback: bool) -> List[Tuple[Any, int]]:
+    """The (key, layer offset) pairs compared by a tile's detector (see `CompiledDetectors`).
+
+    Without classical feedback, the detector also includes the measurements whose Pauli corrections
+    were omitted from the neighboring tile of the other basis.
+    """
     c = tile.center
-    possible_keys = [
-        AtLayer(c, layer),
-        AtLayer(c, layer - 1),
-    ]
+    terms = [(c, 0), (c, -1)]
     if not use_classical_feedback:
-        g = (lambda e: AtLayer(e, layer=layer)) if tile.basis == 'Z' else (lambda e: AtLayer(e, layer=layer - 1))
+        dt = 0 if tile.basis == 'Z' else -1
         f = (lambda e: c + e) if tile.um1().real == tile.um2().real else (lambda e: c + e.imag + 1j * e.real)
-        possible_keys.extend([
-            g(('|', f(-4j))),
-            g(('|', f(4j))),
-            g(f(-4j - 1)),
-            g(f(-4j + 1)),
-            g(f(3)),
-            g(f(-3)),
+        terms.extend([
+            (('|', f(-4j)), dt),
+            (('|', f(4j)), dt),
+            (f(-4j - 1), dt),
+            (f(-4j + 1), dt),
+            (f(3), dt),
+            (f(-3), dt),
         ])
-    return possible_keys
+    return terms
+
+
+def possible_tile_detector_keys(*, tile: Tile, layer: int, use_classical_feedback: bool) -> List[AtLayer]:
+    return [
+        AtLayer(k, layer + dt)
+        for k, dt in pentagonal_detector_stencil(tile, use_classical_feedback=use_classical_feedback)
+    ]
 
 
 def pentagonal_surface_code_memory_circuit(*, basis: str, rounds: int, diam: int, use_classical_feedback: bool = False, flip_orientation: bool) -> stim.Circuit:
@@ -152,33 +176,17 @@ def pentagonal_surface_code_memory_circuit(*, basis: str, rounds: int, diam: int
     used_set = data_set | measure_set
     builder = Builder.for_qubits(used_set)
 
-    def append_partial_layer(expected: str, basis_iters: Iterable[Iterator[str]]):
-        for it in basis_iters:
-            ran_layer = next(it)
-            if ran_layer != expected:
-                raise ValueError(f"Expected layer {expected} but got {ran_layer}")
-
-    def append_layers(xs: List[str], zs: List[str], z_first: bool = False, tick: bool = True):
-        if z_first:
-            for z in zs:
-                append_partial_layer(z, z_iters)
-        for x in xs:
-            append_partial_layer(x, x_iters)
-        if not z_first:
-            for z in zs:
-                append_partial_layer(z, z_iters)
-        if tick:
-            builder.tick()
-
-    x_tiles = [tile for tile in tiles if tile.basis == 'X']
-    z_tiles = [tile for tile in tiles if tile.basis == 'Z']
-    x_iters = [forever_iter_pentagonal_decompose_mpp_tile(tile=tile, builder=builder, use_classical_feedback=use_classical_feedback) for tile in x_tiles]
-    z_iters = [forever_iter_pentagonal_decompose_mpp_tile(tile=tile, builder=builder, use_classical_feedback=use_classical_feedback) for tile in z_tiles]
+    schedules = compile_schedule_by_basis(
+        schedule=pentagonal_schedule(use_classical_feedback=use_classical_feedback),
+        tiles=tiles,
+        builder=builder)
+
+    def append_moments(moments: List[List[Tuple[str, str]]], tick_after_last: bool = True):
+        append_schedule_moments(builder=builder, schedules=schedules, moments=moments, tick_after_last=tick_after_last)
 
     builder.gate(f'R{basis}', data_set)
 
-    append_layers(xs=['R'], zs=[])
-    append_layers(xs=['AB'], zs=[])
+    append_moments(PENTAGONAL_START_MOMENTS)
 
     circuit_so_far = stim.Circuit()
     if use_classical_feedback:
@@ -210,27 +218,30 @@ def pentagonal_surface_code_memory_circuit(*, basis: str, rounds: int, diam: int
                 if abs(relevant_coord(m)) == 1
             ]
 
+    def stencil(tile: Tile) -> List[Tuple[Any, int]]:
+        return pentagonal_detector_stencil(tile, use_classical_feedback=use_classical_feedback)
+
+    def final_stencil(tile: Tile) -> List[Tuple[Any, int]]:
+        return stencil(tile) + [(q, -1) for q in tile.data_set]
+
+    basis_tiles = [tile for tile in tiles if tile.basis == basis]
+    first_detectors = CompiledDetectors(stencil=stencil, tiles=basis_tiles, builder=builder, ignore_non_existent=True)
+    round_detectors = CompiledDetectors(stencil=stencil, tiles=tiles, builder=builder, ignore_non_existent=True)
+    final_detectors = CompiledDetectors(stencil=final_stencil, tiles=basis_tiles, builder=builder, ignore_non_existent=True)
+    feedback_observable = CompiledObservable(terms=[(k, 0) for k in obs_feedback_keys], builder=builder)
+    if basis == 'X':
+        obs_qs = [q for q in data_set if q.imag == 0]
+    else:
+        obs_qs = [q for q in data_set if q.real == 0]
+    data_observable = CompiledObservable(terms=[(q, 0) for q in obs_qs], builder=builder)
+
     for layer in range(min(3, rounds) - 1):
         circuit_so_far += builder.circuit
         builder.circuit.clear()
 
-        append_layers(xs=['|'], zs=[])
-        append_layers(xs=['CD'], zs=['R'], z_first=True)
-        append_layers(xs=['M', 'C'], zs=['AB'])
-        append_layers(xs=[], zs=['|'])
-        append_layers(xs=['R'], zs=['CD'])
-        append_layers(xs=['AB'], zs=['M', 'C'], z_first=True, tick=False)
-        for tile in tiles:
-            if tile.basis != basis and layer == 0:
-                continue
-            builder.detector(
-                possible_tile_detector_keys(tile=tile, layer=layer, use_classical_feedback=use_classical_feedback),
-                pos=tile.center,
-                ignore_non_existent=True)
-        builder.obs_include([
-            AtLayer(m, layer=layer)
-            for m in obs_feedback_keys
-        ], obs_index=0)
+        append_moments(PENTAGONAL_ROUND_MOMENTS, tick_after_last=False)
+        (first_detectors if layer == 0 else round_detectors).append_layer(layer)
+        feedback_observable.append_layer(layer)
         builder.shift_coords(dt=1)
         builder.tick()
 
@@ -241,37 +252,14 @@ def pentagonal_surface_code_memory_circuit(*, basis: str, rounds: int, diam: int
     else:
         last_layer = rounds - 1
 
-    append_layers(xs=['|'], zs=[])
-    append_layers(xs=['CD'], zs=['R'], z_first=True)
-    append_layers(xs=['M', 'C'], zs=['AB'])
-    append_layers(xs=[], zs=['|'])
-    append_layers(xs=[], zs=['CD'])
-    append_layers(xs=[], zs=['M', 'C'], tick=False)
-    builder.obs_include([
-        AtLayer(m, layer=last_layer)
-        for m in obs_feedback_keys
-    ], obs_index=0)
+    append_moments(PENTAGONAL_END_MOMENTS, tick_after_last=False)
+    feedback_observable.append_layer(last_layer)
 
     builder.measure(data_set, layer=last_layer, basis=basis)
-    layer = last_layer
-    for tile in tiles:
-        builder.detector(
-            possible_tile_detector_keys(tile=tile, layer=layer, use_classical_feedback=use_classical_feedback),
-            pos=tile.center,
-            ignore_non_existent=True)
+    round_detectors.append_layer(last_layer)
     builder.shift_coords(dt=1)
-    layer += 1
-    for tile in tiles:
-        if tile.basis == basis:
-            builder.detector(
-                possible_tile_detector_keys(tile=tile, layer=layer, use_classical_feedback=use_classical_feedback) + [AtLayer(q, layer - 1) for q in tile.data_set],
-                pos=tile.center,
-                ignore_non_existent=True)
-    if basis == 'X':
-        obs_qs = [q for q in data_set if q.imag == 0]
-    else:
-        obs_qs = [q for q in data_set if q.real == 0]
-    builder.obs_include([AtLayer(q, last_layer) for q in obs_qs], obs_index=0)
+    final_detectors.append_layer(last_layer + 1)
+    data_observable.append_layer(last_layer)
 
     circuit_so_far += builder.circuit
 
@@ -5,8 +5,8 @@ import stim
 
 from parsurf.circuits.chao_test import circuit_has_unsigned_stabilizers
 from parsurf.circuits.pentagonal import iter_pentagonal_decompose_mpp4, \
-    pentagonal_surface_code_memory_task
-from parsurf.tools import Builder, AtLayer, not_nones
+    pentagonal_surface_code_memory_task, pentagonal_schedule, pentagonal_surface_code_memory_circuit
+from parsurf.tools import Builder, AtLayer, CompiledSchedule, not_nones, surface_code_tiles
 
 
 def test_pentagonal_mpp_x4_feedback():
@@ -366,3 +366,102 @@ def test_exact_surface_code_memory_circuit():
         DEPOLARIZE1(0.001) 5 6 7 13 14 15 1 2 3 9 10 11 17 18 19 0 4 8 12 16 20
     """)
 
+
+@pytest.mark.parametrize('basis', 'XZ')
+def test_feedback_schedule_on_full_tiles(basis: str):
+    # The feedback variant needs both measurement qubits, so only use full tiles.
+    all_tiles = surface_code_tiles(diam=5, flip_orientation=False)
+    tiles = [
+        tile
+        for tile in all_tiles
+        if tile.basis == basis and None not in [tile.a, tile.b, tile.c, tile.d]
+    ]
+    builder = Builder.for_qubits({q for tile in all_tiles for q in tile.used_set})
+    compiled = CompiledSchedule(schedule=pentagonal_schedule(use_classical_feedback=True), tiles=tiles, builder=builder)
+    for step in compiled.step_names * 2:
+        compiled.append_step(step)
+    assert compiled.layer == 2
+
+    # The feedback makes the stabilizers of the other basis pass through without any corrections.
+    rec = builder.tracker.current_measurement_record_targets_for
+    opp = 'Z' if basis == 'X' else 'X'
+    data_qubits = {q for tile in tiles for q in tile.data_set}
+    assert circuit_has_unsigned_stabilizers(builder.circuit, [
+        *[({basis: [q]}, {basis: [q]}, []) for q in data_qubits],
+        *[
+            ({opp: tile.data_set}, {opp: tile.data_set}, [])
+            for tile in all_tiles
+            if tile.basis == opp
+        ],
+        *[
+            ({basis: tile.data_set}, {}, rec([AtLayer(tile.center, layer)]))
+            for tile in tiles
+            for layer in range(2)
+        ],
+    ], q2i=builder.q2i)
+
+
+@pytest.mark.parametrize('diameter,basis,flip_orientation', itertools.product(
+    range(2, 8),
+    'XZ',
+    [False, True],
+))
+def test_rounds_repeat_the_same_round(diameter: int, basis: str, flip_orientation: bool):
+    kwargs = dict(basis=basis, diam=diameter, flip_orientation=flip_orientation)
+    circuits = {
+        rounds: pentagonal_surface_code_memory_circuit(**kwargs, rounds=rounds)
+        for rounds in range(2, 10)
+    }
+    measurements_per_round = circuits[3].num_measurements - circuits[2].num_measurements
+    detectors_per_round = circuits[3].num_detectors - circuits[2].num_detectors
+    assert measurements_per_round > 0
+    assert detectors_per_round > 0
+    for rounds in range(3, 10):
+        assert circuits[rounds].num_measurements - circuits[rounds - 1].num_measurements == measurements_per_round
+        assert circuits[rounds].num_detectors - circuits[rounds - 1].num_detectors == detectors_per_round
+        assert circuits[rounds].num_observables == 1
+        circuits[rounds].detector_error_model()
+
+
+@pytest.mark.parametrize('diameter,basis,flip_orientation,use_classical_feedback', itertools.product(
+    range(2, 8),
+    'XZ',
+    [False, True],
+    [False, True],
+))
+def test_batched_sublayers_match_per_tile_generators(diameter: int, basis: str, flip_orientation: bool, use_classical_feedback: bool):
+    tiles = [
+        tile
+        for tile in surface_code_tiles(diam=diameter, flip_orientation=flip_orientation)
+        if tile.basis == basis
+    ]
+    if use_classical_feedback:
+        # The feedback variant needs both measurement qubits, so only use full tiles.
+        tiles = [tile for tile in tiles if None not in [tile.a, tile.b, tile.c, tile.d]]
+    qubits = {q for tile in tiles for q in tile.used_set}
+
+    b1 = Builder.for_qubits(qubits)
+    batch = CompiledSchedule(schedule=pentagonal_schedule(use_classical_feedback=use_classical_feedback), tiles=tiles, builder=b1)
+    b2 = Builder.for_qubits(qubits)
+    for layer in range(2):
+        iters = [
+            iter_pentagonal_decompose_mpp4(
+                a=tile.a,
+                b=tile.b,
+                c=tile.c,
+                d=tile.d,
+                m1=tile.m1(),
+                m2=tile.m2(),
+                key=tile.center,
+                basis=basis,
+                builder=b2,
+                layer=layer,
+                use_classical_feedback=use_classical_feedback)
+            for tile in tiles
+        ]
+        for step in batch.step_names:
+            batch.append_step(step)
+            for it in iters:
+                assert next(it) == step
+    assert b1.circuit == b2.circuit
+    assert b1.tracker.recorded == b2.tracker.recorded
@@ -1,24 +1,101 @@
+from typing import Optional
+
+import functools
+import hashlib
+import importlib.util
+import os
+import pathlib
+
 import sinter
+import stim
 
 from parsurf.tools import NoiseModel
 
+# Where cached ideal honeycomb circuits are stored when no cache directory is given. None disables the disk cache.
+HONEYCOMB_CACHE_DIR_ENV_VAR = 'PARSURF_HONEYCOMB_CACHE_DIR'
+
 
-def generate_honeycomb_task(basis: str, rounds: int, diam: int, noise: float) -> sinter.Task:
+def _import_honeycomb_layout():
     try:
         from hcb.codes.honeycomb.layout import HoneycombLayout
     except ImportError as ex:
         raise ImportError("Need to clone from https://github.com/Strilanc/honeycomb-boundaries and include its src directory in PYTHONPATH to generate honeycomb code circuits.") from ex
+    return HoneycombLayout
 
-    assert diam % 2 == 1
-    ideal_circuit = HoneycombLayout(
+
+@functools.lru_cache(maxsize=1)
+def hcb_version() -> str:
+    """Identifies the installed version of the external `hcb` package, without importing it.
+
+    The package is usually a source checkout on the PYTHONPATH (not an installed distribution), so
+    the version is a hash of its python sources.
+    """
+    spec = importlib.util.find_spec('hcb')
+    if spec is None or not spec.submodule_search_locations:
+        return 'missing'
+    h = hashlib.sha256()
+    for location in spec.submodule_search_locations:
+        root = pathlib.Path(location)
+        for path in sorted(root.rglob('*.py')):
+            if path.name.endswith('_test.py'):
+                continue
+            h.update(str(path.relative_to(root)).encode())
+            h.update(path.read_bytes())
+    return h.hexdigest()[:16]
+
+
+def _build_ideal_honeycomb_circuit(*, basis: str, diam: int) -> stim.Circuit:
+    HoneycombLayout = _import_honeycomb_layout()
+    return HoneycombLayout(
         data_width=diam + 1,
         data_height=(diam + 1) // 2 * 3,
-        noise_level=noise,
+        # Only the structure of the circuit is used, since the noise is stripped and re-added below.
+        noise_level=0.001,
         noisy_gate_set='EM3_v1',
         tested_observable='V' if basis == 'Z' else 'H',
         sheared=False,
         rounds=diam * 3 - 1,
     ).noisy_circuit().without_noise()
+
+
+@functools.lru_cache(maxsize=16)
+def _memory_cached_ideal_honeycomb_circuit(basis: str, diam: int, cache_dir: Optional[str]) -> stim.Circuit:
+    if cache_dir is None:
+        return _build_ideal_honeycomb_circuit(basis=basis, diam=diam)
+
+    directory = pathlib.Path(cache_dir)
+    path = directory / f'b={basis},d={diam},hcb={hcb_version()}.stim'
+    try:
+        return stim.Circuit.from_file(str(path))
+    except (FileNotFoundError, ValueError):
+        # Missing, or corrupt (e.g. from an interrupted write before atomic renames); rebuild it.
+        pass
+
+    circuit = _build_ideal_honeycomb_circuit(basis=basis, diam=diam)
+    directory.mkdir(exist_ok=True, parents=True)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        print(circuit, file=f)
+    os.replace(tmp, path)
+    return circuit
+
+
+def ideal_honeycomb_circuit(*, basis: str, diam: int, cache_dir: Optional[pathlib.Path] = None) -> stim.Circuit:
+    """Returns the noiseless honeycomb reference circuit, building it with the external `hcb` package on a miss.
+
+    The circuit only depends on the basis, the diameter (which also determines the number of rounds)
+    and the `hcb` version, so it's cached under those: in memory, and on disk when a cache directory
+    is given (or set with the PARSURF_HONEYCOMB_CACHE_DIR environment variable). `hcb` is only
+    imported when the circuit has to be built.
+    """
+    assert diam % 2 == 1
+    if cache_dir is None:
+        cache_dir = os.environ.get(HONEYCOMB_CACHE_DIR_ENV_VAR) or None
+    return _memory_cached_ideal_honeycomb_circuit(basis, diam, None if cache_dir is None else str(cache_dir)).copy()
+
+
+def generate_honeycomb_task(basis: str, rounds: int, diam: int, noise: float, cache_dir: Optional[pathlib.Path] = None) -> sinter.Task:
+    ideal_circuit = ideal_honeycomb_circuit(basis=basis, diam=diam, cache_dir=cache_dir)
     noisy_circuit = NoiseModel.depolarizing_two_body_measurement_noise(noise).noisy_circuit(ideal_circuit)
     m = {
         'd': diam,
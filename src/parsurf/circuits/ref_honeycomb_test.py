@@ -0,0 +1,31 @@
+import stim
+
+from parsurf.circuits import ref_honeycomb
+
+
+def test_ideal_honeycomb_circuit_cache(tmp_path, monkeypatch):
+    built = []
+
+    def fake_build(*, basis: str, diam: int) -> stim.Circuit:
+        built.append((basis, diam))
+        return stim.Circuit(f'R{basis} 0\nTICK\nM{basis} 0\nDETECTOR rec[-1]\nOBSERVABLE_INCLUDE(0) rec[-1]')
+
+    monkeypatch.setattr(ref_honeycomb, '_build_ideal_honeycomb_circuit', fake_build)
+    ref_honeycomb._memory_cached_ideal_honeycomb_circuit.cache_clear()
+
+    a = ref_honeycomb.ideal_honeycomb_circuit(basis='X', diam=3, cache_dir=tmp_path)
+    b = ref_honeycomb.ideal_honeycomb_circuit(basis='X', diam=3, cache_dir=tmp_path)
+    assert a == b
+    assert built == [('X', 3)]
+    assert len(list(tmp_path.glob('b=X,d=3,hcb=*.stim'))) == 1
+
+    # A fresh process (simulated by clearing the memory cache) reads the disk cache instead of rebuilding.
+    ref_honeycomb._memory_cached_ideal_honeycomb_circuit.cache_clear()
+    task = ref_honeycomb.generate_honeycomb_task(basis='X', rounds=8, diam=3, noise=0.001, cache_dir=tmp_path)
+    assert built == [('X', 3)]
+    assert task.json_metadata == {'d': 3, 'r': 8, 'b': 'X', 'p': 0.001, 'c': 'honeycomb', 'q': 1}
+    assert task.circuit != a
+
+    ref_honeycomb.ideal_honeycomb_circuit(basis='Z', diam=3, cache_dir=tmp_path)
+    assert built == [('X', 3), ('Z', 3)]
+    ref_honeycomb._memory_cached_ideal_honeycomb_circuit.cache_clear()
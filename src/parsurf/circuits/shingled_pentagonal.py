@@ -1,9 +1,40 @@
-from typing import Any, Iterable, Iterator, List, Optional
+from typing import Any, Iterator, List, Optional, Tuple
 
 import sinter
 import stim
 
-from parsurf.tools import Builder, AtLayer, NoiseModel, surface_code_tiles, Tile, not_nones
+from parsurf.tools import Builder, NoiseModel, surface_code_tiles, Tile, DecompositionSchedule, \
+    Role, ResetOp, MeasureOp, MeasureProductOp, GroupOp, compile_schedule_by_basis, append_schedule_moments, \
+    CompiledDetectors, CompiledObservable, compile_for_roles
+
+
+def _shingled_pentagonal_schedule() -> DecompositionSchedule:
+    key = Role('key')
+    return DecompositionSchedule(
+        steps=(
+            ('R', (ResetOp(basis='opp', qubits=('m1', 'm2')),)),
+            ('A', (MeasureProductOp(basis='bas', qubits=('a', 'm1'), key=('a', key)),)),
+            ('B', (MeasureProductOp(basis='bas', qubits=('b', 'm2'), key=('b', key)),)),
+            ('|', (MeasureProductOp(basis='opp', qubits=('m1', 'm2'), key=('|', key), require_all=True),)),
+            ('C', (MeasureProductOp(basis='bas', qubits=('c', 'm1'), key=('c', key)),)),
+            ('D', (MeasureProductOp(basis='bas', qubits=('d', 'm2'), key=('d', key)),)),
+            ('M', (MeasureOp(basis='opp', qubits=('m1', 'm2')),)),
+            ('C', (GroupOp(sub_keys=(('a', key), ('b', key), ('c', key), ('d', key)), key=key),)),
+        ),
+        roles=lambda tile: {
+            'a': tile.a,
+            'b': tile.b,
+            'c': tile.c,
+            'd': tile.d,
+            'm1': tile.m1(),
+            'm2': tile.m2(),
+            'key': tile.center,
+        },
+    )
+
+
+# Decomposes a four body measurement into two body measurements, one data qubit at a time.
+SHINGLED_PENTAGONAL_SCHEDULE = _shingled_pentagonal_schedule()
 
 
 def iter_shingled_pentagonal_decompose_mpp4(
@@ -16,55 +47,23 @@ def iter_shingled_pentagonal_decompose_mpp4(
         m2: complex,
         key: Any,
         basis: str,
-        builder: Builder, layer: int):
-    bas = basis
-    opp = 'Z' if bas == 'X' else 'X'
-
-    builder.gate(f"R{opp}", not_nones([m1, m2]))
-    yield 'R'
-    builder.measure_pauli_product(qs={bas: not_nones([a, m1])}, key=('a', key), layer=layer)
-    yield 'A'
-    builder.measure_pauli_product(qs={bas: not_nones([b, m2])}, key=('b', key), layer=layer)
-    yield 'B'
-    builder.measure_pauli_product(qs={opp: [m1, m2] * (m1 is not None and m2 is not None)}, key=('|', key), layer=layer)
-    yield '|'
-    builder.measure_pauli_product(qs={bas: not_nones([c, m1])}, key=('c', key), layer=layer)
-    yield 'C'
-    builder.measure_pauli_product(qs={bas: not_nones([d, m2])}, key=('d', key), layer=layer)
-    yield 'D'
-    builder.measure(not_nones([m1, m2]), basis=opp, layer=layer)
-    yield 'M'
-    builder.tracker.make_measurement_group([
-        AtLayer(('a', key), layer=layer),
-        AtLayer(('b', key), layer=layer),
-        AtLayer(('c', key), layer=layer),
-        AtLayer(('d', key), layer=layer),
-    ], key=AtLayer(key, layer))
-    yield 'C'
-
-
-def forever_iter_shingled_pentagonal_decompose_mpp_tile(
-        *,
-        tile: Tile,
-        builder: Builder):
-    a = tile.a
-    b = tile.b
-    c = tile.c
-    d = tile.d
-    m1 = tile.m1()
-    m2 = tile.m2()
-
-    layer = 0
-    while True:
-        yield from iter_shingled_pentagonal_decompose_mpp4(
-            a=a,
-            b=b,
-            c=c,
-            d=d,
-            m1=m1,
-            m2=m2,
-            key=tile.center, basis=tile.basis, builder=builder, layer=layer)
-        layer += 1
+        builder: Builder, layer: int) -> Iterator[str]:
+    """Appends `SHINGLED_PENTAGONAL_SCHEDULE` for a single tile one step at a time, yielding each step's name."""
+    compiled = compile_for_roles(
+        schedule=SHINGLED_PENTAGONAL_SCHEDULE,
+        roles=dict(a=a, b=b, c=c, d=d, m1=m1, m2=m2, key=key),
+        basis=basis,
+        builder=builder,
+        layer=layer)
+    for step in compiled.step_names:
+        compiled.append_step(step)
+        yield step
+
+# Moments of one round of the memory experiment. Each moment runs its steps on the X tiles, then the Z tiles.
+SHINGLED_PENTAGONAL_ROUND_MOMENTS = [
+    [(b, step) for b in 'XZ' for step in steps]
+    for steps in [['R'], ['A'], ['B'], ['|'], ['C'], ['D'], ['M', 'C']]
+]
 
 
 def shingled_pentagonal_memory_experiment_circuit(*, diam: int, basis: str, rounds: int) -> stim.Circuit:
@@ -74,30 +73,42 @@ def shingled_pentagonal_memory_experiment_circuit(*, diam: int, basis: str, roun
     used_set = data_set | measure_set
     builder = Builder.for_qubits(used_set)
 
-    iter_xs = []
-    iter_zs = []
-    for tile in tiles:
-        it = forever_iter_shingled_pentagonal_decompose_mpp_tile(tile=tile, builder=builder)
-        if tile.basis == 'X':
-            iter_xs.append(it)
-        else:
-            iter_zs.append(it)
-
-    def append_partial_layer(expected: str, basis_iters: Iterable[Iterator[str]]):
-        for it in basis_iters:
-            ran_layer = next(it)
-            if ran_layer != expected:
-                raise ValueError(f"Expected layer {expected} but got {ran_layer}")
-
-    def append_layers(layers: List[str], tick: bool = True):
-        for x in layers:
-            append_partial_layer(x, iter_xs)
-        for z in layers:
-            append_partial_layer(z, iter_zs)
-        if tick:
-            builder.tick()
+    schedules = compile_schedule_by_basis(schedule=SHINGLED_PENTAGONAL_SCHEDULE, tiles=tiles, builder=builder)
     existing_tiles = {tile.center for tile in tiles}
 
+    def neighbor_terms(tile: Tile) -> List[Tuple[Any, int]]:
+        f = (lambda e: tile.center + e) if tile.basis == 'Z' else (lambda e: tile.center + e.imag + e.real * 1j)
+        return [
+            *([(f(-3), -1)] * (f(-4) in existing_tiles)),
+            *([
+                (('|', f(-4j)), -1),
+                (f(-4j - 1), -1),
+                (f(-4j + 1), -1),
+            ] * (f(-4j) in existing_tiles)),
+        ]
+
+    def stencil(tile: Tile) -> List[Tuple[Any, int]]:
+        f = (lambda e: tile.center + e) if tile.basis == 'Z' else (lambda e: tile.center + e.imag + e.real * 1j)
+        return [
+            (f(0), 0),
+            (f(0), -1),
+            *neighbor_terms(tile),
+            *([(f(3), 0)] * (f(4) in existing_tiles)),
+            *([(('|', f(4j)), 0)] * (f(4j) in existing_tiles)),
+        ]
+
+    def final_stencil(tile: Tile) -> List[Tuple[Any, int]]:
+        return [
+            (tile.center, -1),
+            *[(q, -1) for q in tile.data_set],
+            *neighbor_terms(tile),
+        ]
+
+    basis_tiles = [tile for tile in tiles if tile.basis == basis]
+    first_detectors = CompiledDetectors(stencil=stencil, tiles=basis_tiles, builder=builder)
+    round_detectors = CompiledDetectors(stencil=stencil, tiles=tiles, builder=builder)
+    final_detectors = CompiledDetectors(stencil=final_stencil, tiles=basis_tiles, builder=builder)
+
     if basis == 'X':
         obs_qubits = [d for d in data_set if d.imag == 0]
         obs_anticomms = [m for m in measure_set if abs(m.imag) == 1]
@@ -106,64 +117,21 @@ def shingled_pentagonal_memory_experiment_circuit(*, diam: int, basis: str, roun
         obs_anticomms = [m for m in measure_set if abs(m.real) == 1]
     else:
         raise NotImplementedError(f'{basis=}')
+    anticommuting_observable = CompiledObservable(terms=[(m, 0) for m in obs_anticomms], builder=builder)
+    data_observable = CompiledObservable(terms=[(d, 0) for d in obs_qubits], builder=builder)
 
     builder.gate(f"R{basis}", data_set)
     for layer in range(rounds):
-        append_layers(['R'])
-        append_layers(['A'])
-        append_layers(['B'])
-        append_layers(['|'])
-        append_layers(['C'])
-        append_layers(['D'])
-        append_layers(['M', 'C'], tick=False)
-        for tile in tiles:
-            if layer != 0 or basis == tile.basis:
-                f = (lambda e: tile.center + e) if tile.basis == 'Z' else (lambda e: tile.center + e.imag + e.real * 1j)
-                cur = lambda e: AtLayer(e, layer=layer)
-                prev = lambda e: AtLayer(e, layer=layer - 1)
-                builder.detector([
-                    cur(f(0)),
-                    *([prev(f(0))] * (layer > 0)),
-                    *([
-                          prev(f(-3)),
-                    ] * (f(-4) in existing_tiles and layer > 0)),
-                    *([
-                          cur(f(3)),
-                      ] * (f(4) in existing_tiles)),
-                    *([
-                        prev(('|', f(-4j))),
-                        prev(f(-4j - 1)),
-                        prev(f(-4j + 1)),
-                    ] * (f(-4j) in existing_tiles and layer > 0)),
-                    *([
-                        cur(('|', f(4j))),
-                    ] * (f(4j) in existing_tiles)),
-                ], pos=tile.center)
+        append_schedule_moments(builder=builder, schedules=schedules, moments=SHINGLED_PENTAGONAL_ROUND_MOMENTS, tick_after_last=False)
+        (first_detectors if layer == 0 else round_detectors).append_layer(layer)
         builder.shift_coords(dt=1)
-        builder.obs_include([AtLayer(m, layer=layer) for m in obs_anticomms], obs_index=0)
+        anticommuting_observable.append_layer(layer)
         if layer < rounds - 1:
             builder.tick()
 
     builder.measure(data_set, basis=basis, layer=rounds - 1)
-    for tile in tiles:
-        if tile.basis == basis:
-            layer = rounds
-            f = (lambda e: tile.center + e) if tile.basis == 'Z' else (lambda e: tile.center + e.imag + e.real * 1j)
-            prev = lambda e: AtLayer(e, layer=layer - 1)
-            builder.detector([
-                prev(f(0)),
-                *[prev(q) for q in tile.data_set],
-                *([
-                      prev(f(-3)),
-                  ] * (f(-4) in existing_tiles)),
-                *([
-                      prev(('|', f(-4j))),
-                      prev(f(-4j - 1)),
-                      prev(f(-4j + 1)),
-                  ] * (f(-4j) in existing_tiles)),
-            ], pos=tile.center)
-
-    builder.obs_include([AtLayer(d, layer=rounds - 1) for d in obs_qubits], obs_index=0)
+    final_detectors.append_layer(rounds)
+    data_observable.append_layer(rounds - 1)
 
     return builder.circuit
 
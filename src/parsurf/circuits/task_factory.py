@@ -0,0 +1,131 @@
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, Union
+
+import functools
+
+import sinter
+import stim
+
+from parsurf.circuits.chao import chao_memory_experiment_circuit
+from parsurf.circuits.pentagonal import pentagonal_surface_code_memory_circuit
+from parsurf.circuits.ref_honeycomb import ideal_honeycomb_circuit
+from parsurf.circuits.shingled_pentagonal import shingled_pentagonal_memory_experiment_circuit
+from parsurf.tools import circuit_file_metadata, NoiseModel, task_from_archive_entry, task_from_circuit_file
+
+# Maps the 'c' value of a task description to a function producing the noiseless circuit.
+# Each function takes the basis, rounds, diam and the remaining (optional) description entries.
+IDEAL_CIRCUIT_BUILDERS: Dict[str, Callable[..., stim.Circuit]] = {
+    'chao': lambda *, basis, rounds, diam: chao_memory_experiment_circuit(
+        basis=basis, rounds=rounds, diam=diam),
+    'pentagonal_sharp': lambda *, basis, rounds, diam, use_classical_feedback=False: pentagonal_surface_code_memory_circuit(
+        basis=basis, rounds=rounds, diam=diam, use_classical_feedback=use_classical_feedback, flip_orientation=False),
+    'pentagonal_smooth': lambda *, basis, rounds, diam, use_classical_feedback=False: pentagonal_surface_code_memory_circuit(
+        basis=basis, rounds=rounds, diam=diam, use_classical_feedback=use_classical_feedback, flip_orientation=True),
+    'shingled_pentagonal': lambda *, basis, rounds, diam: shingled_pentagonal_memory_experiment_circuit(
+        basis=basis, rounds=rounds, diam=diam),
+    # Needs the external hcb package on a cache miss (see `ideal_honeycomb_circuit`).
+    'honeycomb': lambda *, basis, rounds, diam: ideal_honeycomb_circuit(basis=basis, diam=diam),
+}
+
+# Description entries that don't correspond to builder arguments.
+_STANDARD_KEYS = {'c', 'b', 'd', 'r', 'p', 'q'}
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_ideal_circuit(c: str, basis: str, rounds: int, diam: int, extra: tuple) -> stim.Circuit:
+    if c not in IDEAL_CIRCUIT_BUILDERS:
+        raise NotImplementedError(f'Unknown circuit family {c=}. Known: {sorted(IDEAL_CIRCUIT_BUILDERS)}.')
+    return IDEAL_CIRCUIT_BUILDERS[c](basis=basis, rounds=rounds, diam=diam, **dict(extra))
+
+
+def ideal_circuit_from_description(description: Dict[str, Any]) -> stim.Circuit:
+    """Returns the noiseless circuit of a task description (ignoring its 'p' entry).
+
+    Results are cached per process, keyed by everything in the description except the noise.
+    """
+    extra = tuple(sorted((k, v) for k, v in description.items() if k not in _STANDARD_KEYS))
+    circuit = _cached_ideal_circuit(description['c'], description['b'], description['r'], description['d'], extra)
+    return circuit.copy()
+
+
+def task_from_description(description: Dict[str, Any]) -> sinter.Task:
+    """Expands a task description into a sinter task.
+
+    Descriptions are small picklable dicts (e.g. `{'c': 'pentagonal_sharp', 'd': 19, 'r': 57, 'b': 'X',
+    'p': 0.001}`) that are cheap to create, send between processes and store. The noiseless circuit
+    is cached, so expanding the same circuit at several noise strengths only builds it once per process.
+
+    The task's metadata matches the metadata of the corresponding generated circuit file (including
+    the 'q' qubit count), so stats collected either way can be combined.
+
+    Args:
+        description: A dict with entries 'c' (the circuit family), 'b' (the basis), 'd' (the patch
+            diameter), 'r' (the number of rounds), 'p' (the noise strength) and any optional
+            family-specific entries (e.g. 'use_classical_feedback' for the pentagonal circuits).
+
+    Returns:
+        The sinter task.
+    """
+    circuit = ideal_circuit_from_description(description)
+    noisy_circuit = NoiseModel.depolarizing_two_body_measurement_noise(description['p']).noisy_circuit(circuit)
+    m = {k: v for k, v in description.items() if k != 'q'}
+    m['q'] = circuit.num_qubits
+    return sinter.Task(
+        circuit=noisy_circuit,
+        json_metadata=m,
+    )
+
+
+def task_from_source(source: Union[Dict[str, Any], str, Tuple[str, str]]) -> sinter.Task:
+    """Expands a task source: a task description, a circuit file path or an archive entry.
+
+    Task descriptions are dicts (see `task_from_description`), circuit files are given by their
+    paths, and archived circuits by (archive path, entry name) pairs (see `CircuitArchive.sources`).
+    `collect_task_stats` takes a single task factory, so this lets one collection mix generated
+    tasks with circuit files and archives.
+    """
+    if isinstance(source, str):
+        return task_from_circuit_file(source)
+    if isinstance(source, tuple):
+        return task_from_archive_entry(source)
+    return task_from_description(source)
+
+
+def source_metadata(source: Union[Dict[str, Any], str, Tuple[str, str]]) -> Dict[str, Any]:
+    """The json metadata of a `task_from_source` task, as far as it is known without building it.
+
+    Circuit files and archive entries have their metadata in their names. Task descriptions are
+    their own metadata, minus the 'q' qubit count that is only known once the circuit is built.
+    """
+    if isinstance(source, str):
+        return circuit_file_metadata(source)
+    if isinstance(source, tuple):
+        return circuit_file_metadata(source[1])
+    return source
+
+
+def iter_tasks_from_descriptions(descriptions: Iterable[Dict[str, Any]]) -> Iterator[sinter.Task]:
+    """Lazily expands task descriptions.
+
+    `sinter.collect` pulls tasks from its iterable as it needs them, so passing this iterator lets
+    sampling start as soon as the first circuit is built, instead of after every circuit is built.
+    """
+    for description in descriptions:
+        yield task_from_description(description)
+
+
+def task_descriptions(
+        *,
+        circuits: Iterable[str],
+        bases: Iterable[str],
+        diams: Iterable[int],
+        round_factors: Iterable[int],
+        noises: Iterable[float]) -> List[Dict[str, Any]]:
+    """Lists the descriptions of a sweep, using the same grid as `generate_circuit_files.py`."""
+    return [
+        {'c': c, 'b': b, 'd': d, 'r': d * f, 'p': p}
+        for c in circuits
+        for b in bases
+        for d in diams
+        for f in round_factors
+        for p in noises
+    ]
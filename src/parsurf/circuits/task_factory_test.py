@@ -0,0 +1,35 @@
+import pickle
+
+import pytest
+
+from parsurf.circuits.chao import chao_memory_experiment_task
+from parsurf.circuits.pentagonal import pentagonal_surface_code_memory_task
+from parsurf.circuits.task_factory import iter_tasks_from_descriptions, task_descriptions, task_from_description
+
+
+def test_task_from_description_matches_generated_tasks():
+    description = {'c': 'pentagonal_sharp', 'd': 5, 'r': 6, 'b': 'X', 'p': 0.001}
+    task = task_from_description(pickle.loads(pickle.dumps(description)))
+    expected = pentagonal_surface_code_memory_task(basis='X', rounds=6, diam=5, noise=0.001)
+    assert task.circuit == expected.circuit
+    assert task.json_metadata == expected.json_metadata
+
+    smooth = task_from_description({**description, 'c': 'pentagonal_smooth'})
+    assert smooth.json_metadata['c'] == 'pentagonal_smooth'
+    assert smooth.circuit != task.circuit
+
+    with pytest.raises(NotImplementedError, match='Unknown circuit family'):
+        task_from_description({**description, 'c': 'nope'})
+
+
+def test_iter_tasks_from_descriptions():
+    descriptions = task_descriptions(circuits=['chao'], bases=['Z'], diams=[3], round_factors=[2], noises=[0.001, 0.002])
+    assert descriptions == [
+        {'c': 'chao', 'b': 'Z', 'd': 3, 'r': 6, 'p': 0.001},
+        {'c': 'chao', 'b': 'Z', 'd': 3, 'r': 6, 'p': 0.002},
+    ]
+    tasks = list(iter_tasks_from_descriptions(descriptions))
+    for task, p in zip(tasks, [0.001, 0.002]):
+        expected = chao_memory_experiment_task(basis='Z', rounds=6, diam=3, noise=p)
+        assert task.circuit == expected.circuit
+        assert task.json_metadata == expected.json_metadata
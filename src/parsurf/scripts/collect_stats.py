@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+import argparse
+import pathlib
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import sinter
+
+from parsurf.circuits.task_factory import IDEAL_CIRCUIT_BUILDERS, source_metadata, task_descriptions, task_from_source
+from parsurf.scripts.footprint_allocation import FootprintAllocator
+from parsurf.tools import CircuitArchive, collect_task_stats, CollectionProgress, CollectionPruner, \
+    CollectionTask, CoordinatorOptions, DecodeCounters, DecoderDisagreements, DISAGREEMENTS_CSV_HEADER, \
+    is_stats_database_path, parse_address, read_stats_csv, SamplerOptions, StatsDatabase, windowed_decoder_name
+
+
+class StatsCsvWriter:
+    """Appends stats to a CSV file in the format written by `sinter collect --save_resume_filepath`."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        is_new = not path.exists() or path.stat().st_size == 0
+        self._file = open(path, 'a')
+        if is_new:
+            print(sinter.CSV_HEADER, file=self._file, flush=True)
+
+    def write(self, stats: sinter.TaskStats) -> None:
+        print(stats.to_csv_line(), file=self._file, flush=True)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class DisagreementsCsvWriter:
+    """Appends the disagreements of paired decoders to a CSV file (see `DISAGREEMENTS_CSV_HEADER`)."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        is_new = not path.exists() or path.stat().st_size == 0
+        self._file = open(path, 'a')
+        if is_new:
+            print(DISAGREEMENTS_CSV_HEADER, file=self._file, flush=True)
+
+    def write_disagreements(self, disagreements: DecoderDisagreements) -> None:
+        print(disagreements.to_csv_line(), file=self._file, flush=True)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def open_stats_output(path: pathlib.Path) -> Tuple[List[sinter.TaskStats], Union[StatsCsvWriter, StatsDatabase]]:
+    """Reads the stats already at the output path, and opens it for appending.
+
+    Paths with a database suffix (see `is_stats_database_path`) are `StatsDatabase` files, whose
+    stats are read combined per task. Other paths are CSV files.
+    """
+    if is_stats_database_path(path):
+        db = StatsDatabase(path)
+        return db.combined(), db
+    existing = read_stats_csv(path) if path.exists() else []
+    return existing, StatsCsvWriter(path)
+
+
+def open_disagreements_output(path: pathlib.Path) -> Union[DisagreementsCsvWriter, StatsDatabase]:
+    """Opens a disagreements CSV file, or the disagreements table of a stats database (by suffix), for appending."""
+    if is_stats_database_path(path):
+        return StatsDatabase(path)
+    return DisagreementsCsvWriter(path)
+
+
+def _existing_stats_for_descriptions(existing: List[sinter.TaskStats], descriptions: List[Dict[str, Any]]) -> List[sinter.TaskStats]:
+    """Re-keys existing stats by description, so they can be matched without building circuits.
+
+    Generated tasks also have a 'q' (qubit count) metadata entry, which isn't known without the
+    circuit. It's dropped from copies of the matching stats (only the new stats are written). The
+    stats themselves are kept too, for matching circuit files (whose names include 'q').
+    """
+    wanted = {tuple(sorted(d.items())) for d in descriptions}
+    result = []
+    for stat in existing:
+        m = {k: v for k, v in stat.json_metadata.items() if k != 'q'}
+        if 'q' in stat.json_metadata and tuple(sorted(m.items())) in wanted:
+            result.append(sinter.TaskStats(
+                strong_id=stat.strong_id,
+                decoder=stat.decoder,
+                json_metadata=m,
+                shots=stat.shots,
+                errors=stat.errors,
+                discards=stat.discards,
+                seconds=stat.seconds,
+            ))
+        result.append(stat)
+    return result
+
+
+def parse_selection(terms: List[str]) -> Dict[str, Any]:
+    """Parses KEY=VALUE terms, converting numeric values like the metadata parsed from file names."""
+    result = {}
+    for term in terms:
+        key, sep, value = term.partition('=')
+        if not sep:
+            raise ValueError(f'Expected a KEY=VALUE term, but got {term!r}.')
+        for convert in (int, float):
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+        result[key] = value
+    return result
+
+
+def print_status(tasks: List[CollectionTask], start_time: float) -> None:
+    done = sum(task.done for task in tasks)
+    shots = sum(task.stats.shots for task in tasks)
+    errors = sum(task.stats.errors for task in tasks)
+    print(f'[{time.monotonic() - start_time:.0f}s] {done}/{len(tasks)} tasks done, '
+          f'{shots} shots and {errors} errors in total', file=sys.stderr)
+    counters = sum((task.decode_counters for task in tasks), DecodeCounters())
+    if counters.shots:
+        print(f'    decoding: {counters}', file=sys.stderr)
+    paired: Dict[str, sinter.AnonTaskStats] = {}
+    for task in tasks:
+        for decoder, stats in task.paired_stats.items():
+            paired[decoder] = paired.get(decoder, sinter.AnonTaskStats()) + stats
+    for decoder, stats in paired.items():
+        print(f'    {decoder}: {stats.errors} of {stats.shots} shots', file=sys.stderr)
+    disagreements: Dict[Tuple[str, str], Tuple[int, int]] = {}
+    for task in tasks:
+        for pair, d in task.disagreements.items():
+            shots, count = disagreements.get(pair, (0, 0))
+            disagreements[pair] = (shots + d.shots, count + d.disagreements)
+    for (decoder, other), (shots, count) in disagreements.items():
+        print(f'    {decoder} vs {other}: {count} of {shots} shots disagreed', file=sys.stderr)
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description='Samples memory experiments, building their circuits in memory instead of reading circuit files. '
+                    'Writes stats in the same CSV format as `sinter collect`, and resumes from it.')
+    parser.add_argument('--out_csv', required=True, type=str,
+                        help='Stats CSV file to append to, or stats database file (.db, .sqlite or .sqlite3).')
+    parser.add_argument('--circuits', nargs='+', default=['chao', 'pentagonal_sharp'], choices=sorted(IDEAL_CIRCUIT_BUILDERS),
+                        help='Circuit families to sample (the "c" metadata values).')
+    parser.add_argument('--basis', nargs='+', default=(), type=str)
+    parser.add_argument('--noise', nargs='+', default=(), type=float)
+    parser.add_argument('--round_factors', nargs='+', default=(), type=int)
+    parser.add_argument('--diam', nargs='+', default=(), type=int)
+    parser.add_argument('--circuit_files', nargs='+', default=(), type=str,
+                        help='Also sample these (possibly compressed) circuit files, with metadata from their names.')
+    parser.add_argument('--archive', nargs='+', default=(), type=str,
+                        help='Also sample the circuits packed into these circuit archives (see '
+                             'generate_circuit_files.py --archive), with metadata from their entry names.')
+    parser.add_argument('--select', nargs='+', default=(), type=str, metavar='KEY=VALUE',
+                        help='Only sample the --archive circuits with these metadata values (e.g. c=chao d=5).')
+    parser.add_argument('--processes', required=True, type=int,
+                        help='Number of worker processes. 0 samples in the main process.')
+    parser.add_argument('--decoder', default='pymatching', choices=['pymatching'])
+    parser.add_argument('--decoding_window', nargs=2, default=None, type=int, metavar=('COMMIT', 'BUFFER'),
+                        help='Decode with sliding windows over the detectors\' time coordinate, each committing COMMIT '
+                             'rounds and looking BUFFER rounds ahead. Stats are recorded under the decoder name '
+                             '"<decoder>:window=COMMIT+BUFFER".')
+    parser.add_argument('--paired_decoders', nargs='+', default=(), type=str,
+                        help='Also decode every sampled batch with these decoders (e.g. "pymatching:window=3+3"), '
+                             'recording their stats in --paired_out_csv. The stopping conditions only look at the '
+                             '--decoder stats.')
+    parser.add_argument('--paired_out_csv', default=None, type=str,
+                        help='With --paired_decoders, append their stats to this stats CSV file (or stats database '
+                             'file), which must differ from --out_csv so the decoders\' stats aren\'t plotted '
+                             'together. Without it, the paired decoders\' stats are only summarized.')
+    parser.add_argument('--disagreements_csv', default=None, type=str,
+                        help='With --paired_decoders, append the number of shots where each pair of decoders '
+                             'predicted different observable flips to this disagreements CSV file (or to the '
+                             'disagreements table of a stats database file).')
+    parser.add_argument('--max_shots', default=100_000_000, type=int)
+    parser.add_argument('--max_errors', default=10_000, type=int)
+    parser.add_argument('--max_batch_size', default=100_000, type=int)
+    parser.add_argument('--batch_memory_mb', default=256, type=float,
+                        help='Memory budget of the sample arrays of each worker. Larger batches are sampled and '
+                             'decoded in chunks that fit.')
+    parser.add_argument('--adaptive_footprint_ratio', default=None, type=float,
+                        help='Instead of sampling every task to its limits, direct shots to the tasks that tighten the '
+                             'teraquop footprint fits of plot_footprint.py the most per CPU-second, and stop each fit '
+                             'group (circuit, basis, noise) once its fit interval has high <= ratio * low.')
+    parser.add_argument('--adaptive_chunking', default='d', choices=['shot', 'd', 'round'],
+                        help='The chunking the footprint fits are made with (see plot_footprint.py).')
+    parser.add_argument('--adaptive_refit_seconds', default=30, type=float,
+                        help='How often the footprint fits are recomputed.')
+    parser.add_argument('--dem_cache_dir', default=None, type=str,
+                        help='Load detector error models and decoder graphs from this directory (storing them on a '
+                             'miss), so resumed and repeated collections skip deriving them.')
+    parser.add_argument('--share_graphs', action='store_true',
+                        help="Build each task's decoder graph once, in the main process, and share it with the worker "
+                             'processes through shared memory, instead of having each worker derive it.')
+    parser.add_argument('--decode_cache_size', default=None, type=int,
+                        help='Skip the decoder for shots without detection events, and remember the predictions for '
+                             'this many recently seen syndromes. Reports how many shots needed the decoder.')
+    parser.add_argument('--prune', action='store_true',
+                        help='Stop sampling tasks whose pilot samples show they are saturated (error rate >= 0.4) '
+                             'or not improving with distance. Curves that don\'t improve with distance are stopped '
+                             'at that p and above.')
+    parser.add_argument('--coordinator', default=None, type=str, metavar='ADDRESS',
+                        help='Lease batches to workers connecting to this HOST:PORT (or Unix socket path), started '
+                             'on any machine with collect_worker.py, besides the --processes local workers. Batches '
+                             'of workers that disconnect or overrun --lease_seconds are handed out again.')
+    parser.add_argument('--authkey_file', default=None, type=str,
+                        help='File holding the key connecting workers must have. Required with --coordinator.')
+    parser.add_argument('--lease_seconds', default=3600, type=float,
+                        help='How long a coordinated worker may take to sample a batch.')
+    args = parser.parse_args(args)
+    if args.paired_out_csv is not None and pathlib.Path(args.paired_out_csv).resolve() == pathlib.Path(args.out_csv).resolve():
+        parser.error('--paired_out_csv must differ from --out_csv')
+    coordinator = None
+    if args.coordinator is not None:
+        if args.authkey_file is None:
+            parser.error('--coordinator requires --authkey_file')
+        coordinator = CoordinatorOptions(
+            address=parse_address(args.coordinator),
+            authkey=pathlib.Path(args.authkey_file).read_bytes().strip(),
+            lease_seconds=args.lease_seconds,
+        )
+    decoder = args.decoder
+    if args.decoding_window is not None:
+        commit, buffer = args.decoding_window
+        decoder = windowed_decoder_name(decoder, commit=commit, buffer=buffer)
+    try:
+        options = SamplerOptions(
+            decoder=decoder,
+            paired_decoders=tuple(args.paired_decoders),
+            dem_cache_dir=args.dem_cache_dir,
+            share_graphs=args.share_graphs,
+            decode_cache_size=args.decode_cache_size,
+            batch_memory_bytes=int(args.batch_memory_mb * 2**20),
+        )
+    except (ValueError, NotImplementedError) as ex:
+        parser.error(f'Unsupported decoders or options: {ex}')
+
+    grid = task_descriptions(
+        circuits=args.circuits,
+        bases=args.basis,
+        diams=args.diam,
+        round_factors=args.round_factors,
+        noises=args.noise,
+    )
+    # The grid, circuit files and archived circuits are collected together, so coordinated workers
+    # are only told the collection is done once every task is.
+    sources = grid + list(args.circuit_files)
+    try:
+        selection = parse_selection(args.select)
+    except ValueError as ex:
+        parser.error(str(ex))
+    for path in args.archive:
+        with CircuitArchive(path) as archive:
+            sources += archive.sources(**selection)
+    out_csv = pathlib.Path(args.out_csv)
+    existing, writer = open_stats_output(out_csv)
+    disagreement_writer = None
+    if args.disagreements_csv is not None:
+        disagreement_writer = open_disagreements_output(pathlib.Path(args.disagreements_csv))
+    on_disagreements = None if disagreement_writer is None else disagreement_writer.write_disagreements
+    paired_writer = None
+    if args.paired_out_csv is not None:
+        _, paired_writer = open_stats_output(pathlib.Path(args.paired_out_csv))
+
+    allocator = None
+    if args.adaptive_footprint_ratio is not None:
+        known_metadata = {}
+        for stat in existing:
+            known_metadata[tuple(sorted((k, v) for k, v in stat.json_metadata.items() if k != 'q'))] = stat.json_metadata
+        metadata = {}
+        for i, source in enumerate(sources):
+            m = source_metadata(source)
+            if 'q' not in m:
+                # Generated tasks only learn their qubit count from their stats.
+                m = known_metadata.get(tuple(sorted(m.items())))
+            if m is not None:
+                metadata[i] = m
+        allocator = FootprintAllocator(
+            chunking=args.adaptive_chunking,
+            target_ratio=args.adaptive_footprint_ratio,
+            refit_seconds=args.adaptive_refit_seconds,
+            metadata=metadata,
+        )
+
+    start_time = time.monotonic()
+    last_print = start_time
+
+    pruner = CollectionPruner(metadata_func=source_metadata, verbose=True) if args.prune else None
+
+    def policy(progress: CollectionProgress) -> None:
+        nonlocal last_print
+        if pruner is not None:
+            pruner.policy(progress)
+        if allocator is not None:
+            allocator.policy(progress)
+        if time.monotonic() - last_print > 10:
+            last_print = time.monotonic()
+            print_status(progress.tasks, start_time)
+
+    try:
+        tasks = collect_task_stats(
+            descriptions=sources,
+            task_factory=task_from_source,
+            metadata_func=source_metadata,
+            existing_stats=_existing_stats_for_descriptions(existing, grid),
+            num_workers=args.processes,
+            max_shots=args.max_shots,
+            max_errors=args.max_errors,
+            max_batch_size=args.max_batch_size,
+            options=options,
+            on_stats=writer.write,
+            on_paired_stats=None if paired_writer is None else paired_writer.write,
+            on_disagreements=on_disagreements,
+            policy=policy,
+            prioritize=None if allocator is None else allocator.prioritize,
+            coordinator=coordinator,
+        )
+        if allocator is not None:
+            allocator.refit(tasks)
+    finally:
+        writer.close()
+        if paired_writer is not None:
+            paired_writer.close()
+        if disagreement_writer is not None:
+            disagreement_writer.close()
+    print_status(tasks, start_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import multiprocessing
+import pathlib
+import sys
+from typing import List, Optional
+
+from parsurf.tools import parse_address, run_collection_worker
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description='Samples batches leased by a collect_stats.py run started with --coordinator, until its '
+                    'collection is done. Run on each machine that should help.')
+    parser.add_argument('--connect', required=True, type=str, metavar='ADDRESS',
+                        help="The coordinator's HOST:PORT (or Unix socket path).")
+    parser.add_argument('--authkey_file', required=True, type=str,
+                        help="File holding the coordinator's key.")
+    parser.add_argument('--processes', required=True, type=int,
+                        help='Number of worker processes, each sampling one batch at a time.')
+    parser.add_argument('--connect_timeout', default=60, type=float,
+                        help='How long to keep retrying to connect (e.g. while the coordinator starts).')
+    args = parser.parse_args(args)
+    address = parse_address(args.connect)
+    authkey = pathlib.Path(args.authkey_file).read_bytes().strip()
+    work = functools.partial(run_collection_worker, authkey=authkey, connect_timeout=args.connect_timeout)
+
+    with multiprocessing.Pool(args.processes) as pool:
+        counts = pool.map(work, [address] * args.processes)
+    print(f'sampled {sum(counts)} batches', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import pathlib
+import sys
+from typing import Any, Callable, List, Optional, Tuple
+
+import sinter
+
+from parsurf.circuits.task_factory import IDEAL_CIRCUIT_BUILDERS, task_descriptions, task_from_description
+from parsurf.scripts.collect_stats import open_stats_output
+from parsurf.tools import circuit_file_metadata, DemCache, ErrorWeightSampler, metadata_key, rare_event_decoder_name, \
+    task_from_circuit_file
+
+
+def _without_q(metadata: Any) -> Any:
+    """Drops the 'q' (qubit count) entry, which generated task descriptions don't have until the circuit is built."""
+    return {k: v for k, v in metadata.items() if k != 'q'}
+
+
+def estimate_task(description: Any,
+                  task_factory: Callable[[Any], sinter.Task],
+                  *,
+                  decoder: str,
+                  max_shots: int,
+                  pilot_shots: int,
+                  dem_cache_dir: Optional[str] = None) -> Tuple[sinter.TaskStats, str]:
+    """Estimates a task's logical error rate with an `ErrorWeightSampler`.
+
+    Returns:
+        The estimate as effective stats, and a summary of its confidence interval.
+    """
+    sampler = ErrorWeightSampler(
+        task_factory(description),
+        decoder=decoder,
+        dem_cache=None if dem_cache_dir is None else DemCache(pathlib.Path(dem_cache_dir)))
+    estimate = sampler.estimate(max_shots=max_shots, pilot_shots=pilot_shots)
+    fit = estimate.fit()
+    summary = (f'error rate {fit.best:.3g} in [{fit.low:.3g}, {fit.high:.3g}] from {estimate.shots} shots over '
+               f'weights <= {max(s.weight for s in estimate.strata) if estimate.strata else 0} '
+               f'(truncated probability {estimate.truncated_probability:.2g})')
+    return sampler.task_stats(estimate), summary
+
+
+def _estimate_task_star(args: Tuple[Any, ...]) -> Tuple[sinter.TaskStats, str]:
+    description, task_factory, kwargs = args
+    return estimate_task(description, task_factory, **kwargs)
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description='Estimates logical error rates at low noise by sampling shots stratified by their number of '
+                    'errors, instead of sampling until enough errors are seen. Each estimate is written to the same '
+                    'CSV format as `sinter collect`, as effective shot and error counts whose binomial fit matches '
+                    'the estimate and its confidence interval, under the decoder name "<decoder>:rare_event". Tasks '
+                    'that already have an estimate in the CSV file are skipped.')
+    parser.add_argument('--out_csv', required=True, type=str,
+                        help='Stats CSV file to append to, or stats database file (.db, .sqlite or .sqlite3).')
+    parser.add_argument('--circuits', nargs='+', default=['chao', 'pentagonal_sharp'], choices=sorted(IDEAL_CIRCUIT_BUILDERS),
+                        help='Circuit families to estimate (the "c" metadata values).')
+    parser.add_argument('--basis', nargs='+', default=(), type=str)
+    parser.add_argument('--noise', nargs='+', default=(), type=float)
+    parser.add_argument('--round_factors', nargs='+', default=(), type=int)
+    parser.add_argument('--diam', nargs='+', default=(), type=int)
+    parser.add_argument('--circuit_files', nargs='+', default=(), type=str,
+                        help='Also estimate these (possibly compressed) circuit files, with metadata from their names.')
+    parser.add_argument('--processes', required=True, type=int,
+                        help='Number of worker processes, each estimating one task at a time. 0 estimates in the '
+                             'main process.')
+    parser.add_argument('--decoder', default='pymatching', choices=['pymatching'])
+    parser.add_argument('--max_shots', default=1_000_000, type=int,
+                        help='Shots sampled per task (besides the one shot per error mechanism that enumerates the '
+                             'single-error shots).')
+    parser.add_argument('--pilot_shots', default=1000, type=int,
+                        help='Shots per error weight used to choose the sampled weights and the allocation of the '
+                             'other shots.')
+    parser.add_argument('--dem_cache_dir', default=None, type=str,
+                        help='Load detector error models and decoder graphs from this directory (storing them on a '
+                             'miss).')
+    args = parser.parse_args(args)
+
+    out_csv = pathlib.Path(args.out_csv)
+    existing, writer = open_stats_output(out_csv)
+    decoder = rare_event_decoder_name(args.decoder)
+    done = {
+        metadata_key(stat.decoder, _without_q(stat.json_metadata))
+        for stat in existing
+    }
+
+    work = []
+    for description in task_descriptions(
+            circuits=args.circuits,
+            bases=args.basis,
+            diams=args.diam,
+            round_factors=args.round_factors,
+            noises=args.noise):
+        if metadata_key(decoder, description) not in done:
+            work.append((description, task_from_description))
+    for path in args.circuit_files:
+        if metadata_key(decoder, _without_q(circuit_file_metadata(path))) not in done:
+            work.append((path, task_from_circuit_file))
+    kwargs = dict(
+        decoder=args.decoder,
+        max_shots=args.max_shots,
+        pilot_shots=args.pilot_shots,
+        dem_cache_dir=args.dem_cache_dir,
+    )
+    items = [(description, task_factory, kwargs) for description, task_factory in work]
+
+    if args.processes > 0:
+        pool = multiprocessing.Pool(args.processes)
+        results_iter = pool.imap_unordered(_estimate_task_star, items)
+    else:
+        pool = None
+        results_iter = (_estimate_task_star(item) for item in items)
+    try:
+        for stats, summary in results_iter:
+            writer.write(stats)
+            print(f'{stats.json_metadata}: {summary}', file=sys.stderr)
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.terminate()
+    print(f'estimated {len(items)} tasks ({len(existing)} pre-existing records)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
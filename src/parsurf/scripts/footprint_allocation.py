@@ -0,0 +1,139 @@
+import math
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import sinter
+
+from parsurf.scripts.plot_footprint import fit_teraquop_intercept
+from parsurf.tools import CollectionProgress, CollectionTask
+
+# `categorize_for_fitting` caps the errors of each point entering the semi-systemic bayesian fit at
+# this many (scaling the shots down to match), so more errors than this don't change the fit.
+FIT_ERROR_CAP = 10
+
+# Points with this error rate or more are dropped by `categorize_for_fitting` as above threshold.
+ABOVE_THRESHOLD_ERROR_RATE = 0.4
+
+
+def chunking_s2p(chunking: str) -> Callable[[float, sinter.TaskStats], float]:
+    """The shot-to-piece error rate conversion used by the plotting scripts for the given chunking."""
+    if chunking == 'round':
+        pieces_func = lambda stat: stat.json_metadata['r']
+    elif chunking == 'shot':
+        pieces_func = lambda stat: 1
+    elif chunking == 'd':
+        pieces_func = lambda stat: math.ceil(stat.json_metadata['r'] / stat.json_metadata['d'])
+    else:
+        raise NotImplementedError(f'{chunking=}')
+    return lambda p, stat: sinter.shot_error_rate_to_piece_error_rate(shot_error_rate=p, pieces=pieces_func(stat))
+
+
+def fit_group_key(metadata: Dict[str, Any]) -> Tuple[Any, ...]:
+    """The tasks fitted together by `plot_footprint.py` (which is run separately per basis)."""
+    return metadata['c'], metadata['b'], metadata['p']
+
+
+class FootprintAllocator:
+    """Directs shots to the tasks that matter for the teraquop footprint fits, stopping when they're tight enough.
+
+    Used as the `policy` and `prioritize` hooks of `collect_task_stats`. Every `refit_seconds`, the
+    current stats of each fit group (circuit family, basis and noise strength) are refit with
+    `fit_teraquop_intercept` (using the semi-systemic bayesian fit, which is the one with a
+    meaningful confidence interval). Once a group's interval satisfies `high <= target_ratio * low`,
+    its tasks are stopped.
+
+    Between refits, tasks are prioritized by how much they can tighten their group's fit per
+    CPU-second. The fit only uses points below threshold, and `categorize_for_fitting` caps each
+    point at `FIT_ERROR_CAP` errors, so a point's value is in its first few errors: the next error
+    of a task with e errors is worth about 1/(e+1)^2, and arrives after (seconds per shot) /
+    (error rate) seconds. Points that already reached the cap or are above threshold have no
+    value for the fit, beyond a small pilot sample, so they aren't sampled further. Collection ends
+    when every group converged or has no valuable points left.
+    """
+
+    def __init__(self,
+                 *,
+                 chunking: str,
+                 target_ratio: float,
+                 refit_seconds: float = 30,
+                 pilot_shots: int = 1000,
+                 metadata: Optional[Dict[int, Dict[str, Any]]] = None,
+                 verbose: bool = True):
+        self.s2p = chunking_s2p(chunking)
+        self.target_ratio = target_ratio
+        self.refit_seconds = refit_seconds
+        self.pilot_shots = pilot_shots
+        # The full metadata (including the qubit count 'q') of each task, learned from its stats.
+        self.metadata: Dict[int, Dict[str, Any]] = dict(metadata or {})
+        self.fits: Dict[Tuple[Any, ...], Optional[sinter.Fit]] = {}
+        self.verbose = verbose
+        self._last_refit = None
+
+    def _stats(self, tasks: List[CollectionTask], index: int) -> sinter.TaskStats:
+        s = tasks[index].stats
+        return sinter.TaskStats(
+            strong_id=str(index),
+            decoder='',
+            json_metadata=self.metadata[index],
+            shots=s.shots,
+            errors=s.errors,
+            discards=s.discards,
+            seconds=s.seconds,
+        )
+
+    def refit(self, tasks: List[CollectionTask]) -> None:
+        groups: Dict[Tuple[Any, ...], List[int]] = {}
+        for i in self.metadata:
+            groups.setdefault(fit_group_key(self.metadata[i]), []).append(i)
+
+        for key, indices in groups.items():
+            stats = [self._stats(tasks, i) for i in indices if tasks[i].stats.shots > 0]
+            try:
+                fit = fit_teraquop_intercept(stats, self.s2p, semi_systemic_bayesian=True) if stats else None
+            except NotImplementedError:
+                # The fit's interval couldn't be located yet.
+                fit = None
+            self.fits[key] = fit
+            if fit is not None and fit.high <= self.target_ratio * fit.low:
+                for i in indices:
+                    if tasks[i].stopped is None:
+                        tasks[i].stopped = f'footprint fit converged to {fit}'
+        if self.verbose:
+            for key, fit in sorted(self.fits.items(), key=str):
+                print(f'    footprint fit {key}: {fit}', file=sys.stderr)
+
+    def policy(self, progress: CollectionProgress) -> None:
+        self.metadata[progress.new_index] = progress.new_stats.json_metadata
+        now = time.monotonic()
+        if self._last_refit is None:
+            self._last_refit = now
+        elif now - self._last_refit >= self.refit_seconds:
+            self._last_refit = now
+            self.refit(progress.tasks)
+
+    def _group_weight(self, index: int) -> float:
+        if index not in self.metadata:
+            return 1
+        fit = self.fits.get(fit_group_key(self.metadata[index]))
+        if fit is None or fit.low <= 0:
+            # No fit yet: the group needs data the most.
+            return 100
+        return math.log(max(fit.high, fit.low + 1) / fit.low)
+
+    def value_per_second(self, task: CollectionTask, index: int) -> float:
+        """How much more sampling the task is estimated to tighten its fit group's interval, per CPU-second."""
+        s = task.stats
+        if s.shots < self.pilot_shots:
+            return math.inf
+        if s.errors >= ABOVE_THRESHOLD_ERROR_RATE * s.shots or s.errors >= FIT_ERROR_CAP:
+            return 0
+        seconds_per_shot = max(s.seconds, 1e-6) / s.shots
+        # Laplace estimate of the error rate, so zero-error tasks still have a finite wait.
+        error_rate = (s.errors + 1) / (s.shots + 2)
+        return self._group_weight(index) * error_rate / seconds_per_shot / (s.errors + 1)**2
+
+    def prioritize(self, tasks: List[CollectionTask]) -> List[int]:
+        values = {i: self.value_per_second(task, i) for i, task in enumerate(tasks) if not task.done}
+        # Tasks whose points no longer affect the fits aren't sampled further.
+        return sorted((i for i in values if values[i] > 0), key=lambda i: -values[i])
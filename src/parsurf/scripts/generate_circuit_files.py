@@ -1,12 +1,343 @@
 #!/usr/bin/env python3
 
 import argparse
+import dataclasses
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
 import pathlib
 import sys
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Tuple
+
+import stim
 
 from parsurf.circuits.chao import chao_memory_experiment_task
 from parsurf.circuits.pentagonal import pentagonal_surface_code_memory_task
-from parsurf.circuits.ref_honeycomb import generate_honeycomb_task
+from parsurf.circuits.ref_honeycomb import generate_honeycomb_task, hcb_version, HONEYCOMB_CACHE_DIR_ENV_VAR
+from parsurf.tools import available_compressions, certify_circuit_distances, CircuitArchiveWriter, \
+    compress_repeat_blocks, COMPRESSION_SUFFIXES, encode_text, fold_classical_feedback
+
+METHODS = {
+    'chao': chao_memory_experiment_task,
+    'pentagonal': pentagonal_surface_code_memory_task,
+    'honeycomb': generate_honeycomb_task,
+}
+
+
+def expected_graphlike_distance(metadata: Dict[str, Any]) -> Optional[int]:
+    """Returns the graphlike distance a generated circuit should have, or None if unknown."""
+    c = metadata['c']
+    d = metadata['d']
+    if c == 'chao':
+        return d
+    if c in ['pentagonal_sharp', 'pentagonal_smooth']:
+        return d - d // 2
+    return None
+
+
+@dataclasses.dataclass(frozen=True)
+class GenerationJob:
+    """One circuit family, basis, size and duration, to be generated at several noise strengths.
+
+    Noise strengths are grouped into one job because everything except the noise is shared between
+    them: distance certificates are noise-invariant.
+    """
+    method: str
+    basis: str
+    diam: int
+    rounds: int
+    noises: Tuple[float, ...]
+
+    def cost(self) -> float:
+        """A rough estimate of how long the job takes, used to start the biggest jobs first."""
+        return self.diam**2 * self.rounds * len(self.noises)
+
+
+@dataclasses.dataclass(frozen=True)
+class GenerationOptions:
+    out_dir: pathlib.Path
+    fold_classical_feedback: bool = False
+    compress_repeats: bool = False
+    certify: bool = False
+    certificate_dir: Optional[pathlib.Path] = None
+    hypergraph_budget: Optional[int] = None
+    compression: str = 'none'
+    archive: bool = False
+
+    def content_params(self) -> Dict[str, Any]:
+        """The options that affect the contents of the written files."""
+        return {
+            'fold_classical_feedback': self.fold_classical_feedback,
+            'compress_repeats': self.compress_repeats,
+            'compression': self.compression,
+        }
+
+    def certification(self) -> Optional[Dict[str, Any]]:
+        """The checks that written files have passed, as recorded in the manifest (None if not certified)."""
+        if not self.certify:
+            return None
+        return {'hypergraph_budget': self.hypergraph_budget}
+
+
+@dataclasses.dataclass(frozen=True)
+class GenerationResult:
+    """What happened to one output file.
+
+    Attributes:
+        path: The circuit file (written or not).
+        status: 'wrote', 'rejected' or 'failed'.
+        message: Details for rejected or failed files.
+        params: The generator parameters of the file, as used by the manifest.
+        hashes: For written files, the sha256 of each written file's contents, keyed by file name.
+        contents: When generating into an archive, the contents of each file (keyed by file name)
+            instead of writing them to the output directory.
+    """
+    path: pathlib.Path
+    status: str
+    message: str = ''
+    params: Optional[Dict[str, Any]] = None
+    hashes: Optional[Dict[str, str]] = None
+    contents: Optional[Dict[str, bytes]] = None
+
+
+def task_file_name(metadata: Dict[str, Any]) -> str:
+    return ','.join(f'{k}={metadata[k]}' for k in sorted(metadata.keys()))
+
+
+def generation_params(job: GenerationJob, noise: float, options: GenerationOptions) -> Dict[str, Any]:
+    return {
+        'method': job.method,
+        'basis': job.basis,
+        'diam': job.diam,
+        'rounds': job.rounds,
+        'noise': noise,
+        **options.content_params(),
+    }
+
+
+def certification_covers(done: Optional[Dict[str, Any]], wanted: Optional[Dict[str, Any]]) -> bool:
+    """Determines if files certified with `done` (see `GenerationOptions.certification`) also satisfy `wanted`.
+
+    A larger hypergraph budget searches a superset of the smaller budget's detection event sets, so
+    it covers it.
+    """
+    if wanted is None:
+        return True
+    if done is None:
+        return False
+    wanted_budget = wanted['hypergraph_budget']
+    done_budget = done['hypergraph_budget']
+    return wanted_budget is None or (done_budget is not None and done_budget >= wanted_budget)
+
+
+# The modules whose code determines the contents of generated circuits (relative to the package root).
+GENERATION_MODULES = [
+    'circuits/chao.py',
+    'circuits/pentagonal.py',
+    'circuits/ref_honeycomb.py',
+    'tools/_builder.py',
+    'tools/_circuit_io.py',
+    'tools/_feedback.py',
+    'tools/_noise.py',
+    'tools/_repeat.py',
+    'tools/_schedule.py',
+    'tools/_surface_code.py',
+    'tools/_util.py',
+]
+
+
+def default_honeycomb_cache_dir(out_dir: pathlib.Path) -> pathlib.Path:
+    """Where the noiseless honeycomb circuits are cached by default: next to (not inside) the output directory.
+
+    Kept out of the output directory, so that the cached circuits aren't mistaken for generated ones.
+    """
+    return out_dir.resolve().parent / 'honeycomb_cache'
+
+
+def code_version_fingerprint() -> str:
+    """Hashes the code that determines the contents of generated circuits.
+
+    Covers the `GENERATION_MODULES`, as well as the stim and (external) hcb versions. Changes to
+    other modules (e.g. the collection or plotting code) don't invalidate generated circuits.
+    """
+    root = pathlib.Path(__file__).parent.parent
+    h = hashlib.sha256()
+    h.update(stim.__version__.encode())
+    h.update(hcb_version().encode())
+    for name in GENERATION_MODULES:
+        h.update(name.encode())
+        h.update((root / name).read_bytes())
+    return h.hexdigest()
+
+
+def _sha256_of_file(path: pathlib.Path) -> Optional[str]:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def _write_atomically(path: pathlib.Path, content: str, compression: str = 'none') -> str:
+    """Writes a file via a temporary file, so that an interrupted write never looks finished. Returns its sha256."""
+    data = encode_text(content, compression)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return hashlib.sha256(data).hexdigest()
+
+
+# Temporary files untouched for this long are leftovers from interrupted writes, not in-progress writes.
+STALE_TMP_SECONDS = 3600
+
+
+def remove_stale_tmp_files(out_dir: pathlib.Path, *, now: Optional[float] = None) -> List[pathlib.Path]:
+    """Removes the temporary files left behind by interrupted writes into a directory.
+
+    Temporary files are named per process, and only ones that haven't been modified for
+    `STALE_TMP_SECONDS` are removed, so that runs writing into the same directory concurrently
+    don't delete each other's in-progress writes.
+    """
+    if now is None:
+        now = time.time()
+    removed = []
+    for tmp in out_dir.glob('*.tmp'):
+        try:
+            if now - tmp.stat().st_mtime < STALE_TMP_SECONDS:
+                continue
+            tmp.unlink()
+        except FileNotFoundError:
+            continue
+        print(f'removing half-written file {tmp}', file=sys.stderr)
+        removed.append(tmp)
+    return removed
+
+
+class GenerationManifest:
+    """Records which generator parameters produced which files, so unchanged outputs aren't regenerated.
+
+    Each entry is keyed by the generator parameters and stores the code version fingerprint, the
+    certification the files passed, and the sha256 of each output file. An entry is valid only if the
+    fingerprint matches the current code, the certification covers the requested one, and every file
+    still has the recorded hash (which catches deleted, edited and half-written files).
+
+    Several runs can write into the same directory at once: saving merges the entries recorded since
+    the last save into the manifest file while holding a lock on it.
+    """
+
+    def __init__(self, path: pathlib.Path, code_version: str):
+        self.path = path
+        self.code_version = code_version
+        self.entries: Dict[str, Dict[str, Any]] = self._read()
+        self._unsaved: Dict[str, Dict[str, Any]] = {}
+
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def key(params: Dict[str, Any]) -> str:
+        return json.dumps(params, sort_keys=True)
+
+    def is_valid(self, params: Dict[str, Any], certification: Optional[Dict[str, Any]] = None) -> bool:
+        """Determines if the files generated with the given parameters are up to date.
+
+        Args:
+            params: The generator parameters of the files.
+            certification: The certification the files must have passed (see
+                `GenerationOptions.certification`), or None if they don't need to be certified.
+        """
+        entry = self.entries.get(self.key(params))
+        if entry is None or entry['code_version'] != self.code_version:
+            return False
+        if not certification_covers(entry.get('certification'), certification):
+            return False
+        directory = self.path.parent
+        return all(_sha256_of_file(directory / name) == h for name, h in entry['files'].items())
+
+    def record(self, params: Dict[str, Any], hashes: Dict[str, str], certification: Optional[Dict[str, Any]] = None) -> None:
+        key = self.key(params)
+        self.entries[key] = self._unsaved[key] = {
+            'params': params,
+            'code_version': self.code_version,
+            'certification': certification,
+            'files': hashes,
+        }
+
+    def save(self) -> None:
+        """Merges the entries recorded since the last save into the manifest file.
+
+        The file is re-read under an exclusive lock before writing, so that entries saved by other runs
+        in the meantime are kept.
+        """
+        with open(self.path.with_name(f'{self.path.name}.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = self._read()
+                entries.update(self._unsaved)
+                _write_atomically(self.path, json.dumps(entries, indent=1, sort_keys=True))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.entries = entries
+        self._unsaved = {}
+
+
+def run_generation_job(job: GenerationJob, options: GenerationOptions) -> List[GenerationResult]:
+    """Generates, checks and writes the circuit files for a job. Failures are reported per file, not raised."""
+    method = METHODS[job.method]
+    results = []
+    certificate = None
+    suffix = COMPRESSION_SUFFIXES[options.compression]
+    for noise in job.noises:
+        # Placeholder name, in case the task can't even be created.
+        path = options.out_dir / f'{job.method},b={job.basis},d={job.diam},p={noise},r={job.rounds}.stim{suffix}'
+        params = generation_params(job, noise, options)
+        try:
+            task = method(basis=job.basis, rounds=job.rounds, diam=job.diam, noise=noise)
+            m = task.json_metadata
+            path = options.out_dir / f'{task_file_name(m)}.stim{suffix}'
+            circuit = task.circuit
+            if options.fold_classical_feedback:
+                circuit = fold_classical_feedback(circuit)
+            if options.compress_repeats:
+                circuit = compress_repeat_blocks(circuit)
+
+            if options.certify:
+                if certificate is None:
+                    certificate, = certify_circuit_distances(
+                        [circuit],
+                        hypergraph_budget=options.hypergraph_budget,
+                        cache_dir=options.certificate_dir)
+                expected = expected_graphlike_distance(m)
+                bad = expected is not None and certificate.graphlike_distance != expected
+                bad |= certificate.hypergraph_distance is not None and certificate.hypergraph_distance < certificate.graphlike_distance
+                if bad:
+                    results.append(GenerationResult(path, 'rejected', f'expected graphlike distance {expected} but got {certificate}'))
+                    continue
+
+            text = f'{circuit}\n'
+            if options.archive:
+                data = encode_text(text, options.compression)
+                contents = {path.name: data}
+                hashes = {path.name: hashlib.sha256(data).hexdigest()}
+            else:
+                contents = None
+                hashes = {path.name: _write_atomically(path, text, options.compression)}
+            results.append(GenerationResult(path, 'wrote', params=params, hashes=hashes, contents=contents))
+        except Exception:
+            results.append(GenerationResult(path, 'failed', traceback.format_exc()))
+    return results
+
+
+def _run_generation_job_star(args: Tuple[GenerationJob, GenerationOptions]) -> List[GenerationResult]:
+    return run_generation_job(*args)
 
 
 def main():
@@ -18,34 +349,131 @@ def main():
     parser.add_argument("--diam", nargs='+', required=True, type=int)
     parser.add_argument('--use_classical_feedback', action='store_true')
     parser.add_argument('--honeycomb', required=True, type=int)
+    parser.add_argument('--fold_classical_feedback', action='store_true',
+                        help='Remove classically controlled Paulis by folding them into the detectors and observables.')
+    parser.add_argument('--compress_repeats', action='store_true',
+                        help='Rewrite periodic parts of the circuit into REPEAT blocks (e.g. after folding unrolled them).')
+    parser.add_argument('--certify', action='store_true',
+                        help='Verify the distance of each circuit before writing it, refusing to write bad circuits.')
+    parser.add_argument('--certificate_dir', default=None, type=str,
+                        help='Directory caching distance certificates across runs.')
+    parser.add_argument('--hypergraph_budget', default=None, type=int,
+                        help='If set, certification also runs a hypergraph search limited to detection event sets of this size.')
+    parser.add_argument('--processes', default=1, type=int,
+                        help='Number of worker processes generating (and writing) circuits in parallel.')
+    parser.add_argument('--compression', default='none', choices=sorted(COMPRESSION_SUFFIXES.keys()),
+                        help='Compress the written files (appending .gz or .zst to their names). zstd requires the '
+                             'zstandard package. Compressed circuits are read with parsurf.tools.read_circuit_file '
+                             'or iter_circuit_file_tasks, since the sinter command line tool only reads plain .stim files.')
+    parser.add_argument('--archive', default=None, type=str,
+                        help='Pack all generated files into one archive with this name (inside out_dir) instead of '
+                             'writing individual files. Read it with parsurf.tools.CircuitArchive. Archives are '
+                             'always regenerated in full.')
+    parser.add_argument('--honeycomb_cache_dir', default=None, type=str,
+                        help='Directory caching the noiseless honeycomb circuits across runs, so the external '
+                             'hcb package is only used when a (basis, diam) pair is new. Defaults to the '
+                             f'{HONEYCOMB_CACHE_DIR_ENV_VAR} environment variable, or else to a honeycomb_cache '
+                             'directory next to out_dir.')
+    parser.add_argument('--force', action='store_true',
+                        help='Regenerate every file, even if the manifest says it is up to date.')
     args = parser.parse_args()
 
-    methods = [
-        chao_memory_experiment_task,
-        pentagonal_surface_code_memory_task,
-    ]
+    methods = ['chao', 'pentagonal']
     if args.honeycomb != 0:
-        methods.append(generate_honeycomb_task)
+        methods.append('honeycomb')
+
+    if args.compression not in available_compressions():
+        parser.error(f'--compression {args.compression} is not available (is the zstandard package installed?)')
 
     out_dir = pathlib.Path(args.out_dir)
+    honeycomb_cache_dir = args.honeycomb_cache_dir
+    if honeycomb_cache_dir is None:
+        honeycomb_cache_dir = os.environ.get(HONEYCOMB_CACHE_DIR_ENV_VAR) or str(default_honeycomb_cache_dir(out_dir))
+    # Set through the environment so that worker processes also see it.
+    os.environ[HONEYCOMB_CACHE_DIR_ENV_VAR] = honeycomb_cache_dir
+
     out_dir.mkdir(exist_ok=True, parents=True)
-    for basis in args.basis:
-        for noise in args.noise:
-            for diam in args.diam:
-                for round_factor in args.round_factors:
-                    for method in methods:
-                        rounds = round_factor * diam
-                        task = method(
-                            basis=basis,
-                            rounds=rounds,
-                            diam=diam,
-                            noise=noise)
-                        m = task.json_metadata
-                        name = ','.join(f'{k}={m[k]}' for k in sorted(m.keys()))
-                        path = out_dir / f'{name}.stim'
-                        with open(path, 'w') as f:
-                            print(task.circuit, file=f)
-                        print(f'wrote {path}', file=sys.stderr)
+    options = GenerationOptions(
+        out_dir=out_dir,
+        fold_classical_feedback=args.fold_classical_feedback,
+        compress_repeats=args.compress_repeats,
+        certify=args.certify,
+        certificate_dir=None if args.certificate_dir is None else pathlib.Path(args.certificate_dir),
+        hypergraph_budget=args.hypergraph_budget,
+        compression=args.compression,
+        archive=args.archive is not None,
+    )
+    jobs = [
+        GenerationJob(method=method, basis=basis, diam=diam, rounds=round_factor * diam, noises=tuple(args.noise))
+        for basis in args.basis
+        for diam in args.diam
+        for round_factor in args.round_factors
+        for method in methods
+    ]
+
+    remove_stale_tmp_files(out_dir)
+
+    manifest = GenerationManifest(out_dir / 'manifest.json', code_version_fingerprint())
+    if not args.force and not options.archive:
+        skipped = 0
+        remaining_jobs = []
+        for job in jobs:
+            noises = tuple(
+                p
+                for p in job.noises
+                if not manifest.is_valid(generation_params(job, p, options), certification=options.certification())
+            )
+            skipped += len(job.noises) - len(noises)
+            if noises:
+                remaining_jobs.append(dataclasses.replace(job, noises=noises))
+        jobs = remaining_jobs
+        if skipped:
+            print(f'skipping {skipped} files that are already up to date', file=sys.stderr)
+    jobs.sort(key=lambda job: job.cost(), reverse=True)
+
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        results_iter = pool.imap_unordered(_run_generation_job_star, [(job, options) for job in jobs])
+    else:
+        pool = None
+        results_iter = (run_generation_job(job, options) for job in jobs)
+    archive = None if args.archive is None else CircuitArchiveWriter(out_dir / args.archive)
+
+    counts = {'wrote': 0, 'rejected': 0, 'failed': 0}
+    try:
+        for results in results_iter:
+            for result in results:
+                counts[result.status] += 1
+                if result.status == 'wrote':
+                    if archive is not None:
+                        for name, data in result.contents.items():
+                            archive.add_bytes(name, data)
+                        print(f'packed {result.path.name}', file=sys.stderr)
+                    else:
+                        manifest.record(result.params, result.hashes, certification=options.certification())
+                        print(f'wrote {result.path}', file=sys.stderr)
+                else:
+                    print(f'{result.status.upper()} {result.path}: {result.message}', file=sys.stderr)
+            if archive is None:
+                manifest.save()
+    except BaseException:
+        if archive is not None:
+            archive.abort()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if archive is not None:
+        archive.close()
+        print(f'wrote {archive.path}', file=sys.stderr)
+
+    if counts['rejected']:
+        print(f'rejected {counts["rejected"]} circuits', file=sys.stderr)
+    if counts['failed']:
+        print(f'failed to generate {counts["failed"]} circuits', file=sys.stderr)
+    if counts['rejected'] or counts['failed']:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -12,16 +12,22 @@ from matplotlib import pyplot as plt
 from scipy.stats import linregress
 
 from parsurf.scripts.plot_extrapolation import categorize_for_fitting, TITLE_ORDER, TITLE_CHANGE
-from parsurf.tools import score_binomial_line
+from parsurf.tools import read_stats_files, score_binomial_line
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--csv", required=True, nargs='+', type=str)
+    parser.add_argument("--csv", required=True, nargs='+', type=str,
+                        help='Stats CSV files, or stats database files (.db, .sqlite or .sqlite3).')
     parser.add_argument("--chunking", required=True, choices=['shot', 'd', 'round'])
     parser.add_argument("--skip_d", default=(), nargs='+', type=int)
     parser.add_argument("--skip_p", default=(), nargs='+', type=float)
     parser.add_argument("--skip_b", default=(), nargs='+', type=str)
+    parser.add_argument('--decoders', default=['pymatching:rare_event', 'pymatching'], nargs='+', type=str,
+                        help='The decoders whose stats are plotted, in order of preference. Each task uses the stats of '
+                             'the first listed decoder that has any for it (by default, rare event estimates where '
+                             'there are some and sampled pymatching stats elsewhere). Stats of other decoders (e.g. '
+                             'paired decoders) are ignored.')
     parser.add_argument('--show', action='store_true')
     parser.add_argument('--semi_systemic_bayesian', action='store_true')
     parser.add_argument('--save', default=None, type=str)
@@ -32,11 +38,10 @@ def main():
     MARKERS: str = "ov*sp^<>8PhH+xXDd|" * 100
     COLORS: List[str] = list(matplotlib.colors.TABLEAU_COLORS) * 3
 
-    samples = sinter.stats_from_csv_files(*args.csv)
-    samples = [e for e in samples
-               if e.json_metadata['d'] not in args.skip_d
-               and e.json_metadata['p'] not in args.skip_p
-               and e.json_metadata['b'] not in args.skip_b]
+    samples = read_stats_files(
+        args.csv,
+        exclude={'d': args.skip_d, 'p': args.skip_p, 'b': args.skip_b},
+        decoders=args.decoders)
 
     if args.chunking == 'round':
         pieces_func = lambda stat: stat.json_metadata['r']
@@ -1,3 +1,7 @@
+import hashlib
+import os
+import pathlib
+
 import sinter
 
 from parsurf.tools import score_binomial_line
@@ -20,3 +24,300 @@ def test_piece_conversion_works_at_low_error_rates():
     )
     assert 0 < b[0] < 10**10
     assert 0 < b[1] < 10**10
+
+
+def test_run_generation_job(tmp_path):
+    from parsurf.scripts.generate_circuit_files import GenerationJob, GenerationOptions, run_generation_job
+
+    job = GenerationJob(method='chao', basis='X', diam=3, rounds=3, noises=(0.001, 0.002))
+    results = run_generation_job(job, GenerationOptions(out_dir=tmp_path, certify=True))
+    assert [r.status for r in results] == ['wrote', 'wrote']
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'b=X,c=chao,d=3,p=0.001,q=25,r=3.stim',
+        'b=X,c=chao,d=3,p=0.002,q=25,r=3.stim',
+    ]
+
+    # Errors are reported per file instead of being raised.
+    bad = GenerationJob(method='chao', basis='Y', diam=3, rounds=3, noises=(0.001,))
+    result, = run_generation_job(bad, GenerationOptions(out_dir=tmp_path))
+    assert result.status == 'failed'
+    assert 'Traceback' in result.message
+
+
+def test_generation_manifest(tmp_path):
+    from parsurf.scripts.generate_circuit_files import GenerationJob, GenerationOptions, GenerationManifest, \
+        generation_params, run_generation_job
+
+    options = GenerationOptions(out_dir=tmp_path)
+    job = GenerationJob(method='chao', basis='Z', diam=3, rounds=3, noises=(0.001,))
+    params = generation_params(job, 0.001, options)
+    manifest = GenerationManifest(tmp_path / 'manifest.json', code_version='v1')
+    assert not manifest.is_valid(params)
+
+    result, = run_generation_job(job, options)
+    manifest.record(result.params, result.hashes)
+    manifest.save()
+    assert not list(tmp_path.glob('*.tmp'))
+
+    reloaded = GenerationManifest(tmp_path / 'manifest.json', code_version='v1')
+    assert reloaded.is_valid(params)
+    assert not reloaded.is_valid(generation_params(job, 0.002, options))
+    assert not GenerationManifest(tmp_path / 'manifest.json', code_version='v2').is_valid(params)
+
+    # Truncated (e.g. half-written) outputs invalidate the entry.
+    content = result.path.read_text()
+    result.path.write_text(content[:len(content) // 2])
+    assert not reloaded.is_valid(params)
+
+
+def test_generation_manifest_certification(tmp_path):
+    from parsurf.scripts.generate_circuit_files import GenerationJob, GenerationOptions, GenerationManifest, \
+        generation_params, run_generation_job
+
+    job = GenerationJob(method='chao', basis='Z', diam=3, rounds=3, noises=(0.001,))
+    options = GenerationOptions(out_dir=tmp_path)
+    params = generation_params(job, 0.001, options)
+    certified = GenerationOptions(out_dir=tmp_path, certify=True).certification()
+    budget_2 = GenerationOptions(out_dir=tmp_path, certify=True, hypergraph_budget=2).certification()
+    budget_3 = GenerationOptions(out_dir=tmp_path, certify=True, hypergraph_budget=3).certification()
+    manifest = GenerationManifest(tmp_path / 'manifest.json', code_version='v1')
+
+    # Files written without certification are out of date for a run that certifies.
+    result, = run_generation_job(job, options)
+    manifest.record(result.params, result.hashes, certification=options.certification())
+    assert manifest.is_valid(params)
+    assert not manifest.is_valid(params, certification=certified)
+
+    manifest.record(result.params, result.hashes, certification=budget_2)
+    assert manifest.is_valid(params)
+    assert manifest.is_valid(params, certification=certified)
+    assert manifest.is_valid(params, certification=budget_2)
+    assert not manifest.is_valid(params, certification=budget_3)
+
+
+def test_generation_manifest_merges_concurrent_saves(tmp_path):
+    from parsurf.scripts.generate_circuit_files import GenerationManifest
+
+    path = tmp_path / 'manifest.json'
+    (tmp_path / 'a.stim').write_text('a')
+    (tmp_path / 'b.stim').write_text('b')
+    hash_a = hashlib.sha256(b'a').hexdigest()
+    hash_b = hashlib.sha256(b'b').hexdigest()
+
+    # Two runs that both started before either saved.
+    run1 = GenerationManifest(path, code_version='v1')
+    run2 = GenerationManifest(path, code_version='v1')
+    run1.record({'name': 'a'}, {'a.stim': hash_a})
+    run2.record({'name': 'b'}, {'b.stim': hash_b})
+    run1.save()
+    run2.save()
+
+    reloaded = GenerationManifest(path, code_version='v1')
+    assert reloaded.is_valid({'name': 'a'})
+    assert reloaded.is_valid({'name': 'b'})
+
+
+def test_code_version_fingerprint_covers_generation_modules():
+    from parsurf.scripts.generate_circuit_files import GENERATION_MODULES, code_version_fingerprint
+
+    root = pathlib.Path(__file__).parent.parent
+    assert all((root / name).is_file() for name in GENERATION_MODULES)
+    assert 'tools/_collection.py' not in GENERATION_MODULES
+    assert code_version_fingerprint() == code_version_fingerprint()
+
+
+def test_default_honeycomb_cache_dir(tmp_path):
+    from parsurf.scripts.generate_circuit_files import default_honeycomb_cache_dir
+
+    assert default_honeycomb_cache_dir(tmp_path / 'circuits') == tmp_path.resolve() / 'honeycomb_cache'
+
+
+def test_remove_stale_tmp_files(tmp_path):
+    from parsurf.scripts.generate_circuit_files import STALE_TMP_SECONDS, remove_stale_tmp_files
+
+    stale = tmp_path / 'a.stim.123.tmp'
+    fresh = tmp_path / 'b.stim.456.tmp'
+    kept = tmp_path / 'c.stim'
+    for path in [stale, fresh, kept]:
+        path.write_text('')
+    now = fresh.stat().st_mtime
+    os.utime(stale, (now - STALE_TMP_SECONDS - 1, now - STALE_TMP_SECONDS - 1))
+
+    assert remove_stale_tmp_files(tmp_path, now=now) == [stale]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['b.stim.456.tmp', 'c.stim']
+
+
+def test_run_generation_job_compressed(tmp_path):
+    from parsurf.scripts.generate_circuit_files import GenerationJob, GenerationOptions, run_generation_job
+    from parsurf.tools import iter_circuit_file_tasks
+
+    job = GenerationJob(method='chao', basis='X', diam=3, rounds=3, noises=(0.001,))
+    result, = run_generation_job(job, GenerationOptions(out_dir=tmp_path, compression='gzip'))
+    assert result.status == 'wrote'
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'b=X,c=chao,d=3,p=0.001,q=25,r=3.stim.gz',
+    ]
+    task, = iter_circuit_file_tasks([result.path])
+    assert task.json_metadata == {'b': 'X', 'c': 'chao', 'd': 3, 'p': 0.001, 'q': 25, 'r': 3}
+    assert task.circuit.num_detectors > 0
+
+
+def test_collect_stats_resumes(tmp_path):
+    from parsurf.scripts.collect_stats import main
+    from parsurf.tools import read_stats_csv
+
+    out = tmp_path / 'stats.csv'
+    args = ['--out_csv', str(out), '--circuits', 'chao', '--basis', 'X', '--noise', '0.001', '--round_factors', '2',
+            '--diam', '3', '--processes', '0', '--max_shots', '1000', '--max_errors', '100']
+    main(args)
+    stats = read_stats_csv(out)
+    assert sum(s.shots for s in stats) == 1000
+    assert {s.json_metadata['q'] for s in stats} == {25}
+    assert len({s.strong_id for s in stats}) == 1
+
+    # Nothing left to do, so nothing is added.
+    main(args)
+    assert read_stats_csv(out) == stats
+
+
+def test_collect_stats_resumes_from_database(tmp_path):
+    from parsurf.scripts.collect_stats import main
+    from parsurf.scripts.stats_db import main as stats_db_main
+    from parsurf.tools import read_stats_csv, StatsDatabase
+
+    out = tmp_path / 'stats.db'
+    args = ['--out_csv', str(out), '--circuits', 'chao', '--basis', 'X', '--noise', '0.001', '--round_factors', '2',
+            '--diam', '3', '--processes', '0', '--max_shots', '1000', '--max_errors', '100']
+    main(args)
+    with StatsDatabase(out) as db:
+        stats = db.read()
+    assert sum(s.shots for s in stats) == 1000
+
+    main(args)
+    with StatsDatabase(out) as db:
+        assert db.read() == stats
+
+    stats_db_main(['--db', str(out), '--export_csv', str(tmp_path / 'stats.csv'), '--combine'])
+    combined = read_stats_csv(tmp_path / 'stats.csv')
+    assert len(combined) == 1 and combined[0].shots == 1000
+
+
+def test_collect_stats_coordinates_workers(tmp_path):
+    import multiprocessing
+    from parsurf.circuits.task_factory import task_from_description
+    from parsurf.scripts.collect_stats import main
+    from parsurf.scripts.collect_worker import main as worker_main
+    from parsurf.tools import read_stats_csv
+
+    circuit_file = tmp_path / 'b=Z,c=chao,d=3,p=0.001,q=25,r=6.stim'
+    task_from_description({'c': 'chao', 'b': 'Z', 'd': 3, 'r': 6, 'p': 0.001}).circuit.to_file(circuit_file)
+    out = tmp_path / 'stats.csv'
+    (tmp_path / 'key').write_bytes(b'secret\n')
+    address = str(tmp_path / 'coordinator.sock')
+    worker = multiprocessing.Process(target=worker_main, args=(
+        ['--connect', address, '--authkey_file', str(tmp_path / 'key'), '--processes', '2'],))
+    worker.start()
+    # Only the remote worker samples, so the grid and the circuit file must be served in one collection.
+    main(['--out_csv', str(out), '--circuits', 'chao', '--basis', 'X', '--noise', '0.001', '--round_factors', '2',
+          '--diam', '3', '--circuit_files', str(circuit_file), '--processes', '0', '--max_shots', '1000',
+          '--max_errors', '100', '--coordinator', address, '--authkey_file', str(tmp_path / 'key')])
+    worker.join(timeout=60)
+    assert worker.exitcode == 0
+    shots = {}
+    for s in read_stats_csv(out):
+        shots[s.json_metadata['b']] = shots.get(s.json_metadata['b'], 0) + s.shots
+    assert shots == {'X': 1000, 'Z': 1000}
+
+
+def test_collect_stats_reads_archives(tmp_path):
+    from parsurf.circuits.task_factory import task_from_description
+    from parsurf.scripts.collect_stats import main
+    from parsurf.tools import CircuitArchiveWriter, read_stats_csv
+
+    archive = tmp_path / 'circuits.psarc'
+    with CircuitArchiveWriter(archive) as writer:
+        for p in [0.001, 0.002]:
+            task = task_from_description({'c': 'chao', 'b': 'X', 'd': 3, 'r': 3, 'p': p})
+            writer.add_text(f'b=X,c=chao,d=3,p={p},q=25,r=3.stim.gz', str(task.circuit))
+    out = tmp_path / 'stats.csv'
+    args = ['--out_csv', str(out), '--archive', str(archive), '--select', 'p=0.002', 'c=chao',
+            '--processes', '0', '--max_shots', '1000', '--max_errors', '100']
+    main(args)
+    stats = read_stats_csv(out)
+    assert {s.json_metadata['p'] for s in stats} == {0.002}
+    assert sum(s.shots for s in stats) == 1000
+
+    main(args)
+    assert read_stats_csv(out) == stats
+
+
+def test_collect_stats_with_paired_decoders(tmp_path):
+    from parsurf.scripts.collect_stats import main
+    from parsurf.tools import read_disagreements_csv, read_stats_csv, StatsDatabase
+
+    out = tmp_path / 'stats.csv'
+    paired = tmp_path / 'paired.csv'
+    disagreements = tmp_path / 'disagreements.csv'
+    main(['--out_csv', str(out), '--circuits', 'chao', '--basis', 'X', '--noise', '0.01', '--round_factors', '2',
+          '--diam', '3', '--processes', '0', '--max_shots', '1000', '--max_errors', '100',
+          '--paired_decoders', 'pymatching:window=1+1', '--paired_out_csv', str(paired),
+          '--disagreements_csv', str(disagreements)])
+    # The paired decoder's stats are kept out of the main stats file.
+    assert {s.decoder for s in read_stats_csv(out)} == {'pymatching'}
+    assert {s.decoder for s in read_stats_csv(paired)} == {'pymatching:window=1+1'}
+    shots = sum(s.shots for s in read_stats_csv(out))
+    assert sum(s.shots for s in read_stats_csv(paired)) == shots
+    records = read_disagreements_csv(disagreements)
+    assert {(d.decoder, d.other_decoder) for d in records} == {('pymatching', 'pymatching:window=1+1')}
+    assert sum(d.shots for d in records) == shots
+    assert records[0].json_metadata == read_stats_csv(out)[0].json_metadata
+
+    # A database keeps the disagreements in their own table.
+    db_path = tmp_path / 'stats.db'
+    main(['--out_csv', str(db_path), '--circuits', 'chao', '--basis', 'X', '--noise', '0.01', '--round_factors', '2',
+          '--diam', '3', '--processes', '0', '--max_shots', '1000', '--max_errors', '100',
+          '--paired_decoders', 'pymatching:window=1+1', '--disagreements_csv', str(db_path)])
+    with StatsDatabase(db_path) as db:
+        assert {s.decoder for s in db.read()} == {'pymatching'}
+        assert sum(d.shots for d in db.read_disagreements()) == sum(s.shots for s in db.read())
+
+
+def test_estimate_rare_events_skips_estimated_tasks(tmp_path):
+    from parsurf.scripts.estimate_rare_events import main
+    from parsurf.tools import read_stats_csv
+
+    out = tmp_path / 'stats.csv'
+    args = ['--out_csv', str(out), '--circuits', 'chao', '--basis', 'X', '--noise', '0.0001', '0.0002',
+            '--round_factors', '1', '--diam', '3', '--processes', '0', '--max_shots', '5000', '--pilot_shots', '200']
+    main(args)
+    stats = read_stats_csv(out)
+    assert sorted(s.json_metadata['p'] for s in stats) == [0.0001, 0.0002]
+    assert {s.decoder for s in stats} == {'pymatching:rare_event'}
+    assert all(0 < s.errors < s.shots for s in stats)
+
+    main(args)
+    assert read_stats_csv(out) == stats
+
+
+def test_footprint_allocator_prioritizes_fit_relevant_tasks():
+    from parsurf.scripts.footprint_allocation import FootprintAllocator
+    from parsurf.tools import CollectionTask
+
+    def task(shots, errors, seconds=1.0):
+        return CollectionTask(
+            description=None,
+            stats=sinter.AnonTaskStats(shots=shots, errors=errors, seconds=seconds),
+            max_shots=10**9,
+            max_errors=10**9)
+
+    allocator = FootprintAllocator(chunking='d', target_ratio=2, verbose=False)
+    tasks = [
+        task(shots=100_000, errors=3),  # Few errors; each new error matters.
+        task(shots=10, errors=0),  # Below the pilot sample.
+        task(shots=100_000, errors=50),  # Past the error cap used by the fit.
+        task(shots=10_000, errors=8_000),  # Above threshold.
+        task(shots=100_000, errors=3, seconds=100),  # Same as the first, but slower.
+    ]
+    assert allocator.prioritize(tasks) == [1, 0, 4]
+    tasks[0].stopped = 'done'
+    assert allocator.prioritize(tasks) == [1, 4]
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from typing import List, Optional
+
+from parsurf.tools import StatsDatabase
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description='Moves stats between CSV files (as written by `sinter collect`) and a stats database file, '
+                    'which collect_stats.py can append to and the plot scripts can read.')
+    parser.add_argument('--db', required=True, type=str,
+                        help='The stats database file (created if missing).')
+    parser.add_argument('--import_csv', nargs='+', default=(), type=str,
+                        help='Append the records of these CSV files to the database, one transaction per file.')
+    parser.add_argument('--compact', action='store_true',
+                        help='Replace the records of each task in the database by their sum (like `sinter combine`).')
+    parser.add_argument('--export_csv', default=None, type=str,
+                        help='Write the records of the database to this CSV file.')
+    parser.add_argument('--combine', action='store_true',
+                        help='Export the records summed per task (like `sinter combine`).')
+    args = parser.parse_args(args)
+
+    with StatsDatabase(args.db) as db:
+        for path in args.import_csv:
+            count = db.import_csv(path)
+            print(f'imported {count} records from {path}', file=sys.stderr)
+        if args.compact:
+            db.compact()
+            print(f'compacted to {len(db.read())} records', file=sys.stderr)
+        if args.export_csv is not None:
+            count = db.export_csv(args.export_csv, combine=args.combine)
+            print(f'exported {count} records to {args.export_csv}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,121 @@
+from parsurf.tools._archive import (
+    CircuitArchive,
+    CircuitArchiveEntry,
+    CircuitArchiveWriter,
+    task_from_archive_entry,
+)
+from parsurf.tools._bit_batch import (
+    count_packed_mistakes,
+    DEFAULT_BATCH_MEMORY_BYTES,
+    pack_bits,
+    PackedBatch,
+    popcount_rows,
+    sample_packed_batch,
+    shots_per_chunk,
+    split_packed_bits,
+    unpack_bits,
+)
 from parsurf.tools._builder import (
     Builder,
     AtLayer,
 )
+from parsurf.tools._circuit_io import (
+    available_compressions,
+    circuit_file_metadata,
+    COMPRESSION_SUFFIXES,
+    compression_of_path,
+    encode_text,
+    iter_circuit_file_tasks,
+    open_text_stream,
+    read_circuit_file,
+    strip_compression_suffix,
+    task_from_circuit_file,
+)
+from parsurf.tools._collection import (
+    collect_task_stats,
+    CollectionProgress,
+    CollectionTask,
+    CoordinatorOptions,
+    DecoderDisagreements,
+    DISAGREEMENTS_CSV_HEADER,
+    metadata_key,
+    MultiDecoderSampler,
+    read_disagreements_csv,
+    read_stats_csv,
+    run_collection_worker,
+    SamplerOptions,
+    TaskSampler,
+)
+from parsurf.tools._coordinator import (
+    LeaseServer,
+    parse_address,
+    work_on_leases,
+)
+from parsurf.tools._decode_cache import (
+    DecodeCounters,
+    SyndromeCachingDecoder,
+)
+from parsurf.tools._dem_cache import (
+    dem_cache_key,
+    DemCache,
+    looped_auto_dem,
+)
+from parsurf.tools._distance import (
+    certify_circuit_distance,
+    certify_circuit_distances,
+    circuit_fingerprint,
+    DistanceCertificate,
+    DistanceCertificateCache,
+)
+from parsurf.tools._feedback import (
+    fold_classical_feedback,
+)
 from parsurf.tools._noise import (
     NoiseModel,
 )
+from parsurf.tools._pruning import (
+    CollectionPruner,
+)
+from parsurf.tools._rare_event import (
+    ErrorWeightEstimate,
+    ErrorWeightSampler,
+    ErrorWeightStratum,
+    rare_event_decoder_name,
+)
+from parsurf.tools._repeat import (
+    compress_repeat_blocks,
+    flattened_circuit,
+    flattened_dem,
+)
+from parsurf.tools._schedule import (
+    append_schedule_moments,
+    compile_for_roles,
+    compile_schedule_by_basis,
+    CompiledDetectors,
+    CompiledObservable,
+    CompiledSchedule,
+    DetectorStencil,
+    DecompositionSchedule,
+    FeedbackOp,
+    GroupOp,
+    MeasureOp,
+    MeasureProductOp,
+    ResetOp,
+    Role,
+)
+from parsurf.tools._shared_graph import (
+    matching_from_graph_arrays,
+    matching_graph_arrays,
+    publish_matching_graph,
+    SharedMatchingGraph,
+)
+from parsurf.tools._stats_db import (
+    is_stats_database_path,
+    METADATA_COLUMNS,
+    read_stats_files,
+    STATS_DATABASE_SUFFIXES,
+    StatsDatabase,
+)
 from parsurf.tools._surface_code import (
     surface_code_tiles,
     Tile,
@@ -14,3 +125,9 @@ from parsurf.tools._util import (
     not_nones,
     score_binomial_line,
 )
+from parsurf.tools._windowed import (
+    detector_times,
+    parse_windowed_decoder_name,
+    SlidingWindowDecoder,
+    windowed_decoder_name,
+)
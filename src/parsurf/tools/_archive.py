@@ -0,0 +1,257 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import collections
+import dataclasses
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import pathlib
+import struct
+
+import sinter
+import stim
+
+from parsurf.tools._circuit_io import circuit_file_metadata, compression_of_path, encode_text, \
+    _zstandard
+
+_MAGIC = b'PSARC001'
+_FOOTER = struct.Struct('<QQ8s')
+
+
+@dataclasses.dataclass(frozen=True)
+class CircuitArchiveEntry:
+    """The index entry of one file packed into a circuit archive.
+
+    Attributes:
+        name: The file name the entry would have had on disk (e.g. 'b=X,c=chao,d=3,p=0.001,q=25,r=3.stim.gz').
+        metadata: The metadata parsed from the name, as `circuit_file_metadata` would.
+        offset: Where the entry's (possibly compressed) bytes start in the archive.
+        length: The number of bytes the entry occupies.
+        sha256: The hash of the entry's bytes.
+    """
+    name: str
+    metadata: Dict[str, Any]
+    offset: int
+    length: int
+    sha256: str
+
+    @property
+    def compression(self) -> str:
+        return compression_of_path(self.name)
+
+    def to_json(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+
+class CircuitArchiveWriter:
+    """Packs many circuit files into one archive file.
+
+    The archive is a header, the concatenated file contents, a JSON index mapping each file's name
+    and metadata to its offset, length and hash, and a footer locating the index. It is written to
+    a temporary file and only moved into place by `close`, so an interrupted write never looks finished.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]):
+        self.path = pathlib.Path(path)
+        self._tmp = self.path.with_name(self.path.name + '.tmp')
+        self._file = open(self._tmp, 'wb')
+        self._file.write(_MAGIC)
+        self._offset = len(_MAGIC)
+        self._entries: Dict[str, CircuitArchiveEntry] = {}
+
+    def add_bytes(self, name: str, data: bytes) -> CircuitArchiveEntry:
+        """Adds a file's raw (possibly compressed) contents under the given file name."""
+        if name in self._entries:
+            raise ValueError(f'Duplicate archive entry {name!r}.')
+        entry = CircuitArchiveEntry(
+            name=name,
+            metadata=circuit_file_metadata(name),
+            offset=self._offset,
+            length=len(data),
+            sha256=hashlib.sha256(data).hexdigest(),
+        )
+        self._file.write(data)
+        self._offset += len(data)
+        self._entries[name] = entry
+        return entry
+
+    def add_text(self, name: str, text: str) -> CircuitArchiveEntry:
+        """Adds text (e.g. a circuit), compressed according to the name's suffix."""
+        return self.add_bytes(name, encode_text(text, compression_of_path(name)))
+
+    def close(self) -> None:
+        index = json.dumps({'entries': [e.to_json() for e in self._entries.values()]}).encode()
+        self._file.write(index)
+        self._file.write(_FOOTER.pack(self._offset, len(index), _MAGIC))
+        self._file.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self) -> None:
+        """Discards the partially written archive."""
+        self._file.close()
+        self._tmp.unlink()
+
+    def __enter__(self) -> 'CircuitArchiveWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _decode(data: Union[bytes, memoryview], compression: str) -> str:
+    if compression == 'none':
+        return str(data, 'utf8')
+    if compression == 'gzip':
+        return gzip.decompress(data).decode()
+    if compression == 'zstd':
+        return _zstandard().ZstdDecompressor().decompress(data).decode()
+    raise NotImplementedError(f'{compression=}')
+
+
+class CircuitArchive:
+    """Reads a circuit archive written by `CircuitArchiveWriter`.
+
+    The archive is memory mapped. Only the index is parsed up front; an entry's bytes are only
+    touched (and paged in) when that entry is read, so a collector can select the few tasks it
+    needs out of a large archive without reading the rest of it.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]):
+        self.path = pathlib.Path(path)
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if len(self._view) < len(_MAGIC) + _FOOTER.size or self._view[:len(_MAGIC)] != _MAGIC:
+            self.close()
+            raise ValueError(f'{self.path} is not a circuit archive.')
+        index_offset, index_length, magic = _FOOTER.unpack(self._view[-_FOOTER.size:])
+        if magic != _MAGIC:
+            self.close()
+            raise ValueError(f'{self.path} is truncated (no archive footer).')
+        index = json.loads(bytes(self._view[index_offset:index_offset + index_length]))
+        self.entries: List[CircuitArchiveEntry] = [CircuitArchiveEntry(**e) for e in index['entries']]
+        self._by_name = {e.name: e for e in self.entries}
+
+    def close(self) -> None:
+        """Unmaps the archive.
+
+        Raises:
+            BufferError: A view returned by `raw_bytes` is still alive. Release it (or drop all references
+                to it) first.
+        """
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self) -> 'CircuitArchive':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def select(self,
+               predicate: Optional[Callable[[Dict[str, Any]], bool]] = None,
+               **metadata: Any) -> List[CircuitArchiveEntry]:
+        """Returns the entries whose metadata matches.
+
+        Args:
+            predicate: Optional filter applied to each entry's metadata.
+            **metadata: Required metadata values, e.g. `select(c='chao', d=5)`.
+        """
+        return [
+            e
+            for e in self.entries
+            if all(e.metadata.get(k) == v for k, v in metadata.items())
+            and (predicate is None or predicate(e.metadata))
+        ]
+
+    def entry(self, name: str) -> CircuitArchiveEntry:
+        """Returns the entry with the given file name."""
+        if name not in self._by_name:
+            raise KeyError(f'No entry {name!r} in {self.path}.')
+        return self._by_name[name]
+
+    def sources(self,
+                predicate: Optional[Callable[[Dict[str, Any]], bool]] = None,
+                **metadata: Any) -> List[Tuple[str, str]]:
+        """Describes the matching circuits as (archive path, entry name) pairs for `task_from_archive_entry`.
+
+        The pairs are small and picklable, so they can be given to `collect_task_stats`, whose workers
+        then only read the circuits they sample.
+        """
+        return [(str(self.path), e.name) for e in self.select(predicate, **metadata)]
+
+    def raw_bytes(self, entry: CircuitArchiveEntry, *, verify: bool = True) -> memoryview:
+        """Returns a zero-copy view of an entry's stored (possibly compressed) bytes.
+
+        The view points into the memory mapped archive, so `close` raises a BufferError while it is
+        alive. Call `release()` on it (or copy it with `bytes(...)`) before closing the archive.
+        """
+        data = self._view[entry.offset:entry.offset + entry.length]
+        if verify and hashlib.sha256(data).hexdigest() != entry.sha256:
+            raise ValueError(f'Archive entry {entry.name!r} in {self.path} is corrupted (hash mismatch).')
+        return data
+
+    def read_text(self, entry: CircuitArchiveEntry, *, verify: bool = True) -> str:
+        return _decode(self.raw_bytes(entry, verify=verify), entry.compression)
+
+    def read_circuit(self, entry: CircuitArchiveEntry, *, verify: bool = True) -> stim.Circuit:
+        return stim.Circuit(self.read_text(entry, verify=verify))
+
+    def iter_tasks(self,
+                   predicate: Optional[Callable[[Dict[str, Any]], bool]] = None,
+                   **metadata: Any) -> Iterator[sinter.Task]:
+        """Yields sinter tasks for the matching circuits, reading each circuit only when it is reached."""
+        for entry in self.select(predicate, **metadata):
+            yield sinter.Task(
+                circuit=self.read_circuit(entry),
+                json_metadata=entry.metadata,
+            )
+
+
+# The archives opened by `task_from_archive_entry` in this process, most recently used last.
+_OPEN_ARCHIVES: 'collections.OrderedDict[Tuple[str, int, int], CircuitArchive]' = collections.OrderedDict()
+_MAX_OPEN_ARCHIVES = 8
+
+
+def _open_archive(path: str) -> CircuitArchive:
+    """Returns an open archive for the given path, reusing one opened earlier by this process.
+
+    Archives are keyed by the file's inode and modification time as well as its path, so an archive
+    regenerated in place (which `CircuitArchiveWriter` does with `os.replace`) is reopened instead of
+    reading the old file. Archives that are replaced or evicted are closed.
+    """
+    st = os.stat(path)
+    key = (path, st.st_ino, st.st_mtime_ns)
+    archive = _OPEN_ARCHIVES.get(key)
+    if archive is not None:
+        _OPEN_ARCHIVES.move_to_end(key)
+        return archive
+
+    for stale in [k for k in _OPEN_ARCHIVES if k[0] == path]:
+        _OPEN_ARCHIVES.pop(stale).close()
+    archive = CircuitArchive(path)
+    _OPEN_ARCHIVES[key] = archive
+    while len(_OPEN_ARCHIVES) > _MAX_OPEN_ARCHIVES:
+        _, evicted = _OPEN_ARCHIVES.popitem(last=False)
+        evicted.close()
+    return archive
+
+
+def task_from_archive_entry(source: Tuple[str, str]) -> sinter.Task:
+    """Makes a sinter task for an archived circuit, given the archive's path and the entry's name.
+
+    See `CircuitArchive.sources`. Each process keeps the archives it reads from open, so expanding
+    another entry of the same archive only reads that entry.
+    """
+    path, name = source
+    archive = _open_archive(path)
+    entry = archive.entry(name)
+    return sinter.Task(
+        circuit=archive.read_circuit(entry),
+        json_metadata=entry.metadata,
+    )
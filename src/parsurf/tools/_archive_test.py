@@ -0,0 +1,103 @@
+import pytest
+
+from parsurf.circuits.chao import chao_memory_experiment_task
+from parsurf.tools import _archive
+from parsurf.tools._archive import CircuitArchive, CircuitArchiveWriter, task_from_archive_entry
+
+
+def test_archive_round_trip(tmp_path):
+    tasks = [
+        chao_memory_experiment_task(basis='X', diam=d, rounds=3, noise=p)
+        for d in [3, 5]
+        for p in [0.001, 0.002]
+    ]
+    path = tmp_path / 'circuits.psarc'
+    with CircuitArchiveWriter(path) as writer:
+        for k, task in enumerate(tasks):
+            m = task.json_metadata
+            name = f'c={m["c"]},d={m["d"]},p={m["p"]}'
+            writer.add_text(f'{name}.stim' + '.gz' * (k % 2), str(task.circuit))
+        with pytest.raises(ValueError, match='Duplicate'):
+            writer.add_text(f'{name}.stim.gz', '')
+    assert not (tmp_path / 'circuits.psarc.tmp').exists()
+
+    with CircuitArchive(path) as archive:
+        assert len(archive.entries) == 4
+        assert [e.metadata for e in archive.select(d=5)] == [
+            {'c': 'chao', 'd': 5, 'p': 0.001},
+            {'c': 'chao', 'd': 5, 'p': 0.002},
+        ]
+        assert len(archive.select(lambda m: m['p'] > 0.0015)) == 2
+
+        loaded = list(archive.iter_tasks())
+        assert [t.circuit for t in loaded] == [t.circuit for t in tasks]
+        assert all(t.detector_error_model is None for t in loaded)
+
+        sources = archive.sources(d=5)
+        assert sources == [(str(path), 'c=chao,d=5,p=0.001.stim'), (str(path), 'c=chao,d=5,p=0.002.stim.gz')]
+    task = task_from_archive_entry(sources[1])
+    assert task.circuit == tasks[3].circuit
+    assert task.json_metadata == {'c': 'chao', 'd': 5, 'p': 0.002}
+
+
+def test_archive_detects_damage(tmp_path):
+    path = tmp_path / 'circuits.psarc'
+    with CircuitArchiveWriter(path) as writer:
+        writer.add_text('c=chao,d=3.stim', 'H 0\nM 0\n')
+
+    data = bytearray(path.read_bytes())
+    data[8] ^= 1
+    path.write_bytes(bytes(data))
+    with CircuitArchive(path) as archive:
+        entry, = archive.entries
+        with pytest.raises(ValueError, match='corrupted'):
+            archive.read_circuit(entry)
+
+    path.write_bytes(bytes(data[:-3]))
+    with pytest.raises(ValueError, match='truncated'):
+        CircuitArchive(path)
+
+    # Failed writes don't leave an archive behind.
+    with pytest.raises(RuntimeError):
+        with CircuitArchiveWriter(tmp_path / 'other.psarc') as writer:
+            writer.add_text('c=chao,d=3.stim', 'H 0\n')
+            raise RuntimeError()
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_task_from_archive_entry_reopens_replaced_archives(tmp_path):
+    path = tmp_path / 'circuits.psarc'
+    with CircuitArchiveWriter(path) as writer:
+        writer.add_text('c=chao,d=3.stim', 'H 0\nM 0\n')
+    source = (str(path), 'c=chao,d=3.stim')
+    assert str(task_from_archive_entry(source).circuit) == 'H 0\nM 0'
+    first = _archive._OPEN_ARCHIVES[next(reversed(_archive._OPEN_ARCHIVES))]
+
+    # Regenerating the archive replaces the file, which is noticed by later reads.
+    with CircuitArchiveWriter(path) as writer:
+        writer.add_text('c=chao,d=3.stim', 'X 0\nM 0\n')
+    assert str(task_from_archive_entry(source).circuit) == 'X 0\nM 0'
+    assert first._mmap.closed
+    second, = [a for k, a in _archive._OPEN_ARCHIVES.items() if k[0] == str(path)]
+
+    # Evicted archives are closed.
+    for k in range(_archive._MAX_OPEN_ARCHIVES):
+        other = tmp_path / f'other{k}.psarc'
+        with CircuitArchiveWriter(other) as writer:
+            writer.add_text('c=chao,d=3.stim', 'H 0\n')
+        task_from_archive_entry((str(other), 'c=chao,d=3.stim'))
+    assert len(_archive._OPEN_ARCHIVES) == _archive._MAX_OPEN_ARCHIVES
+    assert second._mmap.closed
+
+
+def test_archive_close_with_live_view(tmp_path):
+    path = tmp_path / 'circuits.psarc'
+    with CircuitArchiveWriter(path) as writer:
+        writer.add_text('c=chao,d=3.stim', 'H 0\n')
+    archive = CircuitArchive(path)
+    view = archive.raw_bytes(archive.entries[0])
+    with pytest.raises(BufferError):
+        archive.close()
+    assert bytes(view) == b'H 0\n'
+    view.release()
+    archive.close()
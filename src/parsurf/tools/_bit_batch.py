@@ -0,0 +1,155 @@
+from typing import Tuple, Union
+
+import dataclasses
+
+import numpy as np
+import stim
+
+# The default memory budget of one sampled chunk of shots (see `shots_per_chunk`).
+DEFAULT_BATCH_MEMORY_BYTES = 1 << 28
+
+# Peak bits of working memory the stim sampler uses per measurement and shot (for its bit-packed
+# measurement record tables), as measured with the stim version this repo pins.
+SAMPLER_BITS_PER_MEASUREMENT = 4
+
+_POPCOUNT = np.array([bin(k).count('1') for k in range(256)], dtype=np.uint8)
+
+
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    """Bit-packs the rows of a 2d bool array, in the little endian order used by stim and pymatching.
+
+    The bit for column `m` of row `s` ends up at `(packed[s, m // 8] >> (m % 8)) & 1`.
+    """
+    return np.packbits(bits.astype(np.bool_, copy=False), axis=1, bitorder='little')
+
+
+def unpack_bits(packed: np.ndarray, num_bits: int) -> np.ndarray:
+    """Inverse of `pack_bits`: returns a (rows, num_bits) bool array."""
+    return np.unpackbits(packed, axis=1, count=num_bits, bitorder='little').view(np.bool_)
+
+
+def popcount_rows(packed: np.ndarray) -> np.ndarray:
+    """Counts the set bits in each row of a bit-packed uint8 array."""
+    return _POPCOUNT[packed].sum(axis=1, dtype=np.int64)
+
+
+def count_packed_mistakes(*, actual_obs: np.ndarray, predicted_obs: np.ndarray) -> int:
+    """Counts mispredicted shots, comparing bit-packed observable flips with XOR.
+
+    Args:
+        actual_obs: A bit-packed uint8 array of shape (shots, ceil(num_observables / 8)).
+        predicted_obs: The bit-packed predictions, with the same shape.
+
+    Returns:
+        The number of shots where any observable was mispredicted.
+    """
+    assert predicted_obs.shape == actual_obs.shape
+    diff = np.bitwise_xor(actual_obs, predicted_obs)
+    return int(np.count_nonzero(diff.any(axis=1)))
+
+
+def shots_per_chunk(*,
+                    num_detectors: int,
+                    num_observables: int,
+                    num_measurements: int,
+                    memory_budget_bytes: int) -> int:
+    """How many shots can be sampled and decoded at once within a memory budget.
+
+    Every shot takes its bit-packed detection events and observable flips (sampled together, and
+    then split into a `PackedBatch`), plus the sampler's bit-packed working memory of about
+    `SAMPLER_BITS_PER_MEASUREMENT` bits per measurement.
+    """
+    bits = num_detectors + num_observables
+    bytes_per_shot = 2 * ((bits + 7) // 8) + (SAMPLER_BITS_PER_MEASUREMENT * num_measurements + 7) // 8
+    return max(1, memory_budget_bytes // max(1, bytes_per_shot))
+
+
+@dataclasses.dataclass
+class PackedBatch:
+    """A batch of shots with bit-packed detection events and observable flips.
+
+    Attributes:
+        dets: A uint8 array of shape (shots, ceil(num_detectors / 8)), bit-packed by `pack_bits`
+            (the layout accepted by `decode_batch(..., bit_packed_shots=True)` of the decoders).
+        obs: A uint8 array of shape (shots, ceil(num_observables / 8)), bit-packed the same way.
+        num_detectors: The number of detectors.
+        num_observables: The number of observables.
+    """
+    dets: np.ndarray
+    obs: np.ndarray
+    num_detectors: int
+    num_observables: int
+
+    @property
+    def shots(self) -> int:
+        return self.dets.shape[0]
+
+    def detection_event_counts(self) -> np.ndarray:
+        """The number of detection events of each shot."""
+        return popcount_rows(self.dets)
+
+    def select(self, shots: Union[np.ndarray, slice]) -> 'PackedBatch':
+        """Returns the batch of the given shots (a bool mask, indices or slice)."""
+        return PackedBatch(
+            dets=self.dets[shots],
+            obs=self.obs[shots],
+            num_detectors=self.num_detectors,
+            num_observables=self.num_observables)
+
+    def count_mistakes(self, predicted_obs: np.ndarray) -> int:
+        """Counts the shots whose bit-packed predicted observable flips are wrong."""
+        return count_packed_mistakes(actual_obs=self.obs, predicted_obs=predicted_obs)
+
+
+def sample_packed_batch(sampler: stim.CompiledDetectorSampler,
+                        shots: int,
+                        *,
+                        num_detectors: int,
+                        num_observables: int) -> PackedBatch:
+    """Samples bit-packed shots, and splits them into detection events and observable flips."""
+    samples = sampler.sample_bit_packed(shots, append_observables=True)
+    dets, obs = split_packed_bits(samples, num_detectors, num_detectors + num_observables)
+    return PackedBatch(
+        dets=dets,
+        obs=obs,
+        num_detectors=num_detectors,
+        num_observables=num_observables)
+
+
+def split_packed_bits(packed: np.ndarray, split: int, num_bits: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Splits the columns of a bit-packed array at a bit offset, without unpacking it.
+
+    Args:
+        packed: A bit-packed uint8 array of shape (rows, ceil(num_bits / 8)).
+        split: The bit offset to split at.
+        num_bits: The number of bits in each row.
+
+    Returns:
+        The bit-packed bits before `split` and the bit-packed bits from `split` on, with the unused
+        high bits of their last bytes cleared.
+    """
+    head = packed[:, :(split + 7) // 8].copy()
+    width = (num_bits - split + 7) // 8
+    shift = split % 8
+    start = split // 8
+    if shift:
+        head[:, -1] &= (1 << shift) - 1
+        # Each byte of the tail takes the high bits of one byte and the low bits of the next.
+        padded = np.pad(packed[:, start:start + width + 1], ((0, 0), (0, 1)))
+        tail = (padded[:, :width] >> shift) | (padded[:, 1:width + 1] << (8 - shift))
+    else:
+        tail = packed[:, start:start + width].copy()
+    if (num_bits - split) % 8:
+        tail[:, -1] &= (1 << ((num_bits - split) % 8)) - 1
+    return head, tail
+
+
+def fit_packed_width(packed: np.ndarray, width: int) -> np.ndarray:
+    """Pads the columns of a bit-packed array with zero bytes up to the given width.
+
+    Decoders predict the observables their graph knows about, which can be fewer than the
+    circuit's when some observable isn't flipped by any error.
+    """
+    if packed.shape[1] >= width:
+        return packed
+    return np.pad(packed, ((0, 0), (0, width - packed.shape[1])))
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import stim
+
+from parsurf.tools._bit_batch import count_packed_mistakes, pack_bits, popcount_rows, sample_packed_batch, \
+    shots_per_chunk, split_packed_bits, unpack_bits
+
+
+def test_pack_bits_round_trip():
+    rng = np.random.default_rng(5)
+    bits = rng.random((50, 21)) < 0.3
+    packed = pack_bits(bits)
+    assert packed.shape == (50, 3) and packed.dtype == np.uint8
+    np.testing.assert_array_equal(unpack_bits(packed, 21), bits)
+    np.testing.assert_array_equal(popcount_rows(packed), np.count_nonzero(bits, axis=1))
+    # The bit layout of stim and pymatching.
+    assert pack_bits(np.array([[0, 1, 0, 0, 0, 0, 0, 0, 1]], dtype=np.bool_)).tolist() == [[2, 1]]
+
+
+def test_count_packed_mistakes_matches_unpacked_count():
+    rng = np.random.default_rng(7)
+    for num_obs in [1, 3, 9]:
+        actual = rng.random((200, num_obs)) < 0.2
+        predicted = rng.random((200, num_obs)) < 0.2
+        assert count_packed_mistakes(
+            actual_obs=pack_bits(actual),
+            predicted_obs=pack_bits(predicted),
+        ) == np.count_nonzero(np.any(actual != predicted, axis=1))
+
+
+def test_sample_packed_batch():
+    circuit = stim.Circuit.generated('surface_code:rotated_memory_x', distance=3, rounds=3, after_clifford_depolarization=0.01)
+    batch = sample_packed_batch(
+        circuit.compile_detector_sampler(),
+        500,
+        num_detectors=circuit.num_detectors,
+        num_observables=circuit.num_observables)
+    assert batch.shots == 500
+    assert batch.dets.shape == (500, (circuit.num_detectors + 7) // 8)
+    assert batch.obs.shape == (500, 1)
+    quiet = batch.select(batch.detection_event_counts() == 0)
+    assert 0 < quiet.shots < 500
+    assert not quiet.dets.any()
+    assert batch.count_mistakes(batch.obs) == 0
+    assert batch.count_mistakes(np.zeros_like(batch.obs)) == np.count_nonzero(batch.obs)
+
+    samples = circuit.compile_detector_sampler(seed=3).sample(500, append_observables=True)
+    seeded = sample_packed_batch(
+        circuit.compile_detector_sampler(seed=3),
+        500,
+        num_detectors=circuit.num_detectors,
+        num_observables=circuit.num_observables)
+    np.testing.assert_array_equal(unpack_bits(seeded.dets, circuit.num_detectors), samples[:, :-1])
+    np.testing.assert_array_equal(unpack_bits(seeded.obs, 1), samples[:, -1:])
+
+    assert shots_per_chunk(num_detectors=63, num_observables=1, num_measurements=168, memory_budget_bytes=10**6) == 10**4
+    assert shots_per_chunk(num_detectors=63, num_observables=1, num_measurements=168, memory_budget_bytes=1) == 1
+
+
+@pytest.mark.parametrize('split,num_bits', [(0, 5), (8, 20), (13, 14), (13, 30), (3, 8), (16, 16)])
+def test_split_packed_bits(split: int, num_bits: int):
+    bits = np.random.default_rng(split).random((7, num_bits)) < 0.5
+    head, tail = split_packed_bits(pack_bits(bits), split, num_bits)
+    np.testing.assert_array_equal(head, pack_bits(bits[:, :split]))
+    np.testing.assert_array_equal(tail, pack_bits(bits[:, split:]))
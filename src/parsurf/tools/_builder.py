@@ -38,6 +38,14 @@ class MeasurementTracker:
         self._rec(key, [self.next_measurement_index])
         self.next_measurement_index += 1
 
+    def record_measurements(self, keys: Iterable[Any]) -> None:
+        """Records several consecutive measurements at once."""
+        n = self.next_measurement_index
+        for key in keys:
+            self._rec(key, [n])
+            n += 1
+        self.next_measurement_index = n
+
     def make_measurement_group(self, sub_keys: Iterable[Any], *, key: Any) -> None:
         self._rec(key, self.measurement_indices(sub_keys))
 
@@ -112,8 +120,7 @@ class Builder:
                 layer: int) -> None:
         qubits = sorted_complex(qubits)
         self.circuit.append(f"M{basis}", [self.q2i[q] for q in qubits])
-        for q in qubits:
-            self.tracker.record_measurement(AtLayer(tracker_key(q), layer))
+        self.tracker.record_measurements(AtLayer(tracker_key(q), layer) for q in qubits)
 
     def measure_pauli_product(self,
                               *,
@@ -0,0 +1,120 @@
+from typing import Any, Dict, IO, Iterable, Iterator, List, Union
+
+import gzip
+import io
+import pathlib
+
+import sinter
+import stim
+
+# Maps compression names to the suffix appended after '.stim'.
+COMPRESSION_SUFFIXES = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _zstandard() -> Any:
+    try:
+        import zstandard
+    except ImportError as ex:
+        raise ImportError("zstd compression requires the 'zstandard' package (pip install zstandard).") from ex
+    return zstandard
+
+
+def available_compressions() -> List[str]:
+    """Returns the compression names that can be used in this environment."""
+    result = ['none', 'gzip']
+    try:
+        _zstandard()
+        result.append('zstd')
+    except ImportError:
+        pass
+    return result
+
+
+def compression_of_path(path: Union[str, pathlib.Path]) -> str:
+    """Determines the compression of a circuit file from its name."""
+    name = pathlib.Path(path).name
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if suffix and name.endswith(suffix):
+            return compression
+    return 'none'
+
+
+def strip_compression_suffix(path: Union[str, pathlib.Path]) -> pathlib.Path:
+    """Returns the path without its compression suffix (e.g. 'a=2.stim.gz' -> 'a=2.stim')."""
+    path = pathlib.Path(path)
+    suffix = COMPRESSION_SUFFIXES[compression_of_path(path)]
+    if suffix:
+        path = path.with_name(path.name[:-len(suffix)])
+    return path
+
+
+def circuit_file_metadata(path: Union[str, pathlib.Path]) -> Dict[str, Any]:
+    """Like `sinter.comma_separated_key_values`, but also accepts compressed file names.
+
+    `sinter.comma_separated_key_values` only strips the last extension, so 'r=15.stim.gz' would
+    give r='15.stim' instead of r=15.
+    """
+    return sinter.comma_separated_key_values(str(strip_compression_suffix(path)))
+
+
+def encode_text(text: str, compression: str) -> bytes:
+    """Encodes text (e.g. a circuit's stim format) into the bytes of a file with the given compression."""
+    data = text.encode()
+    if compression == 'none':
+        return data
+    if compression == 'gzip':
+        # A fixed mtime keeps the output deterministic, so file hashes only change when the content does.
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if compression == 'zstd':
+        return _zstandard().ZstdCompressor(level=10).compress(data)
+    raise NotImplementedError(f'{compression=}')
+
+
+def open_text_stream(path: Union[str, pathlib.Path]) -> IO[str]:
+    """Opens a possibly compressed text file for streaming reads, decompressing on the fly.
+
+    The compression is detected from the file's leading bytes, so misnamed files still read correctly.
+    """
+    f = open(path, 'rb')
+    try:
+        magic = f.read(4)
+        f.seek(0)
+        if magic.startswith(_GZIP_MAGIC):
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=f, mode='rb'))
+        if magic == _ZSTD_MAGIC:
+            reader = _zstandard().ZstdDecompressor().stream_reader(f, closefd=True)
+            return io.TextIOWrapper(io.BufferedReader(reader))
+        return io.TextIOWrapper(f)
+    except BaseException:
+        f.close()
+        raise
+
+
+def read_circuit_file(path: Union[str, pathlib.Path]) -> stim.Circuit:
+    """Reads a circuit from a '.stim', '.stim.gz' or '.stim.zst' file, without decompressing it to disk."""
+    with open_text_stream(path) as f:
+        return stim.Circuit.from_file(f)
+
+
+def task_from_circuit_file(path: Union[str, pathlib.Path]) -> sinter.Task:
+    """Makes a sinter task for a circuit file, taking its metadata from its (possibly compressed) file name."""
+    return sinter.Task(
+        circuit=read_circuit_file(path),
+        json_metadata=circuit_file_metadata(path),
+    )
+
+
+def iter_circuit_file_tasks(paths: Iterable[Union[str, pathlib.Path]]) -> Iterator[sinter.Task]:
+    """Yields sinter tasks for circuit files, taking their metadata from their (possibly compressed) file names.
+
+    Circuits are read lazily, one file at a time, as the tasks are consumed.
+    """
+    for path in paths:
+        yield task_from_circuit_file(path)
@@ -0,0 +1,32 @@
+import pytest
+import stim
+
+from parsurf.circuits.chao import chao_memory_experiment_task
+from parsurf.tools._circuit_io import available_compressions, circuit_file_metadata, COMPRESSION_SUFFIXES, \
+    compression_of_path, encode_text, iter_circuit_file_tasks, read_circuit_file, \
+    strip_compression_suffix
+
+
+def test_compressed_file_names():
+    assert compression_of_path('a=2,b=X.stim') == 'none'
+    assert compression_of_path('dir/a=2,b=X.stim.gz') == 'gzip'
+    assert compression_of_path('a=2,b=X.stim.zst') == 'zstd'
+    assert strip_compression_suffix('dir/a=2,b=X.stim.gz').name == 'a=2,b=X.stim'
+    assert circuit_file_metadata('dir/a=2,p=0.001,r=15.stim.gz') == {'a': 2, 'p': 0.001, 'r': 15}
+    assert circuit_file_metadata('dir/a=2,p=0.001,r=15.stim') == {'a': 2, 'p': 0.001, 'r': 15}
+
+
+@pytest.mark.parametrize('compression', available_compressions())
+def test_circuit_round_trip(tmp_path, compression):
+    task = chao_memory_experiment_task(basis='X', diam=3, rounds=3, noise=0.001)
+    path = tmp_path / f'c=chao,d=3.stim{COMPRESSION_SUFFIXES[compression]}'
+    data = encode_text(f'{task.circuit}\n', compression)
+    assert data == encode_text(f'{task.circuit}\n', compression)
+    path.write_bytes(data)
+    if compression != 'none':
+        assert len(data) < len(str(task.circuit)) / 3
+
+    assert read_circuit_file(path) == task.circuit
+    loaded, = iter_circuit_file_tasks([path])
+    assert loaded.circuit == task.circuit
+    assert loaded.json_metadata == {'c': 'chao', 'd': 3}
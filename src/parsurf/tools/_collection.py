@@ -0,0 +1,904 @@
+from typing import Any, Callable, Collection, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import collections
+import csv
+import dataclasses
+import functools
+import io
+import itertools
+import json
+import multiprocessing
+import pathlib
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import sinter
+
+from parsurf.tools._bit_batch import DEFAULT_BATCH_MEMORY_BYTES, count_packed_mistakes, fit_packed_width, \
+    PackedBatch, sample_packed_batch, shots_per_chunk
+from parsurf.tools._coordinator import Address, LeaseServer, work_on_leases
+from parsurf.tools._decode_cache import DecodeCounters, SyndromeCachingDecoder
+from parsurf.tools._dem_cache import dem_cache_key, DemCache, looped_auto_dem
+from parsurf.tools._shared_graph import publish_matching_graph, SharedMatchingGraph
+from parsurf.tools._windowed import detector_times, parse_windowed_decoder_name, SlidingWindowDecoder
+
+
+class TaskSampler:
+    """Samples and decodes shots of a task, reusing the compiled sampler and decoder across batches.
+
+    When a `DemCache` is given, the detector error model and decoder graph are loaded from it (or
+    stored in it) instead of being derived from scratch. When a `SharedMatchingGraph` is given (see
+    `publish_matching_graph`), the decoder is built from it and the detector error model isn't
+    derived at all. When a decode cache size is given, shots are decoded through a
+    `SyndromeCachingDecoder`.
+
+    Decoders named by `windowed_decoder_name` (e.g. 'pymatching:window=5+5') decode with a
+    `SlidingWindowDecoder`. Its window graphs are built from the detector error model with the
+    circuit's loops kept (see `looped_auto_dem`), so neither the flattened detector error model nor
+    the full matching graph is built, and the decoder's memory doesn't grow with the rounds.
+
+    Shots stay bit-packed from sampling to error counting (see `PackedBatch`): decoders take
+    bit-packed detection events and return bit-packed predictions, which are compared with the
+    sampled observable flips by XOR. Large batches are sampled in chunks fitting in
+    `batch_memory_bytes` (see `shots_per_chunk`).
+    """
+
+    def __init__(self,
+                 task: sinter.Task,
+                 *,
+                 decoder: str = 'pymatching',
+                 dem_cache: Optional[DemCache] = None,
+                 shared_graph: Optional[SharedMatchingGraph] = None,
+                 decode_cache_size: Optional[int] = None,
+                 batch_memory_bytes: int = DEFAULT_BATCH_MEMORY_BYTES):
+        window = parse_windowed_decoder_name(decoder)
+        if (decoder if window is None else window[0]) != 'pymatching':
+            raise NotImplementedError(f'{decoder=}')
+        if task.postselection_mask is not None:
+            raise NotImplementedError('Sampling postselected tasks.')
+        import pymatching
+
+        self.json_metadata = task.json_metadata
+        self.decoder = decoder
+        self.num_detectors = task.circuit.num_detectors
+        self.num_observables = task.circuit.num_observables
+        self.num_measurements = task.circuit.num_measurements
+        self.batch_memory_bytes = batch_memory_bytes
+        self._sampler = task.circuit.compile_detector_sampler()
+        self._decode_cache_size = decode_cache_size
+        self._window = window
+        self._caching_decoder = None
+        if window is not None:
+            if shared_graph is not None:
+                raise NotImplementedError('Sharing sliding-window decoders.')
+            dem = task.detector_error_model
+            if dem is None:
+                dem = looped_auto_dem(task.circuit) if dem_cache is None else dem_cache.looped_detector_error_model(task.circuit)
+            self.strong_id = sinter.Task(
+                circuit=task.circuit,
+                decoder=decoder,
+                detector_error_model=dem,
+                json_metadata=task.json_metadata,
+            ).strong_id()
+            _, commit, buffer = window
+            self._set_matcher(SlidingWindowDecoder(dem, times=detector_times(task.circuit), commit=commit, buffer=buffer))
+            return
+        if shared_graph is not None:
+            self.strong_id = shared_graph.strong_id
+            self._set_matcher(shared_graph.matching())
+            return
+
+        key = None if dem_cache is None else dem_cache_key(task.circuit)
+        dem = task.detector_error_model
+        if dem is None:
+            dem = sinter.worker.auto_dem(task.circuit) if dem_cache is None else dem_cache.detector_error_model(task.circuit, key=key)
+        # The strong id sinter would give the task, so the stats combine with sinter's own records.
+        self.strong_id = sinter.Task(
+            circuit=task.circuit,
+            decoder=decoder,
+            detector_error_model=dem,
+            json_metadata=task.json_metadata,
+        ).strong_id()
+        if dem_cache is not None and task.detector_error_model is None:
+            self._set_matcher(dem_cache.matching(task.circuit, key=key))
+        else:
+            self._set_matcher(pymatching.Matching.from_detector_error_model(dem))
+
+    def _set_matcher(self, matcher: Any) -> None:
+        self._matcher = matcher
+        if self._decode_cache_size is not None:
+            self._caching_decoder = SyndromeCachingDecoder(
+                functools.partial(matcher.decode_batch, bit_packed_shots=True, bit_packed_predictions=True),
+                num_observables=self.num_observables,
+                max_cache_size=self._decode_cache_size,
+                bit_packed=True)
+
+    @property
+    def decode_counters(self) -> Optional[DecodeCounters]:
+        """How the sampled shots were decoded so far, or None when not using a decode cache."""
+        if self._caching_decoder is None:
+            return None
+        return dataclasses.replace(self._caching_decoder.counters)
+
+    def share(self) -> Tuple[shared_memory.SharedMemory, SharedMatchingGraph]:
+        """Publishes the sampler's decoder graph in shared memory (see `publish_matching_graph`)."""
+        if self._window is not None:
+            raise NotImplementedError('Sharing sliding-window decoders.')
+        return publish_matching_graph(self._matcher, strong_id=self.strong_id)
+
+    def chunk_sizes(self, num_shots: int) -> Iterator[int]:
+        """Splits `num_shots` shots into chunks fitting the memory budget."""
+        chunk = shots_per_chunk(
+            num_detectors=self.num_detectors,
+            num_observables=self.num_observables,
+            num_measurements=self.num_measurements,
+            memory_budget_bytes=self.batch_memory_bytes)
+        for start in range(0, num_shots, chunk):
+            yield min(chunk, num_shots - start)
+
+    def sample_batch(self, shots: int) -> PackedBatch:
+        """Samples shots of the circuit, with bit-packed detection events and observable flips."""
+        return sample_packed_batch(
+            self._sampler,
+            shots,
+            num_detectors=self.num_detectors,
+            num_observables=self.num_observables)
+
+    def predict(self, batch: PackedBatch) -> np.ndarray:
+        """Predicts the observable flips of a batch's shots, bit-packed like `batch.obs`."""
+        decoder = self._matcher if self._caching_decoder is None else self._caching_decoder
+        predicted = decoder.decode_batch(batch.dets, bit_packed_shots=True, bit_packed_predictions=True)
+        return fit_packed_width(np.asarray(predicted, dtype=np.uint8), batch.obs.shape[1])
+
+    def sample(self, num_shots: int) -> sinter.AnonTaskStats:
+        """Samples and decodes shots of the circuit."""
+        start_time = time.monotonic()
+        errors = 0
+        for chunk in self.chunk_sizes(num_shots):
+            batch = self.sample_batch(chunk)
+            errors += batch.count_mistakes(self.predict(batch))
+        return sinter.AnonTaskStats(
+            shots=num_shots,
+            errors=errors,
+            discards=0,
+            seconds=time.monotonic() - start_time,
+        )
+
+    def task_stats(self, stats: sinter.AnonTaskStats) -> sinter.TaskStats:
+        return sinter.TaskStats(
+            strong_id=self.strong_id,
+            decoder=self.decoder,
+            json_metadata=self.json_metadata,
+            shots=stats.shots,
+            errors=stats.errors,
+            discards=stats.discards,
+            seconds=stats.seconds,
+        )
+
+
+DISAGREEMENTS_CSV_HEADER = 'decoder,other_decoder,shots,disagreements,json_metadata'
+
+
+@dataclasses.dataclass(frozen=True)
+class DecoderDisagreements:
+    """How many shots of a task two decoders, decoding the same shots, predicted differently.
+
+    For tasks with one observable, the disagreements are the shots exactly one of the decoders got
+    wrong, which (with each decoder's error count) split into the shots only `decoder` got wrong,
+    (disagreements + errors - other errors) / 2, and the shots only `other_decoder` got wrong.
+
+    Disagreements aren't stats of a decoder, so they're stored in their own CSV format (see
+    `DISAGREEMENTS_CSV_HEADER` and `read_disagreements_csv`) or database table, never with stats.
+
+    Attributes:
+        decoder: The first decoder.
+        other_decoder: The decoder it's compared with.
+        json_metadata: The metadata of the task.
+        shots: The number of shots both decoders decoded.
+        disagreements: The number of shots where their predicted observable flips differed.
+    """
+    decoder: str
+    other_decoder: str
+    json_metadata: Any
+    shots: int = 0
+    disagreements: int = 0
+
+    @property
+    def key(self) -> str:
+        """Identifies the pair of decoders and the task (records with the same key can be added)."""
+        return json.dumps([self.decoder, self.other_decoder, self.json_metadata], sort_keys=True)
+
+    def __add__(self, other: 'DecoderDisagreements') -> 'DecoderDisagreements':
+        if other.key != self.key:
+            raise ValueError(f'Adding disagreements of different decoders or tasks: {self.key} and {other.key}.')
+        return dataclasses.replace(
+            self,
+            shots=self.shots + other.shots,
+            disagreements=self.disagreements + other.disagreements)
+
+    def to_csv_line(self) -> str:
+        """The record as a line of a disagreements CSV file (see `DISAGREEMENTS_CSV_HEADER`)."""
+        out = io.StringIO()
+        csv.writer(out, lineterminator='').writerow([
+            self.decoder,
+            self.other_decoder,
+            self.shots,
+            self.disagreements,
+            json.dumps(self.json_metadata, separators=(',', ':'), sort_keys=True),
+        ])
+        return out.getvalue()
+
+
+class MultiDecoderSampler:
+    """Samples shots of a task once, and decodes them with each of several decoders.
+
+    Every decoder decodes the same shots, so comparisons between decoders are paired (their
+    difference isn't blurred by independent sampling noise), and the shots are only sampled once.
+    Besides each decoder's stats, the shots where each pair of decoders predicted different
+    observable flips are counted (see `DecoderDisagreements`).
+    """
+
+    def __init__(self,
+                 task: sinter.Task,
+                 *,
+                 decoders: Sequence[str],
+                 dem_cache: Optional[DemCache] = None,
+                 decode_cache_size: Optional[int] = None,
+                 batch_memory_bytes: int = DEFAULT_BATCH_MEMORY_BYTES):
+        """
+        Args:
+            task: The task to sample.
+            decoders: The names of the decoders (each as accepted by `TaskSampler`).
+            dem_cache: If not None, load the detector error model and decoder graphs from it.
+            decode_cache_size: If not None, each decoder decodes through a `SyndromeCachingDecoder`
+                with this cache size.
+            batch_memory_bytes: The memory budget of each sampled chunk of shots (see `TaskSampler`).
+        """
+        if not decoders or len(set(decoders)) != len(decoders):
+            raise ValueError(f'Expected distinct decoders, but got {decoders!r}.')
+        windowed = [parse_windowed_decoder_name(decoder) is not None for decoder in decoders]
+        shared_task = task
+        if task.detector_error_model is None and dem_cache is None and not all(windowed):
+            # Derive the detector error model once, instead of once per decoder. Sliding-window
+            # decoders derive the (much smaller) detector error model with the circuit's loops instead.
+            shared_task = sinter.Task(
+                circuit=task.circuit,
+                detector_error_model=sinter.worker.auto_dem(task.circuit),
+                json_metadata=task.json_metadata)
+        self.samplers = [
+            TaskSampler(
+                task if is_windowed else shared_task,
+                decoder=decoder,
+                dem_cache=dem_cache,
+                decode_cache_size=decode_cache_size,
+                batch_memory_bytes=batch_memory_bytes)
+            for decoder, is_windowed in zip(decoders, windowed)
+        ]
+        self.pairs = list(itertools.combinations(range(len(decoders)), 2))
+
+    @property
+    def decode_counters(self) -> Optional[DecodeCounters]:
+        """How the first decoder decoded the sampled shots so far, or None when not using a decode cache."""
+        return self.samplers[0].decode_counters
+
+    def sample(self, num_shots: int) -> Tuple[List[sinter.AnonTaskStats], List[DecoderDisagreements]]:
+        """Samples shots of the circuit and decodes them with every decoder.
+
+        Returns:
+            The stats of each decoder, and the disagreements of each pair of decoders (in the order
+            of `pairs`). The sampling time is split evenly between the decoders' stats.
+        """
+        first = self.samplers[0]
+        errors = [0] * len(self.samplers)
+        seconds = [0.0] * len(self.samplers)
+        disagreements = [0] * len(self.pairs)
+        for chunk in first.chunk_sizes(num_shots):
+            start_time = time.monotonic()
+            batch = first.sample_batch(chunk)
+            sample_seconds = (time.monotonic() - start_time) / len(self.samplers)
+            predictions = []
+            for k, sampler in enumerate(self.samplers):
+                decode_start = time.monotonic()
+                predicted_obs = sampler.predict(batch)
+                predictions.append(predicted_obs)
+                errors[k] += batch.count_mistakes(predicted_obs)
+                seconds[k] += sample_seconds + time.monotonic() - decode_start
+            for k, (i, j) in enumerate(self.pairs):
+                disagreements[k] += count_packed_mistakes(actual_obs=predictions[i], predicted_obs=predictions[j])
+        stats = [
+            sinter.AnonTaskStats(shots=num_shots, errors=e, discards=0, seconds=t)
+            for e, t in zip(errors, seconds)
+        ]
+        return stats, [
+            DecoderDisagreements(
+                decoder=self.samplers[i].decoder,
+                other_decoder=self.samplers[j].decoder,
+                json_metadata=first.json_metadata,
+                shots=num_shots,
+                disagreements=d)
+            for (i, j), d in zip(self.pairs, disagreements)
+        ]
+
+    def task_stats(self, stats: Sequence[sinter.AnonTaskStats]) -> List[sinter.TaskStats]:
+        """Labels each decoder's stats returned by `sample`."""
+        return [sampler.task_stats(s) for sampler, s in zip(self.samplers, stats)]
+
+
+def read_stats_csv(path: Union[str, pathlib.Path]) -> List[sinter.TaskStats]:
+    """Reads the rows of a stats CSV file (as written by `sinter collect`), without merging them.
+
+    Unlike `sinter.stats_from_csv_files`, this doesn't need pandas.
+    """
+    result = []
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = [e.strip() for e in next(reader, [])]
+        for row in reader:
+            if not row:
+                continue
+            entry = dict(zip(header, (e.strip() for e in row)))
+            result.append(sinter.TaskStats(
+                strong_id=entry['strong_id'],
+                decoder=entry['decoder'],
+                json_metadata=json.loads(entry['json_metadata']),
+                shots=int(entry['shots']),
+                errors=int(entry['errors']),
+                discards=int(entry['discards']),
+                seconds=float(entry['seconds']),
+            ))
+    return result
+
+
+def read_disagreements_csv(path: Union[str, pathlib.Path]) -> List[DecoderDisagreements]:
+    """Reads the rows of a disagreements CSV file (see `DecoderDisagreements.to_csv_line`), without merging them."""
+    result = []
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = [e.strip() for e in next(reader, [])]
+        for row in reader:
+            if not row:
+                continue
+            entry = dict(zip(header, (e.strip() for e in row)))
+            result.append(DecoderDisagreements(
+                decoder=entry['decoder'],
+                other_decoder=entry['other_decoder'],
+                json_metadata=json.loads(entry['json_metadata']),
+                shots=int(entry['shots']),
+                disagreements=int(entry['disagreements']),
+            ))
+    return result
+
+
+def metadata_key(decoder: str, json_metadata: Any) -> str:
+    """Identifies a task by its decoder and metadata (which, unlike the strong id, is known before the circuit is built)."""
+    return json.dumps([decoder, json_metadata], sort_keys=True)
+
+
+@dataclasses.dataclass
+class CollectionTask:
+    """The collection state of one task.
+
+    Attributes:
+        description: A picklable description of the task, expanded into a `sinter.Task` by the
+            collection's task factory (inside the worker processes).
+        stats: The stats collected so far (including pre-existing stats).
+        max_shots: Stop sampling once this many shots were taken.
+        max_errors: Stop sampling once this many errors were seen.
+        stopped: Set (e.g. by a collection policy) to stop sampling the task early, with the reason.
+        decode_counters: How the task's new shots were decoded, when collecting with a decode cache.
+        paired_stats: When collecting with paired decoders, the new stats of each paired decoder,
+            keyed by decoder name.
+        disagreements: When collecting with paired decoders, the disagreements of each pair of
+            decoders, keyed by the pair's names.
+    """
+    description: Any
+    stats: sinter.AnonTaskStats
+    max_shots: int
+    max_errors: int
+    stopped: Optional[str] = None
+    decode_counters: DecodeCounters = dataclasses.field(default_factory=DecodeCounters)
+    paired_stats: Dict[str, sinter.AnonTaskStats] = dataclasses.field(default_factory=dict)
+    disagreements: Dict[Tuple[str, str], DecoderDisagreements] = dataclasses.field(default_factory=dict)
+
+    @property
+    def shots_left(self) -> int:
+        if self.stopped is not None or self.stats.errors >= self.max_errors:
+            return 0
+        return max(0, self.max_shots - self.stats.shots)
+
+    @property
+    def done(self) -> bool:
+        return self.shots_left == 0
+
+
+@dataclasses.dataclass(frozen=True)
+class SamplerOptions:
+    """How the workers of a collection sample and decode the shots of each task.
+
+    Combinations the samplers don't support are rejected when the options are made, before any
+    worker starts.
+
+    Attributes:
+        decoder: The decoder whose stats are collected (as accepted by `TaskSampler`).
+        paired_decoders: Other decoders that decode the same sampled shots as `decoder` (see
+            `MultiDecoderSampler`).
+        dem_cache_dir: If not None, workers load detector error models and decoder graphs from a
+            `DemCache` in this directory (storing them on a miss), instead of deriving them.
+        share_graphs: If True, each task's detector error model and decoder graph are built once, in
+            the collecting process, and published in shared memory as NumPy arrays (see
+            `publish_matching_graph`). Workers build their decoders from the shared arrays instead
+            of each deriving the detector error model, which lowers their peak memory and startup
+            time. The shared memory of a task is released once it's done.
+        decode_cache_size: If not None, workers decode through a `SyndromeCachingDecoder` with this
+            cache size, and each task's `decode_counters` are tallied.
+        batch_memory_bytes: Workers sample and decode each batch in chunks whose (bit-packed) arrays
+            fit in this many bytes, so large batches don't need memory proportional to their size.
+    """
+    decoder: str = 'pymatching'
+    paired_decoders: Tuple[str, ...] = ()
+    dem_cache_dir: Optional[str] = None
+    share_graphs: bool = False
+    decode_cache_size: Optional[int] = None
+    batch_memory_bytes: int = DEFAULT_BATCH_MEMORY_BYTES
+
+    def __post_init__(self):
+        object.__setattr__(self, 'paired_decoders', tuple(self.paired_decoders))
+        if self.dem_cache_dir is not None:
+            object.__setattr__(self, 'dem_cache_dir', str(self.dem_cache_dir))
+        decoders = (self.decoder, *self.paired_decoders)
+        if len(set(decoders)) != len(decoders):
+            raise ValueError(f'Expected distinct decoders, but got {decoders!r}.')
+        for decoder in decoders:
+            window = parse_windowed_decoder_name(decoder)
+            if (decoder if window is None else window[0]) != 'pymatching':
+                raise NotImplementedError(f'{decoder=}')
+        if self.share_graphs and self.paired_decoders:
+            raise NotImplementedError('Sharing the graphs of paired decoders.')
+        if self.share_graphs and parse_windowed_decoder_name(self.decoder) is not None:
+            raise NotImplementedError('Sharing sliding-window decoders.')
+
+    def dem_cache(self) -> Optional[DemCache]:
+        return None if self.dem_cache_dir is None else DemCache(pathlib.Path(self.dem_cache_dir))
+
+    def make_sampler(self,
+                     task: sinter.Task,
+                     *,
+                     shared_graph: Optional[SharedMatchingGraph] = None) -> Union[TaskSampler, MultiDecoderSampler]:
+        """Makes the sampler of a task: a `MultiDecoderSampler` with paired decoders, else a `TaskSampler`."""
+        if self.paired_decoders:
+            return MultiDecoderSampler(
+                task,
+                decoders=(self.decoder, *self.paired_decoders),
+                dem_cache=self.dem_cache(),
+                decode_cache_size=self.decode_cache_size,
+                batch_memory_bytes=self.batch_memory_bytes)
+        return TaskSampler(
+            task,
+            decoder=self.decoder,
+            dem_cache=self.dem_cache(),
+            shared_graph=shared_graph,
+            decode_cache_size=self.decode_cache_size,
+            batch_memory_bytes=self.batch_memory_bytes)
+
+
+@dataclasses.dataclass(frozen=True)
+class CoordinatorOptions:
+    """Where and how a collection coordinates workers over a socket (see `run_collection_worker`).
+
+    Attributes:
+        address: The address to listen at: a (host, port) pair with a fixed port, or a Unix socket
+            path.
+        authkey: The key coordinated workers must have.
+        lease_seconds: How long a coordinated worker may take to sample a batch. Batches whose
+            worker disconnects or overruns this are handed out again (and their late results
+            dropped).
+    """
+    address: Address
+    authkey: bytes
+    lease_seconds: float = 3600
+
+
+# Process-local cache of task samplers, keyed by the (json) description, so that consecutive batches
+# of a task sent to the same worker don't rebuild the circuit, detector error model and decoder.
+_SAMPLER_CACHE: 'collections.OrderedDict[str, Union[TaskSampler, MultiDecoderSampler]]' = collections.OrderedDict()
+_SAMPLER_CACHE_SIZE = 4
+
+
+@dataclasses.dataclass(frozen=True)
+class _Work:
+    """A batch of shots of one task, sent to a worker."""
+    index: int
+    task_factory: Callable[[Any], sinter.Task]
+    description: Any
+    options: SamplerOptions
+    shared_graph: Optional[SharedMatchingGraph]
+    num_shots: int
+
+
+@dataclasses.dataclass(frozen=True)
+class _WorkResult:
+    """What a worker sends back for a `_Work`."""
+    stats: sinter.TaskStats
+    counters: Optional[DecodeCounters]
+    paired: List[sinter.TaskStats]
+    disagreements: List[DecoderDisagreements]
+
+
+def _cached_sampler(work: _Work) -> Union[TaskSampler, MultiDecoderSampler]:
+    key = json.dumps([
+        getattr(work.task_factory, '__qualname__', repr(work.task_factory)),
+        work.description,
+        dataclasses.asdict(work.options),
+    ], sort_keys=True)
+    sampler = _SAMPLER_CACHE.get(key)
+    if sampler is None:
+        sampler = work.options.make_sampler(work.task_factory(work.description), shared_graph=work.shared_graph)
+        _SAMPLER_CACHE[key] = sampler
+        while len(_SAMPLER_CACHE) > _SAMPLER_CACHE_SIZE:
+            _SAMPLER_CACHE.popitem(last=False)
+    else:
+        _SAMPLER_CACHE.move_to_end(key)
+    return sampler
+
+
+def _sample_work(work: _Work) -> _WorkResult:
+    sampler = _cached_sampler(work)
+    before = sampler.decode_counters
+    if isinstance(sampler, MultiDecoderSampler):
+        all_stats, disagreements = sampler.sample(work.num_shots)
+        stats, *paired = sampler.task_stats(all_stats)
+    else:
+        stats = sampler.task_stats(sampler.sample(work.num_shots))
+        paired = []
+        disagreements = []
+    counters = None if before is None else sampler.decode_counters - before
+    return _WorkResult(stats=stats, counters=counters, paired=paired, disagreements=disagreements)
+
+
+def run_collection_worker(address: Address, *, authkey: bytes, connect_timeout: float = 60) -> int:
+    """Samples batches leased by a `collect_task_stats` coordinator until the collection is done.
+
+    Args:
+        address: The coordinator's address (see `CoordinatorOptions`).
+        authkey: The coordinator's key.
+        connect_timeout: How long to keep retrying to connect (e.g. while the coordinator starts).
+
+    Returns:
+        The number of batches sampled.
+    """
+    return work_on_leases(address, authkey=authkey, handle=_sample_work, connect_timeout=connect_timeout)
+
+
+@dataclasses.dataclass
+class CollectionProgress:
+    """Passed to collection policies and progress callbacks after each finished batch.
+
+    Attributes:
+        tasks: The state of every task.
+        new_stats: The stats of the batch that just finished.
+        new_index: The index (into tasks) of the task the batch belongs to.
+    """
+    tasks: List[CollectionTask]
+    new_stats: sinter.TaskStats
+    new_index: int
+
+
+class _Scheduler:
+    """Chooses the batches of a collection to sample next, and tallies their results.
+
+    It doesn't depend on how batches reach the workers, which is up to `_run_in_process`,
+    `_run_in_pool` or `_run_coordinator`.
+    """
+
+    def __init__(self,
+                 *,
+                 tasks: List[CollectionTask],
+                 task_factory: Callable[[Any], sinter.Task],
+                 options: SamplerOptions,
+                 start_batch_size: int,
+                 max_batch_size: int,
+                 on_stats: Optional[Callable[[sinter.TaskStats], None]],
+                 on_paired_stats: Optional[Callable[[sinter.TaskStats], None]],
+                 on_disagreements: Optional[Callable[[DecoderDisagreements], None]],
+                 policy: Optional[Callable[[CollectionProgress], None]],
+                 prioritize: Optional[Callable[[List[CollectionTask]], List[int]]]):
+        self.tasks = tasks
+        self.task_factory = task_factory
+        self.options = options
+        self.start_batch_size = start_batch_size
+        self.max_batch_size = max_batch_size
+        self.on_stats = on_stats
+        self.on_paired_stats = on_paired_stats
+        self.on_disagreements = on_disagreements
+        self.policy = policy
+        self.prioritize = prioritize
+        self._batch_sizes = [start_batch_size] * len(tasks)
+        self._in_flight = collections.Counter()
+        self._shared: Dict[int, Tuple[shared_memory.SharedMemory, SharedMatchingGraph]] = {}
+
+    def _shared_graph(self, index: int) -> Optional[SharedMatchingGraph]:
+        if not self.options.share_graphs:
+            return None
+        if index not in self._shared:
+            sampler = TaskSampler(
+                self.task_factory(self.tasks[index].description),
+                decoder=self.options.decoder,
+                dem_cache=self.options.dem_cache())
+            self._shared[index] = sampler.share()
+        return self._shared[index][1]
+
+    def _release_shared_graphs(self) -> None:
+        # Release the shared graphs of finished tasks (including tasks a policy stopped).
+        for index in list(self._shared):
+            if self.tasks[index].done and self._in_flight[index] == 0:
+                block, _ = self._shared.pop(index)
+                block.close()
+                block.unlink()
+
+    def next_work(self, prefer: Collection[int] = ()) -> Optional[_Work]:
+        """The next batch to sample, or None when no task needs more shots right now.
+
+        Args:
+            prefer: Indices of tasks to hand out before the others, when they need more shots
+                (e.g. the tasks whose samplers the requesting worker has cached).
+        """
+        tasks = self.tasks
+        in_flight = self._in_flight
+        order = self.prioritize(tasks) if self.prioritize is not None else sorted(
+            range(len(tasks)), key=lambda i: (in_flight[i] > 0, tasks[i].stats.shots))
+        if prefer:
+            order = sorted(order, key=lambda i: i not in prefer)
+        for i in order:
+            task = tasks[i]
+            # Don't overshoot the limits with shots that are already being taken.
+            left = task.shots_left - in_flight[i]
+            # At most double the number of shots whose results are known.
+            left = min(left, max(self.start_batch_size, task.stats.shots) - in_flight[i])
+            if task.stats.errors:
+                # Don't take many more shots than the observed error rate says are needed to reach the error limit.
+                errors_left = task.max_errors - task.stats.errors
+                left = min(left, max(self.start_batch_size, int(errors_left * task.stats.shots / task.stats.errors * 1.1)) - in_flight[i])
+            if left <= 0:
+                continue
+            shots = min(left, self._batch_sizes[i])
+            self._batch_sizes[i] = min(self.max_batch_size, self._batch_sizes[i] * 2)
+            in_flight[i] += shots
+            return _Work(
+                index=i,
+                task_factory=self.task_factory,
+                description=task.description,
+                options=self.options,
+                shared_graph=self._shared_graph(i),
+                num_shots=shots)
+        return None
+
+    def finish(self, work: _Work, result: _WorkResult) -> None:
+        """Tallies the result of a batch, and runs the callbacks and policy."""
+        task = self.tasks[work.index]
+        self._in_flight[work.index] -= work.num_shots
+        task.stats += result.stats.to_anon_stats()
+        if result.counters is not None:
+            task.decode_counters += result.counters
+        for paired_stats in result.paired:
+            total = task.paired_stats.get(paired_stats.decoder, sinter.AnonTaskStats())
+            task.paired_stats[paired_stats.decoder] = total + paired_stats.to_anon_stats()
+        for d in result.disagreements:
+            pair = (d.decoder, d.other_decoder)
+            prev = task.disagreements.get(pair)
+            task.disagreements[pair] = d if prev is None else prev + d
+        if self.on_stats is not None:
+            self.on_stats(result.stats)
+        if self.on_paired_stats is not None:
+            for paired_stats in result.paired:
+                self.on_paired_stats(paired_stats)
+        if self.on_disagreements is not None:
+            for d in result.disagreements:
+                self.on_disagreements(d)
+        if self.policy is not None:
+            self.policy(CollectionProgress(tasks=self.tasks, new_stats=result.stats, new_index=work.index))
+        self._release_shared_graphs()
+
+    def expire(self, work: _Work) -> None:
+        """Forgets a batch whose result will never come."""
+        self._in_flight[work.index] -= work.num_shots
+
+    def close(self) -> None:
+        for block, _ in self._shared.values():
+            block.close()
+            block.unlink()
+        self._shared.clear()
+
+
+def _run_in_process(scheduler: _Scheduler) -> None:
+    while True:
+        work = scheduler.next_work()
+        if work is None:
+            break
+        scheduler.finish(work, _sample_work(work))
+
+
+def _pool_worker(inbox: 'multiprocessing.Queue', outbox: 'multiprocessing.Queue') -> None:
+    """Samples the batches put in a worker's inbox, until it gets None."""
+    while True:
+        item = inbox.get()
+        if item is None:
+            return
+        batch_id, work = item
+        try:
+            outbox.put((batch_id, _sample_work(work), None))
+        except Exception as ex:
+            outbox.put((batch_id, None, ex))
+
+
+def _run_in_pool(scheduler: _Scheduler, num_workers: int) -> None:
+    if scheduler.options.share_graphs:
+        # Workers attaching to shared memory register it with the resource tracker, which must be
+        # the one of this process (started before the workers) so the blocks are only unlinked here.
+        resource_tracker.ensure_running()
+    # Every worker has its own inbox, so the batches of a task keep going to a worker that has its
+    # sampler cached (see `_SAMPLER_CACHE`) instead of whichever worker is free rebuilding it.
+    outbox: 'multiprocessing.Queue' = multiprocessing.Queue()
+    inboxes: List['multiprocessing.Queue'] = [multiprocessing.Queue() for _ in range(num_workers)]
+    workers = [
+        multiprocessing.Process(target=_pool_worker, args=(inbox, outbox), daemon=True)
+        for inbox in inboxes
+    ]
+    for worker in workers:
+        worker.start()
+    # The tasks each worker most recently sampled, mirroring its sampler cache.
+    cached: List['collections.OrderedDict[int, None]'] = [collections.OrderedDict() for _ in workers]
+    queued = [0] * num_workers
+    pending: Dict[int, Tuple[int, _Work]] = {}
+    batch_ids = itertools.count()
+    try:
+        while True:
+            # Keep every worker busy, with one batch queued up behind it.
+            for w in range(num_workers):
+                while queued[w] < 2:
+                    work = scheduler.next_work(prefer=cached[w])
+                    if work is None:
+                        break
+                    cached[w][work.index] = None
+                    cached[w].move_to_end(work.index)
+                    while len(cached[w]) > _SAMPLER_CACHE_SIZE:
+                        cached[w].popitem(last=False)
+                    batch_id = next(batch_ids)
+                    pending[batch_id] = (w, work)
+                    inboxes[w].put((batch_id, work))
+                    queued[w] += 1
+            if not pending:
+                break
+            batch_id, result, error = outbox.get()
+            w, work = pending.pop(batch_id)
+            queued[w] -= 1
+            if error is not None:
+                raise error
+            scheduler.finish(work, result)
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+def _run_coordinator(scheduler: _Scheduler, coordinator: CoordinatorOptions, num_workers: int) -> None:
+    # Start the local workers before the server's thread, so they aren't forked while it runs.
+    workers = [
+        multiprocessing.Process(
+            target=run_collection_worker,
+            args=(coordinator.address,),
+            kwargs=dict(authkey=coordinator.authkey),
+            daemon=True)
+        for _ in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    server = None
+    try:
+        server = LeaseServer(coordinator.address, authkey=coordinator.authkey, lease_seconds=coordinator.lease_seconds)
+        server.serve(
+            next_work=scheduler.next_work,
+            on_result=scheduler.finish,
+            on_expired=scheduler.expire)
+    finally:
+        if server is not None:
+            server.close()
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+
+
+def collect_task_stats(
+        *,
+        descriptions: Iterable[Any],
+        task_factory: Callable[[Any], sinter.Task],
+        num_workers: int,
+        max_shots: int,
+        max_errors: int,
+        options: SamplerOptions = SamplerOptions(),
+        existing_stats: Iterable[sinter.TaskStats] = (),
+        metadata_func: Callable[[Any], Any] = lambda description: description,
+        start_batch_size: int = 100,
+        max_batch_size: int = 100_000,
+        on_stats: Optional[Callable[[sinter.TaskStats], None]] = None,
+        on_paired_stats: Optional[Callable[[sinter.TaskStats], None]] = None,
+        on_disagreements: Optional[Callable[[DecoderDisagreements], None]] = None,
+        policy: Optional[Callable[[CollectionProgress], None]] = None,
+        prioritize: Optional[Callable[[List[CollectionTask]], List[int]]] = None,
+        coordinator: Optional[CoordinatorOptions] = None,
+        ) -> List[CollectionTask]:
+    """Samples tasks in worker processes until each one reaches its stopping condition.
+
+    Unlike `sinter.collect`, tasks are sent to the workers as descriptions (which the workers expand
+    with `task_factory`, caching the result), and the stopping rules are open to the caller: a
+    `policy` can stop tasks early (by setting `stopped`) or change their limits after every batch,
+    and `prioritize` chooses which tasks get the next batches.
+
+    Args:
+        descriptions: Picklable task descriptions.
+        task_factory: Picklable (e.g. module level) function expanding a description into a task.
+        num_workers: Number of worker processes. 0 samples in this process (useful for tests).
+        max_shots: Default shot limit of each task.
+        max_errors: Default error limit of each task.
+        options: How the workers sample and decode shots. With paired decoders, their stats are
+            passed to `on_paired_stats` (not `on_stats`, so they aren't mixed with the main
+            decoder's stats) and tallied in each task's `paired_stats`, and the disagreements of
+            each pair of decoders are passed to `on_disagreements` and tallied in each task's
+            `disagreements`. The stopping conditions only look at the main decoder's stats, so it
+            should be the decoder that needs the most shots.
+        existing_stats: Previously collected stats. They count towards the limits of tasks with the
+            same decoder and metadata.
+        metadata_func: Returns the json metadata a description's task will have (used to match
+            existing stats without building circuits).
+        start_batch_size: Shots in a task's first batch. Later batches double, up to max_batch_size.
+        max_batch_size: Largest number of shots in one batch.
+        on_stats: Called with the stats of each finished batch (e.g. to append them to a CSV file).
+        on_paired_stats: Called with the stats of each paired decoder for each finished batch.
+        on_disagreements: Called with the disagreements of each finished batch, with paired decoders.
+        policy: Called after each finished batch, and may adjust the tasks.
+        prioritize: Returns the indices of tasks that should be sampled next, in order of priority.
+            Defaults to tasks in order, preferring tasks with fewer shots.
+        coordinator: If not None, this process coordinates the collection over a socket: workers
+            started with `run_collection_worker`, on this machine or others, lease batches and
+            report their stats. `num_workers` local workers are started too.
+
+    Returns:
+        The final state of each task.
+    """
+    if coordinator is not None and options.share_graphs:
+        raise ValueError("Coordinated workers can't attach to this machine's shared memory.")
+    existing: Dict[str, sinter.AnonTaskStats] = collections.defaultdict(sinter.AnonTaskStats)
+    for stat in existing_stats:
+        existing[metadata_key(stat.decoder, stat.json_metadata)] += stat.to_anon_stats()
+
+    tasks = [
+        CollectionTask(
+            description=description,
+            stats=existing[metadata_key(options.decoder, metadata_func(description))],
+            max_shots=max_shots,
+            max_errors=max_errors,
+        )
+        for description in descriptions
+    ]
+    scheduler = _Scheduler(
+        tasks=tasks,
+        task_factory=task_factory,
+        options=options,
+        start_batch_size=start_batch_size,
+        max_batch_size=max_batch_size,
+        on_stats=on_stats,
+        on_paired_stats=on_paired_stats,
+        on_disagreements=on_disagreements,
+        policy=policy,
+        prioritize=prioritize)
+    try:
+        if coordinator is not None:
+            _run_coordinator(scheduler, coordinator, num_workers)
+        elif num_workers == 0:
+            _run_in_process(scheduler)
+        else:
+            _run_in_pool(scheduler, num_workers)
+        return tasks
+    finally:
+        scheduler.close()
@@ -0,0 +1,258 @@
+import dataclasses
+import functools
+import multiprocessing
+import time
+from multiprocessing import connection
+
+import pytest
+import sinter
+
+from parsurf.circuits.task_factory import task_from_description
+from parsurf.tools._collection import collect_task_stats, CoordinatorOptions, DecoderDisagreements, \
+    DISAGREEMENTS_CSV_HEADER, MultiDecoderSampler, read_disagreements_csv, read_stats_csv, SamplerOptions, TaskSampler
+
+
+def test_task_sampler():
+    task = task_from_description({'c': 'chao', 'b': 'X', 'd': 3, 'r': 6, 'p': 0.01})
+    sampler = TaskSampler(task)
+    stats = sampler.task_stats(sampler.sample(1000))
+    assert stats.shots == 1000
+    assert 0 < stats.errors < 500
+    assert stats.json_metadata == task.json_metadata
+    assert stats.strong_id == sinter.Task(
+        circuit=task.circuit,
+        decoder='pymatching',
+        detector_error_model=sinter.worker.auto_dem(task.circuit),
+        json_metadata=task.json_metadata,
+    ).strong_id()
+
+    # A small memory budget splits the batch into chunks.
+    circuit = task.circuit
+    bytes_per_shot = 2 * ((circuit.num_detectors + circuit.num_observables + 7) // 8) + (circuit.num_measurements + 1) // 2
+    chunked = TaskSampler(task, batch_memory_bytes=100 * bytes_per_shot)
+    assert list(chunked.chunk_sizes(250)) == [100, 100, 50]
+    assert chunked.sample(250).shots == 250
+
+
+def test_collect_task_stats():
+    descriptions = [
+        {'c': 'chao', 'b': 'X', 'd': 3, 'r': 6, 'p': 0.01},
+        {'c': 'chao', 'b': 'X', 'd': 3, 'r': 6, 'p': 0.001},
+        {'c': 'chao', 'b': 'Z', 'd': 3, 'r': 6, 'p': 0.001},
+    ]
+    existing = sinter.TaskStats(
+        strong_id='x',
+        decoder='pymatching',
+        json_metadata=descriptions[1],
+        shots=4000,
+        errors=5,
+        discards=0,
+        seconds=1,
+    )
+    written = []
+
+    def policy(progress):
+        if progress.new_index == 2:
+            progress.tasks[2].stopped = 'test'
+
+    tasks = collect_task_stats(
+        descriptions=descriptions,
+        task_factory=task_from_description,
+        num_workers=0,
+        max_shots=5000,
+        max_errors=50,
+        existing_stats=[existing],
+        on_stats=written.append,
+        policy=policy,
+    )
+    assert all(task.done for task in tasks)
+    # Stopped by reaching the error limit.
+    assert tasks[0].stats.errors >= 50
+    assert tasks[0].stats.shots < 5000
+    # Stopped by reaching the shot limit, counting the existing stats.
+    assert tasks[1].stats.shots == 5000
+    assert sum(s.shots for s in written if s.json_metadata['p'] == 0.001 and s.json_metadata['b'] == 'X') == 1000
+    # Stopped by the policy.
+    assert tasks[2].stopped == 'test'
+    assert tasks[2].stats.shots == 100
+
+
+def test_collect_task_stats_sharing_graphs():
+    descriptions = [
+        {'c': 'chao', 'b': 'X', 'd': 3, 'r': 6, 'p': 0.01},
+        {'c': 'chao', 'b': 'Z', 'd': 3, 'r': 6, 'p': 0.01},
+    ]
+    written = []
+    tasks = collect_task_stats(
+        descriptions=descriptions,
+        task_factory=task_from_description,
+        num_workers=2,
+        max_shots=1000,
+        max_errors=10**6,
+        on_stats=written.append,
+        options=SamplerOptions(share_graphs=True),
+    )
+    assert [task.stats.shots for task in tasks] == [1000, 1000]
+    assert {s.strong_id for s in written} == {TaskSampler(task_from_description(d)).strong_id for d in descriptions}
+
+
+def _logged_task_from_description(log_path, description):
+    with open(log_path, 'a') as f:
+        print(description['p'], file=f)
+    return task_from_description(description)
+
+
+def test_collect_task_stats_keeps_tasks_on_workers(tmp_path):
+    descriptions = [{'c': 'chao', 'b': 'X', 'd': 3, 'r': 6, 'p': p} for p in [0.001, 0.002, 0.003, 0.004, 0.005, 0.006]]
+    log_path = tmp_path / 'builds.txt'
+    tasks = collect_task_stats(
+        descriptions=descriptions,
+        task_factory=functools.partial(_logged_task_from_description, log_path),
+        num_workers=2,
+        max_shots=10_000,
+        max_errors=10**6,
+        max_batch_size=1000,
+    )
+    assert [task.stats.shots for task in tasks] == [10_000] * len(descriptions)
+    # Batches of a task go to a worker that has its sampler cached, instead of rebuilding it.
+    builds = log_path.read_text().split()
+    assert len(builds) <= 2 * len(descriptions)
+
+
+def test_sampler_options_reject_unsupported_combinations():
+    assert SamplerOptions(paired_decoders=['pymatching:window=1+1']).paired_decoders == ('pymatching:window=1+1',)
+    with pytest.raises(NotImplementedError):
+        SamplerOptions(decoder='fusion_blossom')
+    with pytest.raises(ValueError):
+        SamplerOptions(paired_decoders=('pymatching',))
+    with pytest.raises(NotImplementedError):
+        SamplerOptions(share_graphs=True, paired_decoders=('pymatching:window=1+1',))
+    with pytest.raises(NotImplementedError):
+        SamplerOptions(decoder='pymatching:window=2+2', share_graphs=True)
+    with pytest.raises(ValueError):
+        collect_task_stats(
+            descriptions=[],
+            task_factory=task_from_description,
+            num_workers=0,
+            max_shots=1,
+            max_errors=1,
+            options=SamplerOptions(share_graphs=True),
+            coordinator=CoordinatorOptions(address='unused', authkey=b'test'))
+
+
+def test_multi_decoder_sampler():
+    task = task_from_description({'c': 'chao', 'b': 'X', 'd': 5, 'r': 10, 'p': 0.005})
+    decoders = ['pymatching', 'pymatching:window=2+2', 'pymatching:window=1+1']
+    sampler = MultiDecoderSampler(task, decoders=decoders)
+    stats, disagreements = sampler.sample(2000)
+    labelled = sampler.task_stats(stats)
+    assert [s.decoder for s in labelled] == decoders
+    assert {s.shots for s in labelled} == {2000}
+    assert labelled[0].strong_id == TaskSampler(task).strong_id
+    assert len({s.strong_id for s in labelled}) == len(labelled)
+    assert [(d.decoder, d.other_decoder) for d in disagreements] == [
+        ('pymatching', 'pymatching:window=2+2'),
+        ('pymatching', 'pymatching:window=1+1'),
+        ('pymatching:window=2+2', 'pymatching:window=1+1'),
+    ]
+    for (i, j), d in zip(sampler.pairs, disagreements):
+        assert d.shots == 2000
+        assert d.json_metadata == task.json_metadata
+        # One observable, so disagreeing shots are the shots exactly one of the two decoders got wrong.
+        assert abs(stats[i].errors - stats[j].errors) <= d.disagreements <= stats[i].errors + stats[j].errors
+        assert (d.disagreements + stats[i].errors - stats[j].errors) % 2 == 0
+    assert disagreements[0].disagreements > 0
+
+
+def test_decoder_disagreements_csv_round_trip(tmp_path):
+    a = DecoderDisagreements(
+        decoder='pymatching',
+        other_decoder='pymatching:window=2+2',
+        json_metadata={'c': 'chao', 'p': 0.001},
+        shots=100,
+        disagreements=3)
+    b = dataclasses.replace(a, json_metadata={'c': 'chao', 'p': 0.002})
+    path = tmp_path / 'disagreements.csv'
+    path.write_text(DISAGREEMENTS_CSV_HEADER + '\n' + a.to_csv_line() + '\n' + b.to_csv_line() + '\n')
+    assert read_disagreements_csv(path) == [a, b]
+    assert a + a == dataclasses.replace(a, shots=200, disagreements=6)
+    with pytest.raises(ValueError):
+        _ = a + b
+
+
+def test_collect_task_stats_with_paired_decoders():
+    written = []
+    paired = []
+    disagreements = []
+    tasks = collect_task_stats(
+        descriptions=[{'c': 'chao', 'b': 'X', 'd': 3, 'r': 6, 'p': 0.01}],
+        task_factory=task_from_description,
+        num_workers=0,
+        max_shots=1000,
+        max_errors=10**6,
+        options=SamplerOptions(paired_decoders=('pymatching:window=1+1',)),
+        on_stats=written.append,
+        on_paired_stats=paired.append,
+        on_disagreements=disagreements.append,
+    )
+    pair = ('pymatching', 'pymatching:window=1+1')
+    assert tasks[0].stats.shots == 1000
+    assert {decoder: stats.shots for decoder, stats in tasks[0].paired_stats.items()} == {'pymatching:window=1+1': 1000}
+    assert {s.decoder for s in written} == {'pymatching'}
+    assert {s.decoder for s in paired} == {'pymatching:window=1+1'}
+    assert sum(s.errors for s in paired) == tasks[0].paired_stats['pymatching:window=1+1'].errors
+    assert list(tasks[0].disagreements) == [pair]
+    assert tasks[0].disagreements[pair].shots == sum(d.shots for d in disagreements) == 1000
+    assert tasks[0].disagreements[pair].disagreements == sum(d.disagreements for d in disagreements)
+
+
+def _lose_a_lease(address):
+    # A worker that disconnects right after taking a lease.
+    while True:
+        try:
+            conn = connection.Client(address, authkey=b'test')
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            time.sleep(0.01)
+    conn.send(('request',))
+    conn.recv()
+    conn.close()
+
+
+def test_collect_task_stats_coordinated(tmp_path):
+    descriptions = [
+        {'c': 'chao', 'b': 'X', 'd': 3, 'r': 6, 'p': 0.01},
+        {'c': 'chao', 'b': 'Z', 'd': 3, 'r': 6, 'p': 0.01},
+    ]
+    address = str(tmp_path / 'coordinator.sock')
+    rogue = multiprocessing.Process(target=_lose_a_lease, args=(address,), daemon=True)
+    rogue.start()
+    written = []
+    tasks = collect_task_stats(
+        descriptions=descriptions,
+        task_factory=task_from_description,
+        num_workers=2,
+        max_shots=3000,
+        max_errors=10**6,
+        max_batch_size=500,
+        on_stats=written.append,
+        coordinator=CoordinatorOptions(address=address, authkey=b'test'),
+    )
+    rogue.join(timeout=10)
+    assert [task.stats.shots for task in tasks] == [3000, 3000]
+    assert sum(s.shots for s in written) == 6000
+
+
+def test_read_stats_csv(tmp_path):
+    stats = sinter.TaskStats(
+        strong_id='abc',
+        decoder='pymatching',
+        json_metadata={'c': 'chao', 'd': 3, 'p': 0.001},
+        shots=1000,
+        errors=3,
+        discards=0,
+        seconds=1.5,
+    )
+    path = tmp_path / 'stats.csv'
+    path.write_text(f'{sinter.CSV_HEADER}\n{stats.to_csv_line()}\n{stats.to_csv_line()}\n')
+    assert read_stats_csv(path) == [stats, stats]
@@ -0,0 +1,239 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import collections
+import dataclasses
+import itertools
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import connection
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_address(text: str) -> Address:
+    """Parses 'host:port' into a TCP address, and anything containing a '/' into a Unix socket path."""
+    if '/' in text:
+        return text
+    host, sep, port = text.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError(f'Expected HOST:PORT or a Unix socket path, but got {text!r}.')
+    return host, int(port)
+
+
+@dataclasses.dataclass
+class _Lease:
+    work: Any
+    conn: connection.Connection
+    deadline: float
+
+
+class LeaseServer:
+    """Hands out work items to workers connecting over a socket, and collects their results.
+
+    Each item is leased to one worker at a time. A lease is given up when the worker's connection
+    drops (e.g. the worker process died) or when it isn't returned within `lease_seconds` (e.g. the
+    worker's machine went down), and the work's owner is told (with `on_expired`) so it can hand out
+    the work again. Results of given up leases are ignored, so no result is counted twice.
+
+    Messages are pickled, and connections are authenticated with `authkey`, which every worker must
+    know. Only serve on networks where everyone who knows the key is trusted.
+    """
+
+    def __init__(self, address: Address, *, authkey: bytes, lease_seconds: float = 3600):
+        """
+        Args:
+            address: A (host, port) pair for TCP (port 0 picks a free port), or a Unix socket path.
+            authkey: The key connecting workers must have.
+            lease_seconds: How long a worker may hold a lease before it's given up.
+        """
+        self.lease_seconds = lease_seconds
+        self._authkey = authkey
+        self._closing = False
+        self._listener = connection.Listener(address, authkey=authkey)
+        self._new_conns: 'queue.Queue[connection.Connection]' = queue.Queue()
+        self._accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._accept_thread.start()
+        self.expired_leases = 0
+
+    @property
+    def address(self) -> Address:
+        """The address workers connect to (with the actual port, when serving on port 0)."""
+        return self._listener.address
+
+    def _accept_loop(self) -> None:
+        while True:
+            try:
+                conn = self._listener.accept()
+            except connection.AuthenticationError:
+                continue
+            except OSError:
+                # The listener was closed.
+                return
+            if self._closing:
+                conn.close()
+                return
+            self._new_conns.put(conn)
+
+    def serve(self,
+              *,
+              next_work: Callable[[], Optional[Any]],
+              on_result: Callable[[Any, Any], None],
+              on_expired: Callable[[Any], None],
+              poll_seconds: float = 0.1) -> None:
+        """Leases work to workers until `next_work` runs out and every lease was returned or given up.
+
+        Args:
+            next_work: Returns the next work item, or None when there is none (right now). Called
+                when a worker is waiting for work.
+            on_result: Called with each work item and the result a worker returned for it.
+            on_expired: Called with each work item whose lease was given up.
+            poll_seconds: How often to check for new connections and overdue leases.
+
+        Raises:
+            RuntimeError: A worker reported that it failed on a work item.
+        """
+        leases: Dict[int, _Lease] = {}
+        lease_ids = itertools.count()
+        conns: List[connection.Connection] = []
+        waiting: 'collections.deque[connection.Connection]' = collections.deque()
+        ready: 'collections.deque[Any]' = collections.deque()
+
+        def drop(conn: connection.Connection) -> None:
+            conns.remove(conn)
+            if conn in waiting:
+                waiting.remove(conn)
+            for lease_id, lease in list(leases.items()):
+                if lease.conn is conn:
+                    del leases[lease_id]
+                    self.expired_leases += 1
+                    on_expired(lease.work)
+            conn.close()
+
+        try:
+            while True:
+                while not self._new_conns.empty():
+                    conns.append(self._new_conns.get())
+
+                now = time.monotonic()
+                for lease_id, lease in list(leases.items()):
+                    if lease.deadline < now:
+                        del leases[lease_id]
+                        self.expired_leases += 1
+                        on_expired(lease.work)
+
+                while waiting:
+                    work = ready.popleft() if ready else next_work()
+                    if work is None:
+                        break
+                    conn = waiting.popleft()
+                    lease_id = next(lease_ids)
+                    try:
+                        conn.send(('lease', lease_id, work))
+                    except OSError:
+                        ready.append(work)
+                        drop(conn)
+                        continue
+                    leases[lease_id] = _Lease(work=work, conn=conn, deadline=time.monotonic() + self.lease_seconds)
+
+                if not leases and not ready:
+                    work = next_work()
+                    if work is None:
+                        break
+                    ready.append(work)
+
+                for conn in connection.wait(conns, timeout=poll_seconds):
+                    try:
+                        message = conn.recv()
+                    except (EOFError, OSError):
+                        drop(conn)
+                        continue
+                    kind = message[0]
+                    if kind == 'request':
+                        waiting.append(conn)
+                    elif kind == 'result':
+                        _, lease_id, result = message
+                        lease = leases.get(lease_id)
+                        if lease is not None and lease.conn is conn:
+                            del leases[lease_id]
+                            on_result(lease.work, result)
+                    elif kind == 'error':
+                        _, lease_id, message = message
+                        lease = leases.get(lease_id)
+                        raise RuntimeError(f'A worker failed on {None if lease is None else lease.work}:\n{message}')
+                    else:
+                        raise ValueError(f'Unexpected message from a worker: {message!r}')
+
+            for conn in waiting:
+                try:
+                    conn.send(('done',))
+                except OSError:
+                    pass
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def close(self) -> None:
+        self._closing = True
+        if self._accept_thread.is_alive():
+            # Closing the listener doesn't interrupt a blocked accept, so wake it with a connection.
+            try:
+                connection.Client(self.address, authkey=self._authkey).close()
+            except OSError:
+                pass
+            self._accept_thread.join(timeout=10)
+        self._listener.close()
+        while not self._new_conns.empty():
+            self._new_conns.get().close()
+
+
+def work_on_leases(address: Address,
+                   *,
+                   authkey: bytes,
+                   handle: Callable[[Any], Any],
+                   connect_timeout: float = 60) -> int:
+    """Connects to a `LeaseServer`, and handles the work it leases until it has none left.
+
+    Args:
+        address: The server's address.
+        authkey: The server's key.
+        handle: Computes the result of a work item.
+        connect_timeout: How long to keep retrying to connect (e.g. while the server starts).
+
+    Returns:
+        The number of work items handled.
+    """
+    deadline = time.monotonic() + connect_timeout
+    while True:
+        try:
+            conn = connection.Client(address, authkey=authkey)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+    handled = 0
+    with conn:
+        while True:
+            try:
+                conn.send(('request',))
+                message = conn.recv()
+            except (EOFError, OSError):
+                # The server finished (or went away).
+                break
+            if message[0] == 'done':
+                break
+            _, lease_id, work = message
+            try:
+                result = handle(work)
+            except Exception:
+                conn.send(('error', lease_id, traceback.format_exc()))
+                raise
+            try:
+                conn.send(('result', lease_id, result))
+            except OSError:
+                break
+            handled += 1
+    return handled
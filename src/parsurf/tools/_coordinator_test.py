@@ -0,0 +1,96 @@
+import threading
+import time
+from multiprocessing import connection
+
+import pytest
+
+from parsurf.tools import LeaseServer, parse_address, work_on_leases
+
+
+def test_parse_address():
+    assert parse_address('localhost:1234') == ('localhost', 1234)
+    assert parse_address('/tmp/x.sock') == '/tmp/x.sock'
+    with pytest.raises(ValueError):
+        parse_address('localhost')
+
+
+def _take_lease(address, authkey: bytes):
+    conn = connection.Client(address, authkey=authkey)
+    conn.send(('request',))
+    kind, lease_id, work = conn.recv()
+    assert kind == 'lease'
+    return conn, lease_id
+
+
+def test_lease_server_reassigns_lost_leases(tmp_path):
+    server = LeaseServer(str(tmp_path / 'socket'), authkey=b'key', lease_seconds=1)
+    todo = list(range(20))
+    results = []
+    expired = []
+
+    def next_work():
+        return todo.pop() if todo else None
+
+    def on_expired(work):
+        expired.append(work)
+        todo.append(work)
+
+    serving = threading.Thread(target=server.serve, kwargs=dict(
+        next_work=next_work,
+        on_result=lambda work, result: results.append((work, result)),
+        on_expired=on_expired))
+    serving.start()
+    try:
+        # A worker that dies holding a lease, and one that hangs past its lease.
+        dead, _ = _take_lease(server.address, b'key')
+        dead.close()
+        hung, lease_id = _take_lease(server.address, b'key')
+        time.sleep(1.5)
+        # The hung worker's late result is dropped.
+        hung.send(('result', lease_id, 'late'))
+        hung.close()
+
+        handled = []
+        workers = [
+            threading.Thread(target=lambda: handled.append(
+                work_on_leases(server.address, authkey=b'key', handle=lambda work: work * 10)))
+            for _ in range(2)
+        ]
+        for worker in workers:
+            worker.start()
+        serving.join(timeout=30)
+        assert not serving.is_alive()
+    finally:
+        server.close()
+    for worker in workers:
+        worker.join(timeout=30)
+
+    assert len(expired) == 2
+    assert sorted(results) == [(k, k * 10) for k in range(20)]
+    assert sum(handled) == 20
+
+
+def test_lease_server_rejects_wrong_key(tmp_path):
+    server = LeaseServer(('localhost', 0), authkey=b'key')
+    try:
+        with pytest.raises(connection.AuthenticationError):
+            connection.Client(server.address, authkey=b'other')
+    finally:
+        server.close()
+
+
+def test_lease_server_reports_worker_errors(tmp_path):
+    server = LeaseServer(str(tmp_path / 'socket'), authkey=b'key')
+    todo = [1]
+
+    def fail(work):
+        raise ValueError('bad work')
+
+    worker = threading.Thread(target=lambda: pytest.raises(ValueError, work_on_leases, server.address, authkey=b'key', handle=fail))
+    worker.start()
+    try:
+        with pytest.raises(RuntimeError, match='bad work'):
+            server.serve(next_work=lambda: todo.pop() if todo else None, on_result=None, on_expired=None)
+    finally:
+        server.close()
+        worker.join()
@@ -0,0 +1,185 @@
+from typing import Callable
+
+import collections
+import dataclasses
+
+import numpy as np
+
+from parsurf.tools._bit_batch import fit_packed_width, pack_bits, popcount_rows, unpack_bits
+
+
+@dataclasses.dataclass
+class DecodeCounters:
+    """Counts how the shots given to a `SyndromeCachingDecoder` were decoded.
+
+    Attributes:
+        shots: Shots given to the decoder.
+        zero_syndromes: Shots without detection events (predicted without decoding).
+        cache_hits: Shots whose syndrome was found in the cache, or repeated an earlier shot of the
+            same batch.
+        decoded: Shots passed to the underlying decoder.
+    """
+    shots: int = 0
+    zero_syndromes: int = 0
+    cache_hits: int = 0
+    decoded: int = 0
+
+    def __add__(self, other: 'DecodeCounters') -> 'DecodeCounters':
+        return DecodeCounters(
+            shots=self.shots + other.shots,
+            zero_syndromes=self.zero_syndromes + other.zero_syndromes,
+            cache_hits=self.cache_hits + other.cache_hits,
+            decoded=self.decoded + other.decoded,
+        )
+
+    def __sub__(self, other: 'DecodeCounters') -> 'DecodeCounters':
+        return DecodeCounters(
+            shots=self.shots - other.shots,
+            zero_syndromes=self.zero_syndromes - other.zero_syndromes,
+            cache_hits=self.cache_hits - other.cache_hits,
+            decoded=self.decoded - other.decoded,
+        )
+
+    @property
+    def decoded_fraction(self) -> float:
+        """The fraction of shots that needed the underlying decoder."""
+        return self.decoded / self.shots if self.shots else 0
+
+    def __str__(self) -> str:
+        return (f'{self.shots} shots: {self.zero_syndromes} without detection events, '
+                f'{self.cache_hits} cache hits, {self.decoded} decoded ({self.decoded_fraction:.1%})')
+
+
+class SyndromeCachingDecoder:
+    """Wraps a batch decoder, skipping shots without detection events and memoizing small syndromes.
+
+    At low noise, most shots have no detection events (and are predicted to flip no observables),
+    and many of the rest repeat a few small syndromes. Syndromes with at most `max_cached_weight`
+    detection events are used (bit-packed) as keys of a bounded LRU cache of predictions, and
+    repeated ones within a batch are looked up once. Larger syndromes rarely repeat, so they go
+    straight to the decoder (along with the cache misses, in one call). Decoding is deterministic,
+    so the predictions are the same as the underlying decoder's.
+
+    Shots are handled bit-packed (see `pack_bits`) throughout. With `bit_packed=True`, the wrapped
+    decoder takes and returns bit-packed arrays too, so no shot is ever unpacked.
+    """
+
+    def __init__(self,
+                 decode_batch: Callable[[np.ndarray], np.ndarray],
+                 *,
+                 num_observables: int,
+                 max_cache_size: int = 1 << 16,
+                 max_cached_weight: int = 4,
+                 bypass_fraction: float = 0.75,
+                 min_shots_before_bypass: int = 10_000,
+                 bit_packed: bool = False):
+        """
+        Args:
+            decode_batch: Maps a (shots, detectors) bool array to a (shots, observables) array of
+                predicted observable flips (e.g. `pymatching.Matching.decode_batch`). With
+                `bit_packed`, maps bit-packed shots to bit-packed predictions instead (e.g.
+                `pymatching.Matching.decode_batch` with `bit_packed_shots=True` and
+                `bit_packed_predictions=True`).
+            num_observables: The number of observables predicted by the decoder.
+            max_cache_size: The maximum number of syndromes to remember. 0 disables memoization
+                (shots without detection events are still skipped).
+            max_cached_weight: Syndromes with more detection events than this aren't memoized.
+            bypass_fraction: Once at least `min_shots_before_bypass` shots were seen, if more than
+                this fraction of them needed the decoder, later batches are passed to the decoder
+                whole (e.g. at higher noise, where almost every shot has a unique syndrome).
+            min_shots_before_bypass: See `bypass_fraction`.
+            bit_packed: Whether `decode_batch` takes and returns bit-packed arrays.
+        """
+        self._decode_batch = decode_batch
+        self.num_observables = num_observables
+        self.max_cache_size = max_cache_size
+        self.max_cached_weight = max_cached_weight
+        self.bypass_fraction = bypass_fraction
+        self.min_shots_before_bypass = min_shots_before_bypass
+        self.bit_packed = bit_packed
+        self.counters = DecodeCounters()
+        self._cache: 'collections.OrderedDict[bytes, np.ndarray]' = collections.OrderedDict()
+
+    def decode_batch(self,
+                     dets: np.ndarray,
+                     *,
+                     bit_packed_shots: bool = False,
+                     bit_packed_predictions: bool = False) -> np.ndarray:
+        """Predicts the observable flips of each shot.
+
+        Args:
+            dets: A (shots, detectors) bool array, or a bit-packed (shots, ceil(detectors / 8))
+                uint8 array when `bit_packed_shots`.
+            bit_packed_shots: Whether `dets` is bit-packed (see `pack_bits`).
+            bit_packed_predictions: Whether to return bit-packed predictions.
+
+        Returns:
+            A (shots, observables) bool array, or a bit-packed (shots, ceil(observables / 8)) uint8
+            array when `bit_packed_predictions`.
+        """
+        if bit_packed_shots and not self.bit_packed:
+            raise ValueError('Bit-packed shots need a wrapped decoder taking bit-packed shots.')
+        packed = dets if bit_packed_shots else pack_bits(dets)
+        predictions = self._decode_packed(packed, dets)
+        if bit_packed_predictions:
+            return predictions
+        return unpack_bits(predictions, self.num_observables)
+
+    def _decode_subset(self, packed: np.ndarray, dets: np.ndarray, shots: np.ndarray) -> np.ndarray:
+        """Decodes the given shots with the wrapped decoder. Returns bit-packed predictions."""
+        width = (self.num_observables + 7) // 8
+        if self.bit_packed:
+            return fit_packed_width(np.asarray(self._decode_batch(packed[shots]), dtype=np.uint8), width)
+        decoded = np.asarray(self._decode_batch(dets[shots])).astype(np.bool_).reshape(len(shots), self.num_observables)
+        return pack_bits(decoded)
+
+    def _decode_packed(self, packed: np.ndarray, dets: np.ndarray) -> np.ndarray:
+        num_shots = packed.shape[0]
+        if self.counters.shots >= self.min_shots_before_bypass and self.counters.decoded_fraction > self.bypass_fraction:
+            # Most shots need the decoder anyway, so finding the ones that don't costs more than it saves.
+            self.counters.shots += num_shots
+            self.counters.decoded += num_shots
+            return self._decode_subset(packed, dets, np.arange(num_shots))
+
+        predictions = np.zeros((num_shots, (self.num_observables + 7) // 8), dtype=np.uint8)
+        weights = popcount_rows(packed)
+        self.counters.shots += num_shots
+        self.counters.zero_syndromes += int(np.count_nonzero(weights == 0))
+
+        cached = np.flatnonzero((weights > 0) & (weights <= self.max_cached_weight)) if self.max_cache_size else []
+        to_decode = [np.flatnonzero(weights > (self.max_cached_weight if self.max_cache_size else 0))]
+        num_hits = 0
+        miss_keys = []
+        if len(cached):
+            rows = np.ascontiguousarray(packed[cached]).view(np.dtype((np.void, packed.shape[1]))).reshape(-1)
+            unique_rows, first_shots, inverse = np.unique(rows, return_index=True, return_inverse=True)
+            unique_predictions = np.empty((len(unique_rows), predictions.shape[1]), dtype=np.uint8)
+            misses = []
+            for k, row in enumerate(unique_rows.tolist()):
+                hit = self._cache.get(row)
+                if hit is None:
+                    misses.append(k)
+                    miss_keys.append(row)
+                else:
+                    self._cache.move_to_end(row)
+                    unique_predictions[k] = hit
+            num_hits = len(cached) - len(misses)
+            to_decode.insert(0, cached[first_shots[misses]])
+
+        decode_shots = np.concatenate(to_decode)
+        if len(decode_shots):
+            decoded = self._decode_subset(packed, dets, decode_shots)
+            predictions[decode_shots] = decoded
+        if len(cached):
+            if misses:
+                # The misses were decoded first.
+                unique_predictions[misses] = decoded[:len(misses)]
+                for key, prediction in zip(miss_keys, decoded[:len(misses)]):
+                    self._cache[key] = prediction
+                while len(self._cache) > self.max_cache_size:
+                    self._cache.popitem(last=False)
+            predictions[cached] = unique_predictions[inverse.reshape(-1)]
+
+        self.counters.decoded += len(decode_shots)
+        self.counters.cache_hits += num_hits
+        return predictions
@@ -0,0 +1,71 @@
+import numpy as np
+import pymatching
+import sinter
+import stim
+
+from parsurf.tools import DecodeCounters, SyndromeCachingDecoder, TaskSampler
+
+
+def test_caching_decoder_matches_decoder():
+    circuit = stim.Circuit.generated('surface_code:rotated_memory_x', distance=3, rounds=3, after_clifford_depolarization=0.002)
+    matching = pymatching.Matching.from_detector_error_model(sinter.worker.auto_dem(circuit))
+    calls = []
+
+    def decode_batch(dets):
+        calls.append(len(dets))
+        return matching.decode_batch(dets)
+
+    decoder = SyndromeCachingDecoder(decode_batch, num_observables=1, max_cache_size=100, max_cached_weight=2)
+    for _ in range(3):
+        dets = circuit.compile_detector_sampler().sample(2000)
+        np.testing.assert_array_equal(decoder.decode_batch(dets), matching.decode_batch(dets).astype(np.bool_))
+    c = decoder.counters
+    assert c.shots == 6000
+    assert c.zero_syndromes + c.cache_hits + c.decoded == c.shots
+    assert c.zero_syndromes > 0
+    assert c.cache_hits > 0
+    assert sum(calls) == c.decoded < c.shots
+    assert len(decoder._cache) <= 100
+
+
+def test_caching_decoder_edge_cases():
+    decoder = SyndromeCachingDecoder(lambda dets: dets[:, :1] ^ dets[:, 1:2], num_observables=1, max_cache_size=0)
+    dets = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [1, 0, 0]], dtype=np.uint8)
+    np.testing.assert_array_equal(decoder.decode_batch(dets), [[0], [1], [0], [1]])
+    assert decoder.counters == DecodeCounters(shots=4, zero_syndromes=1, cache_hits=0, decoded=3)
+
+    decoder = SyndromeCachingDecoder(lambda dets: dets[:, :1] ^ dets[:, 1:2], num_observables=1, min_shots_before_bypass=4)
+    np.testing.assert_array_equal(decoder.decode_batch(dets), [[0], [1], [0], [1]])
+    assert decoder.counters == DecodeCounters(shots=4, zero_syndromes=1, cache_hits=1, decoded=2)
+    np.testing.assert_array_equal(decoder.decode_batch(dets[1:]), [[1], [0], [1]])
+    assert decoder.counters == DecodeCounters(shots=7, zero_syndromes=1, cache_hits=4, decoded=2)
+    np.testing.assert_array_equal(decoder.decode_batch(dets[:0]), np.zeros((0, 1)))
+
+
+def test_caching_decoder_bit_packed():
+    circuit = stim.Circuit.generated('surface_code:rotated_memory_x', distance=3, rounds=3, after_clifford_depolarization=0.002)
+    matching = pymatching.Matching.from_detector_error_model(sinter.worker.auto_dem(circuit))
+    decoder = SyndromeCachingDecoder(
+        lambda dets: matching.decode_batch(dets, bit_packed_shots=True, bit_packed_predictions=True),
+        num_observables=1,
+        max_cache_size=100,
+        bit_packed=True)
+    dets = circuit.compile_detector_sampler().sample(2000)
+    packed = np.packbits(dets, axis=1, bitorder='little')
+    expected = matching.decode_batch(dets)
+    np.testing.assert_array_equal(
+        decoder.decode_batch(packed, bit_packed_shots=True, bit_packed_predictions=True),
+        np.packbits(expected, axis=1, bitorder='little'))
+    np.testing.assert_array_equal(decoder.decode_batch(dets), expected.astype(np.bool_))
+    assert decoder.counters.cache_hits > 0
+
+
+def test_task_sampler_counts_decodes():
+    circuit = stim.Circuit.generated('surface_code:rotated_memory_x', distance=3, rounds=3, after_clifford_depolarization=0.001)
+    task = sinter.Task(circuit=circuit, json_metadata={})
+    sampler = TaskSampler(task, decode_cache_size=1000)
+    assert TaskSampler(task).decode_counters is None
+    sampler.sample(1000)
+    counters = sampler.decode_counters
+    assert counters.shots == 1000
+    assert counters.decoded < 1000
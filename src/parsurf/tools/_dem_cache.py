@@ -0,0 +1,120 @@
+from typing import Any, Optional
+
+import hashlib
+import os
+import pathlib
+
+import sinter
+import stim
+
+
+def dem_cache_key(circuit: stim.Circuit) -> str:
+    """Identifies a circuit's detector error model: a hash of the circuit and the stim version.
+
+    Unlike `circuit_fingerprint`, the noise strengths are part of the key, since they are part of
+    the detector error model.
+    """
+    h = hashlib.sha256()
+    h.update(f'stim={stim.__version__}\n'.encode())
+    h.update(str(circuit).encode())
+    return h.hexdigest()
+
+
+def looped_auto_dem(circuit: stim.Circuit) -> stim.DetectorErrorModel:
+    """The detector error model sinter derives (see `sinter.worker.auto_dem`), but keeping the circuit's loops.
+
+    The REPEAT blocks of the circuit stay repeat blocks in the detector error model, so its size
+    doesn't grow with the number of rounds.
+    """
+    return circuit.detector_error_model(
+        allow_gauge_detectors=False,
+        approximate_disjoint_errors=True,
+        block_decomposition_from_introducing_remnant_edges=False,
+        decompose_errors=True,
+        flatten_loops=False,
+        ignore_decomposition_failures=False,
+    )
+
+
+def _matching_graph_dem(matching: Any) -> stim.DetectorErrorModel:
+    """Describes a pymatching graph as a graphlike detector error model, which pymatching loads quickly.
+
+    Merged and decomposed edges are written out as they are in the graph, so loading the result
+    skips the decomposition and merging work of loading the original detector error model.
+    """
+    lines = []
+    if matching.num_detectors:
+        # Keep detectors that aren't touched by any edge.
+        lines.append(f'detector D{matching.num_detectors - 1}')
+    for u, v, data in matching.edges():
+        targets = f'D{u}' if v is None else f'D{u} D{v}'
+        for k in sorted(data['fault_ids']):
+            targets += f' L{k}'
+        lines.append(f"error({data['error_probability']!r}) {targets}")
+    return stim.DetectorErrorModel('\n'.join(lines))
+
+
+class DemCache:
+    """Stores detector error models and matching decoder graphs on disk, keyed by `dem_cache_key`.
+
+    Deriving the detector error model of a large circuit (and building its decoder graph) takes much
+    longer than loading the results, so workers picking up a task, resumed collections, and runs with
+    other decoders load them from the cache instead. Decoder graphs are also keyed by the pymatching
+    version, which decides how the detector error model is turned into a graph.
+    """
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = pathlib.Path(directory)
+
+    def _path(self, key: str, kind: str) -> pathlib.Path:
+        return self.directory / f'{key}.{kind}.dem'
+
+    def _load(self, path: pathlib.Path) -> Optional[stim.DetectorErrorModel]:
+        try:
+            return stim.DetectorErrorModel.from_file(str(path))
+        except (FileNotFoundError, ValueError, IndexError):
+            # Missing, or corrupt (e.g. from an interrupted write before atomic renames); recompute it.
+            return None
+
+    def _store(self, path: pathlib.Path, dem: stim.DetectorErrorModel) -> None:
+        self.directory.mkdir(exist_ok=True, parents=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            print(dem, file=f)
+        os.replace(tmp, path)
+
+    def detector_error_model(self, circuit: stim.Circuit, *, key: Optional[str] = None) -> stim.DetectorErrorModel:
+        """Returns the detector error model sinter would use for the circuit, computing and storing it on a miss."""
+        if key is None:
+            key = dem_cache_key(circuit)
+        path = self._path(key, 'sinter')
+        dem = self._load(path)
+        if dem is None:
+            dem = sinter.worker.auto_dem(circuit)
+            self._store(path, dem)
+        return dem
+
+    def looped_detector_error_model(self, circuit: stim.Circuit, *, key: Optional[str] = None) -> stim.DetectorErrorModel:
+        """Returns the circuit's `looped_auto_dem`, computing and storing it on a miss."""
+        if key is None:
+            key = dem_cache_key(circuit)
+        path = self._path(key, 'looped')
+        dem = self._load(path)
+        if dem is None:
+            dem = looped_auto_dem(circuit)
+            self._store(path, dem)
+        return dem
+
+    def matching(self, circuit: stim.Circuit, *, key: Optional[str] = None) -> Any:
+        """Returns a `pymatching.Matching` decoder for the circuit, building and storing its graph on a miss."""
+        import pymatching
+
+        if key is None:
+            key = dem_cache_key(circuit)
+        path = self._path(key, f'pymatching-{pymatching.__version__}')
+        graph = self._load(path)
+        if graph is not None:
+            return pymatching.Matching.from_detector_error_model(graph)
+        matching = pymatching.Matching.from_detector_error_model(self.detector_error_model(circuit, key=key))
+        self._store(path, _matching_graph_dem(matching))
+        return matching
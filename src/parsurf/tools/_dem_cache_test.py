@@ -0,0 +1,51 @@
+import numpy as np
+import sinter
+import stim
+
+from parsurf.tools import dem_cache_key, DemCache, TaskSampler
+
+
+def _circuit(p: float = 0.001) -> stim.Circuit:
+    return stim.Circuit.generated('surface_code:rotated_memory_x', distance=3, rounds=3, after_clifford_depolarization=p)
+
+
+def test_dem_cache_key():
+    assert dem_cache_key(_circuit()) == dem_cache_key(_circuit())
+    assert dem_cache_key(_circuit()) != dem_cache_key(_circuit(0.002))
+
+
+def test_dem_cache_round_trip(tmp_path):
+    circuit = _circuit()
+    cache = DemCache(tmp_path)
+    dem = cache.detector_error_model(circuit)
+    assert dem == sinter.worker.auto_dem(circuit)
+    assert len(list(tmp_path.iterdir())) == 1
+    assert DemCache(tmp_path).detector_error_model(circuit) == dem
+
+    # A corrupt entry is recomputed.
+    path, = tmp_path.iterdir()
+    path.write_text('not a dem')
+    assert DemCache(tmp_path).detector_error_model(circuit) == dem
+
+
+def test_dem_cache_matching_graph_decodes_identically(tmp_path):
+    import pymatching
+
+    circuit = _circuit(0.01)
+    built = DemCache(tmp_path).matching(circuit)
+    loaded = DemCache(tmp_path).matching(circuit)
+    assert len(list(tmp_path.iterdir())) == 2
+    expected = pymatching.Matching.from_detector_error_model(sinter.worker.auto_dem(circuit))
+    assert loaded.num_detectors == expected.num_detectors
+
+    dets = circuit.compile_detector_sampler().sample(500)
+    np.testing.assert_array_equal(loaded.decode_batch(dets), expected.decode_batch(dets))
+    np.testing.assert_array_equal(built.decode_batch(dets), expected.decode_batch(dets))
+
+
+def test_task_sampler_uses_dem_cache(tmp_path):
+    task = sinter.Task(circuit=_circuit(), json_metadata={'d': 3})
+    cached = TaskSampler(task, dem_cache=DemCache(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
+    assert cached.strong_id == TaskSampler(task).strong_id
+    assert cached.sample(100).shots == 100
@@ -0,0 +1,181 @@
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import dataclasses
+import hashlib
+import json
+import multiprocessing
+import os
+import pathlib
+
+import stim
+
+from parsurf.tools._noise import OP_TYPES, NOISE, MPP, JUST_MEASURE_1Q, MEASURE_RESET_1Q
+
+# Operations whose parens arguments are probabilities, as opposed to coordinates or indices.
+_PROBABILITY_ARG_TYPES = {NOISE, MPP, JUST_MEASURE_1Q, MEASURE_RESET_1Q}
+
+
+def circuit_fingerprint(circuit: stim.Circuit) -> str:
+    """Returns a hash identifying the error structure of a circuit.
+
+    Probability arguments are reduced to whether or not they are zero, so the same circuit noised
+    at different strengths gets the same fingerprint (and therefore the same distance certificate).
+    """
+    h = hashlib.sha256()
+    _hash_circuit_structure(circuit, h)
+    return h.hexdigest()
+
+
+def _hash_circuit_structure(circuit: stim.Circuit, h: Any) -> None:
+    for op in circuit:
+        if isinstance(op, stim.CircuitRepeatBlock):
+            h.update(f'REPEAT {op.repeat_count} {{\n'.encode())
+            _hash_circuit_structure(op.body_copy(), h)
+            h.update(b'}\n')
+            continue
+        args = op.gate_args_copy()
+        if OP_TYPES.get(op.name) in _PROBABILITY_ARG_TYPES:
+            args = [int(a != 0) for a in args]
+        targets = ' '.join(repr(t) for t in op.targets_copy())
+        h.update(f'{op.name}{args} {targets}\n'.encode())
+
+
+@dataclasses.dataclass(frozen=True)
+class DistanceCertificate:
+    """The result of searching a circuit for its smallest undetectable logical errors.
+
+    Attributes:
+        fingerprint: The `circuit_fingerprint` of the certified circuit.
+        graphlike_distance: Size of the smallest graphlike logical error.
+        hypergraph_budget: The detection event set size limit given to the hypergraph search, or
+            None if the hypergraph search wasn't run.
+        hypergraph_distance: Size of the smallest logical error found by the hypergraph search, or
+            None if the search wasn't run or found nothing within its budget.
+    """
+    fingerprint: str
+    graphlike_distance: int
+    hypergraph_budget: Optional[int] = None
+    hypergraph_distance: Optional[int] = None
+
+    def to_json(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> 'DistanceCertificate':
+        return DistanceCertificate(**data)
+
+
+def certify_circuit_distance(circuit: stim.Circuit,
+                             *,
+                             hypergraph_budget: Optional[int] = None) -> DistanceCertificate:
+    """Computes the graphlike (and optionally hypergraph) distance of a noisy circuit.
+
+    Args:
+        circuit: The noisy circuit to certify.
+        hypergraph_budget: If not None, also runs a hypergraph search for undetectable logical errors
+            that doesn't explore detection event sets larger than this.
+
+    Returns:
+        The distance certificate.
+    """
+    graphlike = circuit.shortest_graphlike_error(canonicalize_circuit_errors=True)
+    hypergraph = None
+    if hypergraph_budget is not None:
+        try:
+            hypergraph = len(circuit.search_for_undetectable_logical_errors(
+                dont_explore_edges_increasing_symptom_degree=False,
+                dont_explore_edges_with_degree_above=999,
+                dont_explore_detection_event_sets_with_size_above=hypergraph_budget,
+                canonicalize_circuit_errors=True))
+        except ValueError:
+            # Nothing found within the budget.
+            hypergraph = None
+    return DistanceCertificate(
+        fingerprint=circuit_fingerprint(circuit),
+        graphlike_distance=len(graphlike),
+        hypergraph_budget=hypergraph_budget,
+        hypergraph_distance=hypergraph,
+    )
+
+
+class DistanceCertificateCache:
+    """Stores distance certificates on disk, as one json file per (fingerprint, budget) pair."""
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = pathlib.Path(directory)
+
+    def _path(self, fingerprint: str, hypergraph_budget: Optional[int]) -> pathlib.Path:
+        return self.directory / f'{fingerprint},hb={hypergraph_budget}.json'
+
+    def get(self, fingerprint: str, *, hypergraph_budget: Optional[int]) -> Optional[DistanceCertificate]:
+        path = self._path(fingerprint, hypergraph_budget)
+        try:
+            with open(path) as f:
+                return DistanceCertificate.from_json(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError):
+            # Corrupt entry (e.g. from an interrupted write before atomic renames); recompute it.
+            return None
+
+    def put(self, certificate: DistanceCertificate) -> None:
+        self.directory.mkdir(exist_ok=True, parents=True)
+        path = self._path(certificate.fingerprint, certificate.hypergraph_budget)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(certificate.to_json(), f)
+        os.replace(tmp, path)
+
+
+def _certify_circuit_text(args: Any) -> DistanceCertificate:
+    text, hypergraph_budget = args
+    return certify_circuit_distance(stim.Circuit(text), hypergraph_budget=hypergraph_budget)
+
+
+def certify_circuit_distances(circuits: Sequence[stim.Circuit],
+                              *,
+                              hypergraph_budget: Optional[int] = None,
+                              cache_dir: Optional[pathlib.Path] = None,
+                              processes: int = 1) -> List[DistanceCertificate]:
+    """Certifies the distance of many circuits, using a process pool and an on-disk cache.
+
+    Circuits with the same fingerprint (e.g. the same circuit at different noise strengths) are only
+    certified once, and circuits with a cached certificate aren't certified at all.
+
+    Args:
+        circuits: The noisy circuits to certify.
+        hypergraph_budget: Passed to `certify_circuit_distance`.
+        cache_dir: Where to load and store certificates. No caching if None.
+        processes: Number of worker processes to use for circuits that aren't cached.
+
+    Returns:
+        The certificates, in the same order as the given circuits.
+    """
+    cache = None if cache_dir is None else DistanceCertificateCache(cache_dir)
+    fingerprints = [circuit_fingerprint(c) for c in circuits]
+
+    known: Dict[str, DistanceCertificate] = {}
+    missing: Dict[str, stim.Circuit] = {}
+    for fingerprint, circuit in zip(fingerprints, circuits):
+        if fingerprint in known or fingerprint in missing:
+            continue
+        cert = None if cache is None else cache.get(fingerprint, hypergraph_budget=hypergraph_budget)
+        if cert is None:
+            missing[fingerprint] = circuit
+        else:
+            known[fingerprint] = cert
+
+    work = [(str(c), hypergraph_budget) for c in missing.values()]
+    if processes > 1 and len(work) > 1:
+        with multiprocessing.Pool(min(processes, len(work))) as pool:
+            results: Iterable[DistanceCertificate] = pool.map(_certify_circuit_text, work, chunksize=1)
+    else:
+        results = [_certify_circuit_text(w) for w in work]
+    for fingerprint, cert in zip(missing.keys(), results):
+        # Key by the fingerprint of the given circuit, not of its text round trip.
+        cert = dataclasses.replace(cert, fingerprint=fingerprint)
+        known[fingerprint] = cert
+        if cache is not None:
+            cache.put(cert)
+
+    return [known[f] for f in fingerprints]
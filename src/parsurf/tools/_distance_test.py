@@ -0,0 +1,47 @@
+import stim
+
+from parsurf.circuits.chao import chao_memory_experiment_task
+from parsurf.tools._distance import circuit_fingerprint, certify_circuit_distance, certify_circuit_distances, \
+    DistanceCertificateCache, DistanceCertificate
+
+
+def test_circuit_fingerprint():
+    a = chao_memory_experiment_task(basis='X', rounds=3, diam=3, noise=0.001).circuit
+    b = chao_memory_experiment_task(basis='X', rounds=3, diam=3, noise=0.002).circuit
+    c = chao_memory_experiment_task(basis='Z', rounds=3, diam=3, noise=0.001).circuit
+    assert circuit_fingerprint(a) == circuit_fingerprint(a.copy())
+    assert circuit_fingerprint(a) == circuit_fingerprint(b)
+    assert circuit_fingerprint(a) != circuit_fingerprint(c)
+    assert circuit_fingerprint(stim.Circuit("X_ERROR(0.1) 0")) != circuit_fingerprint(stim.Circuit("X_ERROR(0) 0"))
+    assert circuit_fingerprint(stim.Circuit("DETECTOR(1) rec[-1]")) != circuit_fingerprint(stim.Circuit("DETECTOR(2) rec[-1]"))
+
+
+def test_certify_circuit_distance():
+    task = chao_memory_experiment_task(basis='X', rounds=3, diam=3, noise=0.001)
+    cert = certify_circuit_distance(task.circuit)
+    assert cert.graphlike_distance == 3
+    assert cert.hypergraph_distance is None
+
+    cert = certify_circuit_distance(task.circuit, hypergraph_budget=8)
+    assert cert.graphlike_distance == 3
+    assert cert.hypergraph_distance == 3
+    assert cert.fingerprint == circuit_fingerprint(task.circuit)
+
+
+def test_certify_circuit_distances_cache(tmp_path):
+    circuits = [
+        chao_memory_experiment_task(basis='X', rounds=3, diam=d, noise=p).circuit
+        for d in [3, 5]
+        for p in [0.001, 0.002]
+    ]
+    certs = certify_circuit_distances(circuits, cache_dir=tmp_path, processes=2)
+    assert [c.graphlike_distance for c in certs] == [3, 3, 5, 5]
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # Cached results are used instead of being recomputed.
+    cache = DistanceCertificateCache(tmp_path)
+    fake = DistanceCertificate(fingerprint=certs[0].fingerprint, graphlike_distance=100)
+    cache.put(fake)
+    assert cache.get(certs[0].fingerprint, hypergraph_budget=None) == fake
+    certs2 = certify_circuit_distances(circuits, cache_dir=tmp_path)
+    assert [c.graphlike_distance for c in certs2] == [100, 100, 5, 5]
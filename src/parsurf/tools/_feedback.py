@@ -0,0 +1,235 @@
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import functools
+
+import stim
+
+from parsurf.tools._noise import OP_TYPES, CLIFFORD_1Q, CLIFFORD_2Q, ANNOTATION, NOISE
+
+_EMPTY: FrozenSet[int] = frozenset()
+
+# Measurement gates, mapped to (basis, resets afterwards).
+_MEASURE_GATES = {
+    'M': ('Z', False),
+    'MZ': ('Z', False),
+    'MX': ('X', False),
+    'MY': ('Y', False),
+    'MR': ('Z', True),
+    'MRZ': ('Z', True),
+    'MRX': ('X', True),
+    'MRY': ('Y', True),
+}
+_RESET_GATES = {'R', 'RZ', 'RX', 'RY'}
+
+# The Pauli applied by a classically controlled gate, as (applies X, applies Z).
+_FEEDBACK_PAULIS = {
+    'CX': (True, False),
+    'CNOT': (True, False),
+    'CY': (True, True),
+    'CZ': (False, True),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _conjugation_table(gate: str) -> Tuple[Tuple[Tuple[bool, bool], ...], ...]:
+    """Returns, for each input qubit and each of X and Z, the (x, z) bits of its image on each output qubit.
+
+    Result is indexed as table[2*input_qubit + (0 for X, 1 for Z)][output_qubit] = (x_bit, z_bit).
+    """
+    tableau = stim.Tableau.from_named_gate(gate)
+    n = len(tableau)
+    rows = []
+    for q in range(n):
+        for out in [tableau.x_output(q), tableau.z_output(q)]:
+            rows.append(tuple((out[k] in (1, 2), out[k] in (2, 3)) for k in range(n)))
+    return tuple(rows)
+
+
+class _FeedbackFolder:
+    """Propagates classically controlled Paulis through a circuit, as a Pauli frame over measurement results.
+
+    Each frame component (X or Z on a qubit) is stored as the set of measurement indices (in the folded
+    circuit's measurement record) whose parity determines whether that Pauli is currently applied.
+    """
+
+    def __init__(self):
+        self.xs: Dict[int, FrozenSet[int]] = {}
+        self.zs: Dict[int, FrozenSet[int]] = {}
+        # For measurements flipped by the frame: the measurement indices whose parity equals the flipped result.
+        self.flipped: Dict[int, FrozenSet[int]] = {}
+        self.num_measurements = 0
+        self.out = stim.Circuit()
+
+    def _deps(self, k: int) -> FrozenSet[int]:
+        result = self.flipped.get(k)
+        if result is None:
+            return frozenset([k])
+        return result
+
+    def _rec_deps(self, targets: List[stim.GateTarget]) -> FrozenSet[int]:
+        result = _EMPTY
+        for t in targets:
+            if not t.is_measurement_record_target:
+                raise NotImplementedError(f'Non-record target in annotation: {t!r}')
+            result = result ^ self._deps(self.num_measurements + t.value)
+        return result
+
+    def _record(self, flip: FrozenSet[int]) -> None:
+        k = self.num_measurements
+        if flip:
+            self.flipped[k] = frozenset([k]) ^ flip
+        self.num_measurements += 1
+
+    def _clear(self, q: int) -> None:
+        self.xs.pop(q, None)
+        self.zs.pop(q, None)
+
+    def _flip_for_basis(self, q: int, basis: str) -> FrozenSet[int]:
+        if basis == 'X':
+            return self.zs.get(q, _EMPTY)
+        if basis == 'Z':
+            return self.xs.get(q, _EMPTY)
+        if basis == 'Y':
+            return self.xs.get(q, _EMPTY) ^ self.zs.get(q, _EMPTY)
+        raise NotImplementedError(f'{basis=}')
+
+    def _apply_clifford(self, name: str, qubits: List[int]) -> None:
+        if not any(q in self.xs or q in self.zs for q in qubits):
+            return
+        table = _conjugation_table(name)
+        old = []
+        for q in qubits:
+            old.append(self.xs.pop(q, _EMPTY))
+            old.append(self.zs.pop(q, _EMPTY))
+        new_x = [_EMPTY] * len(qubits)
+        new_z = [_EMPTY] * len(qubits)
+        for row, deps in zip(table, old):
+            if deps:
+                for k, (x, z) in enumerate(row):
+                    if x:
+                        new_x[k] = new_x[k] ^ deps
+                    if z:
+                        new_z[k] = new_z[k] ^ deps
+        for q, x, z in zip(qubits, new_x, new_z):
+            if x:
+                self.xs[q] = x
+            if z:
+                self.zs[q] = z
+
+    def _process_2q(self, op: stim.CircuitInstruction) -> None:
+        targets = op.targets_copy()
+        kept = []
+        for k in range(0, len(targets), 2):
+            a, b = targets[k], targets[k + 1]
+            if a.is_measurement_record_target or b.is_measurement_record_target:
+                if op.name not in _FEEDBACK_PAULIS:
+                    raise NotImplementedError(f'Classical control of {op.name}.')
+                if b.is_measurement_record_target:
+                    a, b = b, a
+                if b.is_measurement_record_target:
+                    # Purely classical; doesn't touch the quantum state.
+                    continue
+                apply_x, apply_z = _FEEDBACK_PAULIS[op.name]
+                deps = self._deps(self.num_measurements + a.value)
+                q = b.value
+                if apply_x:
+                    self.xs[q] = self.xs.get(q, _EMPTY) ^ deps
+                    if not self.xs[q]:
+                        del self.xs[q]
+                if apply_z:
+                    self.zs[q] = self.zs.get(q, _EMPTY) ^ deps
+                    if not self.zs[q]:
+                        del self.zs[q]
+            else:
+                self._apply_clifford(op.name, [a.value, b.value])
+                kept.append(a)
+                kept.append(b)
+        if kept:
+            self.out.append(op.name, kept, op.gate_args_copy())
+
+    def _process_mpp(self, op: stim.CircuitInstruction) -> None:
+        targets = op.targets_copy()
+        flip = _EMPTY
+        for k, t in enumerate(targets):
+            if t.is_combiner:
+                continue
+            if t.is_x_target:
+                flip = flip ^ self._flip_for_basis(t.value, 'X')
+            elif t.is_y_target:
+                flip = flip ^ self._flip_for_basis(t.value, 'Y')
+            elif t.is_z_target:
+                flip = flip ^ self._flip_for_basis(t.value, 'Z')
+            else:
+                raise NotImplementedError(f'{op=}')
+            if k + 1 == len(targets) or not targets[k + 1].is_combiner:
+                self._record(flip)
+                flip = _EMPTY
+        self.out.append(op)
+
+    def _process_annotation(self, op: stim.CircuitInstruction) -> None:
+        if op.name in ['DETECTOR', 'OBSERVABLE_INCLUDE']:
+            deps = self._rec_deps(op.targets_copy())
+            n = self.num_measurements
+            self.out.append(op.name, [stim.target_rec(k - n) for k in sorted(deps)], op.gate_args_copy())
+        else:
+            self.out.append(op)
+
+    def process(self, circuit: stim.Circuit) -> None:
+        for op in circuit:
+            if isinstance(op, stim.CircuitRepeatBlock):
+                body = op.body_copy()
+                for _ in range(op.repeat_count):
+                    self.process(body)
+                continue
+
+            name = op.name
+            t = OP_TYPES.get(name)
+            if name in _MEASURE_GATES:
+                basis, reset = _MEASURE_GATES[name]
+                for target in op.targets_copy():
+                    q = target.value
+                    self._record(self._flip_for_basis(q, basis))
+                    if reset:
+                        self._clear(q)
+                self.out.append(op)
+            elif name in _RESET_GATES:
+                for target in op.targets_copy():
+                    self._clear(target.value)
+                self.out.append(op)
+            elif name == 'MPP':
+                self._process_mpp(op)
+            elif t == CLIFFORD_2Q:
+                self._process_2q(op)
+            elif t == CLIFFORD_1Q:
+                for target in op.targets_copy():
+                    self._apply_clifford(name, [target.value])
+                self.out.append(op)
+            elif t == ANNOTATION:
+                self._process_annotation(op)
+            elif t == NOISE:
+                # Pauli noise commutes with the Pauli frame (up to global phase).
+                self.out.append(op)
+            else:
+                raise NotImplementedError(f'{op=}')
+
+
+def fold_classical_feedback(circuit: stim.Circuit) -> stim.Circuit:
+    """Removes classically controlled Paulis by folding their effects into detectors and observables.
+
+    Each classically controlled Pauli (e.g. `CX rec[-1] 5`) is propagated to the end of the circuit.
+    Whenever it would have flipped a later measurement, the measurements controlling it are
+    instead XOR'd into the detectors and observables that use that measurement. The result has the
+    same detector error model as the input, but doesn't need to simulate the feedback operations.
+
+    REPEAT blocks are unrolled, because the folded detectors of later iterations can refer to
+    arbitrarily old measurements.
+
+    Args:
+        circuit: The circuit to fold. May be noisy.
+
+    Returns:
+        The folded circuit.
+    """
+    folder = _FeedbackFolder()
+    folder.process(circuit)
+    return folder.out
@@ -0,0 +1,93 @@
+import pytest
+import stim
+
+from parsurf.circuits.chao import chao_memory_experiment_task
+from parsurf.circuits.pentagonal import iter_pentagonal_decompose_mpp4
+from parsurf.tools import Builder, AtLayer, NoiseModel
+from parsurf.tools._feedback import fold_classical_feedback
+
+
+def _has_feedback(circuit: stim.Circuit) -> bool:
+    return any(
+        t.is_measurement_record_target
+        for op in circuit.flattened()
+        if op.name in ['CX', 'CY', 'CZ']
+        for t in op.targets_copy()
+    )
+
+
+def test_fold_classical_feedback_simple():
+    assert fold_classical_feedback(stim.Circuit("""
+        M 0
+        CX rec[-1] 1
+        M 1
+        DETECTOR rec[-1]
+    """)) == stim.Circuit("""
+        M 0
+        M 1
+        DETECTOR rec[-2] rec[-1]
+    """)
+
+    # Reset clears the frame.
+    assert fold_classical_feedback(stim.Circuit("""
+        M 0
+        CX rec[-1] 1
+        R 1
+        M 1
+        DETECTOR rec[-1]
+    """)) == stim.Circuit("""
+        M 0
+        R 1
+        M 1
+        DETECTOR rec[-1]
+    """)
+
+    # Frame propagates through Cliffords and into later feedback.
+    assert fold_classical_feedback(stim.Circuit("""
+        M 0
+        CZ rec[-1] 1
+        H 1
+        CX 1 2
+        M 2
+        CX rec[-1] 3
+        MPP Z3*X4
+        OBSERVABLE_INCLUDE(0) rec[-1]
+    """)) == stim.Circuit("""
+        M 0
+        H 1
+        CX 1 2
+        M 2
+        MPP Z3*X4
+        OBSERVABLE_INCLUDE(0) rec[-3] rec[-2] rec[-1]
+    """)
+
+
+@pytest.mark.parametrize('basis,rounds,diam', [
+    ('X', 1, 3),
+    ('X', 5, 3),
+    ('Z', 6, 5),
+])
+def test_fold_classical_feedback_chao_same_dem(basis: str, rounds: int, diam: int):
+    circuit = chao_memory_experiment_task(basis=basis, rounds=rounds, diam=diam, noise=0.001).circuit
+    folded = fold_classical_feedback(circuit)
+    assert _has_feedback(circuit)
+    assert not _has_feedback(folded)
+    assert folded.flattened().detector_error_model(decompose_errors=True) == circuit.flattened().detector_error_model(decompose_errors=True)
+
+
+def test_fold_classical_feedback_pentagonal_same_dem():
+    builder = Builder.for_qubits(range(6))
+    builder.gate('RX', range(4))
+    for _ in iter_pentagonal_decompose_mpp4(
+            a=0, b=1, c=2, d=3, m1=4, m2=5,
+            key='key', layer=0, basis='X', builder=builder, use_classical_feedback=True):
+        builder.tick()
+    builder.detector([AtLayer('key', 0)])
+    builder.measure(range(4), basis='X', layer=0)
+    builder.detector([AtLayer('key', 0)] + [AtLayer(q, 0) for q in range(4)])
+    builder.obs_include([AtLayer(0, 0), AtLayer(1, 0)], obs_index=0)
+    circuit = NoiseModel.depolarizing_two_body_measurement_noise(0.001).noisy_circuit(builder.circuit)
+    folded = fold_classical_feedback(circuit)
+    assert _has_feedback(circuit)
+    assert not _has_feedback(folded)
+    assert folded.detector_error_model() == circuit.detector_error_model()
@@ -0,0 +1,117 @@
+from typing import Any, Callable, Dict, List, Optional
+
+import sys
+
+import sinter
+
+from parsurf.tools._collection import CollectionProgress, CollectionTask
+
+
+class CollectionPruner:
+    """Stops collecting tasks whose stats can't enter the plots' fits.
+
+    Used as (part of) the `policy` of `collect_task_stats`. After each batch, the binomial
+    confidence interval of the sampled task's error rate is used to stop tasks that are:
+
+    - Saturated: the task's shot error rate is confidently at least `saturated_error_rate` (the
+        plots' fits drop such points as above threshold). Only the task itself is stopped: tasks
+        with a larger distance may still be below threshold, and are only stopped once their curve
+        is found not improving with distance (which stops every task at that p or above).
+    - Not improving: the task's per-round error rate is confidently at least the rate of a task with
+        a smaller distance at the same p (so the curve's fitted slope can't be below the plots'
+        cutoff, and the whole curve is dropped from the fits). Tasks of that curve, and of the same
+        circuit family and basis with larger p, are stopped.
+
+    Tasks with low error rates are never pruned: the small pilot samples that every task gets first
+    can't show a rate below the bottom of the plots. Tasks whose metadata lacks the 'c', 'b', 'd',
+    'r' or 'p' entries are never pruned.
+    """
+
+    def __init__(self,
+                 *,
+                 metadata_func: Callable[[Any], Any] = lambda description: description,
+                 saturated_error_rate: float = 0.4,
+                 max_likelihood_factor: float = 1000,
+                 verbose: bool = False):
+        self.metadata_func = metadata_func
+        self.saturated_error_rate = saturated_error_rate
+        self.max_likelihood_factor = max_likelihood_factor
+        self.verbose = verbose
+        self.pruned: Dict[int, str] = {}
+        self._fits: Dict[int, sinter.Fit] = {}
+        self._metadata: Optional[List[Optional[Dict[str, Any]]]] = None
+
+    def _prunable_metadata(self, task: CollectionTask) -> Optional[Dict[str, Any]]:
+        m = self.metadata_func(task.description)
+        if not isinstance(m, dict) or not all(k in m for k in 'cbdrp'):
+            return None
+        return m
+
+    def _stop(self, tasks: List[CollectionTask], index: int, reason: str) -> None:
+        task = tasks[index]
+        if task.stopped is not None or task.done:
+            return
+        task.stopped = reason
+        self.pruned[index] = reason
+        if self.verbose:
+            print(f'    pruned {self._metadata[index]}: {reason}', file=sys.stderr)
+
+    def _update_fit(self, tasks: List[CollectionTask], index: int) -> None:
+        s = tasks[index].stats
+        if s.shots > s.discards:
+            self._fits[index] = sinter.fit_binomial(
+                num_shots=s.shots - s.discards,
+                num_hits=s.errors,
+                max_likelihood_factor=self.max_likelihood_factor)
+
+    def _prune_using(self, tasks: List[CollectionTask], index: int) -> None:
+        m = self._metadata[index]
+        fit = self._fits.get(index)
+        if m is None or fit is None:
+            return
+        rounds = m['r']
+        same_family = [
+            (j, m2)
+            for j, m2 in enumerate(self._metadata)
+            if j != index and m2 is not None and m2['c'] == m['c'] and m2['b'] == m['b']
+        ]
+
+        round_low = sinter.shot_error_rate_to_piece_error_rate(fit.low, pieces=rounds)
+        round_high = sinter.shot_error_rate_to_piece_error_rate(fit.high, pieces=rounds)
+        for j, m2 in same_family:
+            fit2 = self._fits.get(j)
+            if fit2 is None or m2['p'] != m['p'] or m2['d'] == m['d']:
+                continue
+            if m2['d'] < m['d']:
+                smaller_high = sinter.shot_error_rate_to_piece_error_rate(fit2.high, pieces=m2['r'])
+                larger_low = round_low
+            else:
+                smaller_high = round_high
+                larger_low = sinter.shot_error_rate_to_piece_error_rate(fit2.low, pieces=m2['r'])
+            if larger_low >= smaller_high:
+                reason = f'not improving with distance at {m} and {m2}'
+                self._stop(tasks, index, reason)
+                for k, m3 in same_family:
+                    if m3['p'] >= m['p']:
+                        self._stop(tasks, k, reason)
+                break
+
+        if fit.low >= self.saturated_error_rate:
+            reason = f'saturated: error rate >= {self.saturated_error_rate} at {m}'
+            self._stop(tasks, index, reason)
+
+    def prune(self, tasks: List[CollectionTask]) -> None:
+        """Applies the pruning rules using the current stats of every task (e.g. pre-existing stats)."""
+        self._metadata = [self._prunable_metadata(task) for task in tasks]
+        for i in range(len(tasks)):
+            self._update_fit(tasks, i)
+        for i in range(len(tasks)):
+            self._prune_using(tasks, i)
+
+    def policy(self, progress: CollectionProgress) -> None:
+        if self._metadata is None:
+            # The first batch also brings in the pre-existing stats of every task.
+            self.prune(progress.tasks)
+            return
+        self._update_fit(progress.tasks, progress.new_index)
+        self._prune_using(progress.tasks, progress.new_index)
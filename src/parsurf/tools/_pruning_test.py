@@ -0,0 +1,71 @@
+import sinter
+
+from parsurf.tools import CollectionPruner, CollectionTask
+
+
+def _task(*, d: int, p: float, shots: int, errors: int, r_factor: int = 3) -> CollectionTask:
+    return CollectionTask(
+        description={'c': 'chao', 'b': 'X', 'd': d, 'r': d * r_factor, 'p': p},
+        stats=sinter.AnonTaskStats(shots=shots, errors=errors),
+        max_shots=10**9,
+        max_errors=10**9,
+    )
+
+
+def test_prunes_saturated_tasks():
+    tasks = [
+        _task(d=3, p=0.01, shots=1000, errors=480),
+        _task(d=5, p=0.01, shots=0, errors=0),
+        _task(d=5, p=0.02, shots=0, errors=0),
+        _task(d=5, p=0.001, shots=0, errors=0),
+        _task(d=3, p=0.01, r_factor=1, shots=0, errors=0),
+    ]
+    pruner = CollectionPruner()
+    pruner.prune(tasks)
+    # Saturation alone doesn't say the larger distances are saturated too (they may be below threshold).
+    assert sorted(pruner.pruned) == [0]
+    assert tasks[0].done
+    assert not tasks[1].done
+    assert not tasks[4].done
+
+
+def test_prunes_curves_that_dont_improve_with_distance():
+    tasks = [
+        _task(d=3, p=0.005, shots=10000, errors=100),
+        _task(d=5, p=0.005, shots=10000, errors=300),
+        _task(d=7, p=0.005, shots=0, errors=0),
+        _task(d=7, p=0.006, shots=0, errors=0),
+        _task(d=7, p=0.001, shots=0, errors=0),
+    ]
+    pruner = CollectionPruner()
+    pruner.prune(tasks)
+    assert sorted(pruner.pruned) == [0, 1, 2, 3]
+
+    # Improving curves are kept.
+    tasks[1].stats = sinter.AnonTaskStats(shots=10000, errors=20)
+    for task in tasks:
+        task.stopped = None
+    pruner = CollectionPruner()
+    pruner.prune(tasks)
+    assert pruner.pruned == {}
+
+
+def test_keeps_tasks_without_errors():
+    tasks = [
+        _task(d=3, p=0.001, shots=10**6, errors=0),
+        _task(d=5, p=0.001, shots=10**6, errors=0),
+        _task(d=7, p=0.001, shots=0, errors=0),
+    ]
+    pruner = CollectionPruner()
+    pruner.prune(tasks)
+    assert pruner.pruned == {}
+    assert not any(task.done for task in tasks)
+
+
+def test_ignores_tasks_without_standard_metadata():
+    tasks = [
+        CollectionTask(description='a.stim', stats=sinter.AnonTaskStats(shots=100, errors=100), max_shots=10, max_errors=10),
+    ]
+    pruner = CollectionPruner()
+    pruner.prune(tasks)
+    assert pruner.pruned == {}
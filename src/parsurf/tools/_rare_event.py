@@ -0,0 +1,439 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import dataclasses
+import math
+import time
+
+import numpy as np
+import sinter
+import stim
+
+from parsurf.tools._dem_cache import dem_cache_key, DemCache
+from parsurf.tools._repeat import flattened_dem
+
+
+def rare_event_decoder_name(decoder: str) -> str:
+    """The decoder name that error weight stratified estimates are recorded under (e.g. 'pymatching:rare_event').
+
+    The estimates are recorded as effective shot and error counts (see
+    `ErrorWeightEstimate.effective_stats`), so they are kept apart from directly sampled stats.
+    """
+    return f'{decoder}:rare_event'
+
+
+@dataclasses.dataclass
+class ErrorWeightStratum:
+    """The shots sampled with exactly `weight` error mechanisms occurring.
+
+    Attributes:
+        weight: The number of error mechanisms that occurred in each shot.
+        probability: The probability that exactly this many error mechanisms occur.
+        shots: The number of shots sampled.
+        errors: The number of sampled shots the decoder got wrong.
+        exact_error_rate: The error rate of shots with this many errors, when it was computed
+            exactly (by enumerating the error sets) instead of being sampled.
+    """
+    weight: int
+    probability: float
+    shots: int = 0
+    errors: int = 0
+    exact_error_rate: Optional[float] = None
+
+    @property
+    def error_rate(self) -> float:
+        if self.exact_error_rate is not None:
+            return self.exact_error_rate
+        return self.errors / self.shots if self.shots else 0
+
+    def smoothed_error_rate(self) -> float:
+        """The stratum's error rate with one pseudo-error and one pseudo-success (non-zero, for variances)."""
+        return (self.errors + 1) / (self.shots + 2)
+
+    def zero_error_upper_bound(self, *, max_likelihood_factor: float = 1000) -> float:
+        """The binomial upper bound on the error rate of a stratum sampled without errors.
+
+        This is the error rate at which seeing no errors in `shots` shots is `max_likelihood_factor`
+        times less likely than at an error rate of zero (the upper end of `sinter.fit_binomial`).
+        """
+        assert self.errors == 0 and self.exact_error_rate is None
+        if not self.shots:
+            return 1
+        return -math.expm1(-math.log(max_likelihood_factor) / self.shots)
+
+
+@dataclasses.dataclass
+class ErrorWeightEstimate:
+    """A logical error rate estimated by sampling shots stratified by their number of errors.
+
+    The error rate is the sum, over error weights w, of the probability of w errors occurring times
+    the error rate of shots with w errors. The sampled weights' error rates are estimated from
+    their shots, without bias. Weights above the sampled ones (whose total probability is
+    `truncated_probability`) can add at most that much, which is added to the upper end of the
+    confidence interval (see `fit`, which uses a normal approximation). Weight 0 is never sampled: a shot without errors has no detection events
+    and flips no observables, so it is always decoded correctly.
+
+    Attributes:
+        strata: The sampled error weights.
+        truncated_probability: The probability of more errors than the largest sampled weight.
+        seconds: The time spent sampling and decoding.
+    """
+    strata: List[ErrorWeightStratum]
+    truncated_probability: float
+    seconds: float = 0
+
+    @property
+    def shots(self) -> int:
+        return sum(s.shots for s in self.strata)
+
+    @property
+    def errors(self) -> int:
+        return sum(s.errors for s in self.strata)
+
+    @property
+    def error_rate(self) -> float:
+        """The unbiased estimate of the (truncated) logical error rate."""
+        return float(sum(s.probability * s.error_rate for s in self.strata))
+
+    @property
+    def standard_error(self) -> float:
+        """The standard error of `error_rate`, using smoothed stratum error rates so empty strata count."""
+        variance = 0
+        for s in self.strata:
+            if s.exact_error_rate is not None:
+                continue
+            f = s.smoothed_error_rate()
+            variance += s.probability**2 * f * (1 - f) / max(s.shots, 1)
+        return math.sqrt(variance)
+
+    def fit(self, *, max_likelihood_factor: float = 1000) -> sinter.Fit:
+        """A confidence interval for the logical error rate.
+
+        This is a normal approximation, not an exact interval: the sampled strata with errors
+        contribute their variance, and the interval is as many standard errors wide as a binomial
+        likelihood fit with the same `max_likelihood_factor` would be. It can be too narrow when
+        those strata have few errors. Strata sampled without errors (where the normal approximation
+        would give a width of zero) instead add their binomial upper bound (see
+        `ErrorWeightStratum.zero_error_upper_bound`) times their probability to the upper end, as
+        does the truncated probability.
+        """
+        z = math.sqrt(2 * math.log(max_likelihood_factor))
+        variance = 0
+        zero_error_bound = 0
+        for s in self.strata:
+            if s.exact_error_rate is not None:
+                continue
+            if s.errors:
+                f = s.smoothed_error_rate()
+                variance += s.probability**2 * f * (1 - f) / s.shots
+            else:
+                zero_error_bound += s.probability * s.zero_error_upper_bound(max_likelihood_factor=max_likelihood_factor)
+        best = self.error_rate
+        se = math.sqrt(variance)
+        return sinter.Fit(
+            low=max(0.0, best - z * se),
+            best=best,
+            high=min(1.0, best + z * se + zero_error_bound + self.truncated_probability),
+        )
+
+    def effective_stats(self, *, max_likelihood_factor: float = 1000) -> sinter.AnonTaskStats:
+        """Shot and error counts whose binomial fit matches this estimate, for the plot scripts.
+
+        The counts have the estimate's error rate, in as many shots as give a binomial fit the same
+        upper bound as `fit` (so the bound of the strata sampled without errors, and the truncated
+        probability, are included). Without errors seen, they are zero errors.
+        """
+        best = self.error_rate
+        high = self.fit(max_likelihood_factor=max_likelihood_factor).high
+        if best > 0:
+            shots = _binomial_shots_with_high(best=best, high=high, max_likelihood_factor=max_likelihood_factor)
+            errors = _binomial_errors(best=best, shots=shots)
+        else:
+            shots = max(1, round(math.log(max_likelihood_factor) / -math.log1p(-high))) if 0 < high < 1 else 1
+            errors = 0
+        return sinter.AnonTaskStats(shots=shots, errors=errors, discards=0, seconds=self.seconds)
+
+
+# Caps the effective shots of estimates whose upper bound is (almost) their error rate.
+_MAX_EFFECTIVE_SHOTS = 10**18
+
+
+def _binomial_errors(*, best: float, shots: int) -> int:
+    return min(shots, max(1, round(best * shots)))
+
+
+def _binomial_shots_with_high(*, best: float, high: float, max_likelihood_factor: float) -> int:
+    """The most shots (at the error rate `best`) whose binomial fit's upper bound is at least `high`."""
+
+    def reaches(shots: int) -> bool:
+        fit = sinter.fit_binomial(
+            num_shots=shots,
+            num_hits=_binomial_errors(best=best, shots=shots),
+            max_likelihood_factor=max_likelihood_factor)
+        return fit.high >= high
+
+    # Start from the normal approximation, bracket, then bisect to within 0.1%.
+    z2 = 2 * math.log(max_likelihood_factor)
+    guess = best * (1 - best) * z2 / (high - best)**2 if high > best else _MAX_EFFECTIVE_SHOTS
+    lo = hi = max(1, min(_MAX_EFFECTIVE_SHOTS, round(guess)))
+    while lo > 1 and not reaches(lo):
+        lo //= 2
+    while hi < _MAX_EFFECTIVE_SHOTS and reaches(hi):
+        hi = min(_MAX_EFFECTIVE_SHOTS, hi * 2)
+    if reaches(hi):
+        return hi
+    while hi - lo > max(1, lo // 1000):
+        mid = (lo + hi) // 2
+        if reaches(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+class ErrorWeightSampler:
+    """Samples and decodes shots of a detector error model with a chosen number of errors.
+
+    Given that exactly w of the model's independent error mechanisms occur, the chance of a given
+    set of w mechanisms is proportional to the product of their odds p/(1-p). Such sets are sampled
+    exactly by drawing w mechanisms with probability proportional to their odds, and redrawing the
+    shots that drew a mechanism twice.
+    """
+
+    def __init__(self,
+                 task: sinter.Task,
+                 *,
+                 decoder: str = 'pymatching',
+                 dem_cache: Optional[DemCache] = None,
+                 seed: Optional[int] = None):
+        if decoder != 'pymatching':
+            raise NotImplementedError(f'{decoder=}')
+        if task.postselection_mask is not None:
+            raise NotImplementedError('Sampling postselected tasks.')
+        import pymatching
+
+        self.json_metadata = task.json_metadata
+        self.decoder = rare_event_decoder_name(decoder)
+        key = None if dem_cache is None else dem_cache_key(task.circuit)
+        dem = task.detector_error_model
+        if dem is None:
+            dem = sinter.worker.auto_dem(task.circuit) if dem_cache is None else dem_cache.detector_error_model(task.circuit, key=key)
+        self.strong_id = sinter.Task(
+            circuit=task.circuit,
+            decoder=self.decoder,
+            detector_error_model=dem,
+            json_metadata=task.json_metadata,
+        ).strong_id()
+        if dem_cache is not None and task.detector_error_model is None:
+            self._matcher = dem_cache.matching(task.circuit, key=key)
+        else:
+            self._matcher = pymatching.Matching.from_detector_error_model(dem)
+        self.num_detectors = dem.num_detectors
+        self.num_observables = dem.num_observables
+        self._parse_dem(dem)
+        self._rng = np.random.default_rng(seed)
+
+    def _parse_dem(self, dem: stim.DetectorErrorModel) -> None:
+        probabilities = []
+        det_offsets = [0]
+        dets = []
+        obs = []
+        for inst in flattened_dem(dem):
+            if inst.type == 'error':
+                p = inst.args_copy()[0]
+                # Decomposition separators ('^') don't change what the mechanism flips.
+                symptom_dets = set()
+                symptom_obs = set()
+                for t in inst.targets_copy():
+                    if t.is_relative_detector_id():
+                        symptom_dets ^= {t.val}
+                    elif t.is_logical_observable_id():
+                        symptom_obs ^= {t.val}
+                if p == 0 or (not symptom_dets and not symptom_obs):
+                    continue
+                if p >= 1:
+                    raise ValueError(f'Error mechanism with probability {p} in the detector error model.')
+                probabilities.append(p)
+                dets.extend(sorted(symptom_dets))
+                det_offsets.append(len(dets))
+                obs.append(sorted(symptom_obs))
+        self.probabilities = np.array(probabilities, dtype=np.float64)
+        self._det_offsets = np.array(det_offsets, dtype=np.int64)
+        self._dets = np.array(dets, dtype=np.int64)
+        self._obs = np.zeros((len(probabilities), self.num_observables), dtype=np.bool_)
+        for k, flipped in enumerate(obs):
+            self._obs[k, flipped] = True
+        odds = self.probabilities / (1 - self.probabilities)
+        self._odds_cdf = np.cumsum(odds)
+
+    @property
+    def num_mechanisms(self) -> int:
+        return len(self.probabilities)
+
+    def weight_probabilities(self, max_weight: int) -> np.ndarray:
+        """The probability of exactly w error mechanisms occurring, for w = 0..max_weight."""
+        pmf = np.zeros(max_weight + 1, dtype=np.float64)
+        pmf[0] = 1
+        # Mechanisms with equal probabilities contribute a binomial distribution; convolve those.
+        unique, counts = np.unique(self.probabilities, return_counts=True)
+        ks = np.arange(max_weight + 1)
+        for p, c in zip(unique.tolist(), counts.tolist()):
+            log_pmf = np.full(max_weight + 1, -np.inf)
+            n = min(c, max_weight)
+            log_pmf[:n + 1] = (
+                np.array([math.lgamma(c + 1) - math.lgamma(k + 1) - math.lgamma(c - k + 1) for k in range(n + 1)])
+                + ks[:n + 1] * math.log(p)
+                + (c - ks[:n + 1]) * math.log1p(-p))
+            pmf = np.convolve(pmf, np.exp(log_pmf))[:max_weight + 1]
+        return pmf
+
+    def _sample_mechanisms(self, num_shots: int, weight: int) -> np.ndarray:
+        total = self._odds_cdf[-1]
+        result = np.empty((num_shots, weight), dtype=np.int64)
+        pending = np.arange(num_shots)
+        while len(pending):
+            drawn = np.searchsorted(self._odds_cdf, self._rng.random((len(pending), weight)) * total, side='right')
+            drawn = np.minimum(drawn, self.num_mechanisms - 1)
+            result[pending] = drawn
+            s = np.sort(drawn, axis=1)
+            pending = pending[np.any(s[:, 1:] == s[:, :-1], axis=1)]
+        return result
+
+    def sample(self, num_shots: int, *, weight: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Samples shots with exactly `weight` errors. Returns their detection events and observable flips."""
+        if weight > self.num_mechanisms:
+            raise ValueError(f'{weight=} > {self.num_mechanisms=}')
+        return self._syndromes(self._sample_mechanisms(num_shots, weight))
+
+    def _syndromes(self, mechanisms: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        num_shots, weight = mechanisms.shape
+        flat = mechanisms.reshape(-1)
+        starts = self._det_offsets[flat]
+        lengths = self._det_offsets[flat + 1] - starts
+        shot_of_det = np.repeat(np.repeat(np.arange(num_shots), weight), lengths)
+        det_positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        keys, counts = np.unique(shot_of_det * self.num_detectors + self._dets[det_positions], return_counts=True)
+        dets = np.zeros((num_shots, self.num_detectors), dtype=np.bool_)
+        dets.reshape(-1)[keys[counts % 2 == 1]] = True
+        obs = np.logical_xor.reduce(self._obs[mechanisms], axis=1) if weight else np.zeros((num_shots, self.num_observables), dtype=np.bool_)
+        return dets, obs
+
+    def _decode_errors(self, dets: np.ndarray, obs: np.ndarray) -> np.ndarray:
+        predicted = self._matcher.decode_batch(dets).astype(np.bool_).reshape(obs.shape)
+        return np.any(predicted != obs, axis=1)
+
+    def weight_one_stratum(self, *, probability: float, max_batch_size: int = 10_000) -> ErrorWeightStratum:
+        """Computes the error rate of shots with exactly one error exactly, by decoding each error mechanism."""
+        weights = self._odds_cdf - np.concatenate([[0], self._odds_cdf[:-1]])
+        failed = 0.0
+        num_failures = 0
+        for start in range(0, self.num_mechanisms, max_batch_size):
+            mechanisms = np.arange(start, min(start + max_batch_size, self.num_mechanisms))
+            dets, obs = self._syndromes(mechanisms.reshape(-1, 1))
+            errors = self._decode_errors(dets, obs)
+            failed += float(np.sum(weights[mechanisms][errors]))
+            num_failures += int(np.count_nonzero(errors))
+        return ErrorWeightStratum(
+            weight=1,
+            probability=probability,
+            shots=self.num_mechanisms,
+            errors=num_failures,
+            exact_error_rate=failed / self._odds_cdf[-1] if self.num_mechanisms else 0)
+
+    def sample_errors(self, num_shots: int, *, weight: int) -> int:
+        """Samples and decodes shots with exactly `weight` errors, returning how many were decoded wrong."""
+        if weight == 0:
+            return 0
+        dets, obs = self.sample(num_shots, weight=weight)
+        return int(np.count_nonzero(self._decode_errors(dets, obs)))
+
+    def estimate(self,
+                 *,
+                 max_shots: int,
+                 pilot_shots: int = 1000,
+                 max_batch_size: int = 10_000,
+                 truncation_fraction: float = 0.01,
+                 min_error_rate: float = 1e-12) -> ErrorWeightEstimate:
+        """Estimates the logical error rate, sampling up to `max_shots` shots spread over error weights.
+
+        Shots with one error are enumerated exactly (one per error mechanism, not counted against
+        `max_shots`). Larger weights are added from 2 upward, each getting `pilot_shots` shots,
+        until the probability of more errors is below `truncation_fraction` times the estimated
+        error rate (or below `min_error_rate`, when no errors were seen). The remaining shots are
+        spread over the added weights in proportion to their pilot contribution to the standard
+        error (Neyman allocation), with each weight getting at least `pilot_shots`. The pilot
+        shots only guide the allocation: the estimate uses the shots sampled after it, whose
+        numbers don't depend on their outcomes, so it stays unbiased. (When the remaining shots
+        can't give every weight `pilot_shots`, the pilot shots are used instead.)
+
+        Args:
+            max_shots: The total number of shots to sample.
+            pilot_shots: The number of shots every sampled weight gets first.
+            max_batch_size: The maximum number of shots to sample and decode at once.
+            truncation_fraction: Sampled weights are added until the probability of more errors is
+                below this fraction of the estimate.
+            min_error_rate: Sampled weights are added until the probability of more errors is below
+                this.
+        """
+        start_time = time.monotonic()
+        # Weights this far above the mean are vanishingly unlikely.
+        mean = float(np.sum(self.probabilities))
+        deviation = math.sqrt(float(np.sum(self.probabilities * (1 - self.probabilities))))
+        max_weight = min(self.num_mechanisms, math.ceil(mean + 15 * deviation + 50))
+        pmf = self.weight_probabilities(max_weight)
+        tails = np.maximum(1 - np.cumsum(pmf), 0)
+        pilot = ErrorWeightEstimate(strata=[], truncated_probability=float(tails[0]))
+        if max_weight >= 1:
+            pilot.strata.append(self.weight_one_stratum(probability=float(pmf[1]), max_batch_size=max_batch_size))
+            pilot.truncated_probability = float(tails[1])
+
+        def sample_into(stratum: ErrorWeightStratum, shots: int) -> None:
+            while shots > 0:
+                n = min(shots, max_batch_size)
+                stratum.errors += self.sample_errors(n, weight=stratum.weight)
+                stratum.shots += n
+                shots -= n
+
+        used = 0
+        for w in range(2, max_weight + 1):
+            bound = truncation_fraction * pilot.error_rate if pilot.error_rate else min_error_rate
+            if pilot.truncated_probability <= max(bound, min_error_rate) or used + pilot_shots > max_shots:
+                break
+            stratum = ErrorWeightStratum(weight=w, probability=float(pmf[w]))
+            sample_into(stratum, pilot_shots)
+            used += pilot_shots
+            pilot.strata.append(stratum)
+            pilot.truncated_probability = float(tails[w])
+
+        sampled = [s for s in pilot.strata if s.exact_error_rate is None]
+        remaining = max_shots - used
+        if not sampled or remaining < pilot_shots * len(sampled):
+            pilot.seconds = time.monotonic() - start_time
+            return pilot
+
+        scores = np.array([
+            s.probability * math.sqrt(s.smoothed_error_rate() * (1 - s.smoothed_error_rate()))
+            for s in sampled
+        ])
+        spare = remaining - pilot_shots * len(sampled)
+        allocation = pilot_shots + np.floor(spare * scores / scores.sum()).astype(np.int64)
+        strata = [s for s in pilot.strata if s.exact_error_rate is not None]
+        for s, shots in zip(sampled, allocation.tolist()):
+            stratum = ErrorWeightStratum(weight=s.weight, probability=s.probability)
+            sample_into(stratum, shots)
+            strata.append(stratum)
+        return ErrorWeightEstimate(
+            strata=strata,
+            truncated_probability=pilot.truncated_probability,
+            seconds=time.monotonic() - start_time)
+
+    def task_stats(self, estimate: ErrorWeightEstimate, *, max_likelihood_factor: float = 1000) -> sinter.TaskStats:
+        stats = estimate.effective_stats(max_likelihood_factor=max_likelihood_factor)
+        return sinter.TaskStats(
+            strong_id=self.strong_id,
+            decoder=self.decoder,
+            json_metadata=self.json_metadata,
+            shots=stats.shots,
+            errors=stats.errors,
+            discards=stats.discards,
+            seconds=stats.seconds,
+        )
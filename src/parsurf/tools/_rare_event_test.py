@@ -0,0 +1,115 @@
+import itertools
+
+import numpy as np
+import pytest
+import sinter
+import stim
+
+from parsurf.circuits.task_factory import task_from_description
+from parsurf.tools import ErrorWeightEstimate, ErrorWeightSampler, ErrorWeightStratum, TaskSampler
+
+
+def _small_sampler() -> ErrorWeightSampler:
+    circuit = stim.Circuit('''
+        X_ERROR(0.1) 0
+        X_ERROR(0.2) 1
+        X_ERROR(0.3) 2
+        M 0 1 2
+        DETECTOR rec[-3]
+        DETECTOR rec[-2]
+        DETECTOR rec[-1]
+        OBSERVABLE_INCLUDE(0) rec[-1]
+    ''')
+    return ErrorWeightSampler(sinter.Task(circuit=circuit), seed=5)
+
+
+def test_weight_probabilities():
+    sampler = _small_sampler()
+    ps = sampler.probabilities
+    expected = np.zeros(4)
+    for fired in itertools.product([0, 1], repeat=len(ps)):
+        expected[sum(fired)] += np.prod([p if f else 1 - p for p, f in zip(ps, fired)])
+    np.testing.assert_allclose(sampler.weight_probabilities(3), expected)
+    np.testing.assert_allclose(sampler.weight_probabilities(1), expected[:2])
+
+
+def test_sample_conditioned_on_weight():
+    sampler = _small_sampler()
+    dets, obs = sampler.sample(30000, weight=2)
+    assert np.all(np.count_nonzero(dets, axis=1) == 2)
+    np.testing.assert_array_equal(obs[:, 0], dets[:, 2])
+
+    # Sets of two errors are drawn with probability proportional to the product of their odds.
+    odds = sampler.probabilities / (1 - sampler.probabilities)
+    pairs = list(itertools.combinations(range(3), 2))
+    weights = np.array([odds[a] * odds[b] for a, b in pairs])
+    counts = [np.count_nonzero(dets[:, a] & dets[:, b]) for a, b in pairs]
+    np.testing.assert_allclose(np.array(counts) / 30000, weights / weights.sum(), atol=0.015)
+
+    with pytest.raises(ValueError):
+        sampler.sample(10, weight=4)
+
+
+def test_estimate_agrees_with_direct_sampling():
+    task = task_from_description({'c': 'chao', 'b': 'X', 'd': 3, 'r': 3, 'p': 0.003})
+    sampler = ErrorWeightSampler(task, seed=1)
+    assert sampler.decoder == 'pymatching:rare_event'
+    assert sampler.strong_id != TaskSampler(task).strong_id
+    estimate = sampler.estimate(max_shots=50_000, pilot_shots=500)
+    assert estimate.strata[0].weight == 1
+    assert estimate.strata[0].exact_error_rate is not None
+    assert estimate.shots <= 50_000 + sampler.num_mechanisms
+    fit = estimate.fit()
+    assert fit.low < fit.best < fit.high
+
+    direct = TaskSampler(task).sample(200_000)
+    direct_fit = sinter.fit_binomial(num_shots=direct.shots, num_hits=direct.errors, max_likelihood_factor=1000)
+    assert fit.low < direct_fit.high and direct_fit.low < fit.high
+
+    stats = sampler.task_stats(estimate)
+    assert stats.decoder == 'pymatching:rare_event'
+    assert stats.json_metadata == task.json_metadata
+    assert stats.errors / stats.shots == pytest.approx(estimate.error_rate, rel=0.01)
+    effective_fit = sinter.fit_binomial(num_shots=stats.shots, num_hits=stats.errors, max_likelihood_factor=1000)
+    assert effective_fit.high - effective_fit.low == pytest.approx(fit.high - fit.low, rel=0.2)
+
+
+def test_effective_stats_without_errors():
+    estimate = ErrorWeightEstimate(
+        strata=[ErrorWeightStratum(weight=1, probability=0.01, shots=10, exact_error_rate=0),
+                ErrorWeightStratum(weight=2, probability=1e-4, shots=1000, errors=0)],
+        truncated_probability=1e-9)
+    assert estimate.error_rate == 0
+    fit = estimate.fit()
+    assert fit.low == 0 < fit.high
+    stats = estimate.effective_stats()
+    assert stats.errors == 0
+    assert sinter.fit_binomial(num_shots=stats.shots, num_hits=0, max_likelihood_factor=1000).high == pytest.approx(fit.high, rel=0.05)
+
+
+def test_effective_stats_include_truncated_probability():
+    stratum = ErrorWeightStratum(weight=2, probability=0.1, shots=10_000, errors=100)
+    estimate = ErrorWeightEstimate(strata=[stratum], truncated_probability=1e-3)
+    untruncated = ErrorWeightEstimate(strata=[stratum], truncated_probability=0)
+    fit = estimate.fit()
+    assert fit.high == pytest.approx(untruncated.fit().high + 1e-3)
+
+    stats = estimate.effective_stats()
+    assert stats.errors / stats.shots == pytest.approx(estimate.error_rate, rel=0.05)
+    effective_fit = sinter.fit_binomial(num_shots=stats.shots, num_hits=stats.errors, max_likelihood_factor=1000)
+    assert effective_fit.high == pytest.approx(fit.high, rel=0.01)
+    # The truncated probability widens the effective stats' interval (fewer effective shots).
+    assert stats.shots < untruncated.effective_stats().shots / 4
+
+
+def test_fit_bounds_strata_without_errors():
+    stratum = ErrorWeightStratum(weight=3, probability=1e-3, shots=500)
+    bound = stratum.zero_error_upper_bound()
+    assert bound == pytest.approx(sinter.fit_binomial(num_shots=500, num_hits=0, max_likelihood_factor=1000).high, rel=1e-3)
+    with_errors = ErrorWeightStratum(weight=2, probability=1e-2, shots=1000, errors=100)
+    estimate = ErrorWeightEstimate(strata=[with_errors, stratum], truncated_probability=1e-7)
+    fit = estimate.fit()
+    normal_only = ErrorWeightEstimate(strata=[with_errors], truncated_probability=1e-7).fit()
+    assert fit.best == normal_only.best
+    assert fit.low == normal_only.low
+    assert fit.high == pytest.approx(normal_only.high + 1e-3 * bound)
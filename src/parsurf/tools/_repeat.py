@@ -0,0 +1,201 @@
+from typing import Any, List, Optional, Sequence, Tuple
+
+import stim
+
+# Annotations whose parens arguments are coordinates (and therefore affected by SHIFT_COORDS).
+_COORD_ANNOTATIONS = {'DETECTOR', 'QUBIT_COORDS'}
+
+
+def flattened_circuit(circuit: stim.Circuit) -> stim.Circuit:
+    """Returns an equivalent circuit with no REPEAT blocks and no SHIFT_COORDS instructions.
+
+    Coordinate shifts are applied directly to the arguments of the affected DETECTOR and
+    QUBIT_COORDS instructions.
+    """
+    result = stim.Circuit()
+    _append_flattened(circuit, result, [])
+    return result
+
+
+def _append_flattened(circuit: stim.Circuit, out: stim.Circuit, shift: List[float]) -> None:
+    for op in circuit:
+        if isinstance(op, stim.CircuitRepeatBlock):
+            body = op.body_copy()
+            for _ in range(op.repeat_count):
+                _append_flattened(body, out, shift)
+        elif op.name == 'SHIFT_COORDS':
+            for k, v in enumerate(op.gate_args_copy()):
+                if k < len(shift):
+                    shift[k] += v
+                else:
+                    shift.append(v)
+        elif op.name in _COORD_ANNOTATIONS and any(shift):
+            args = op.gate_args_copy()
+            args = [a + (shift[k] if k < len(shift) else 0) for k, a in enumerate(args)]
+            out.append(op.name, op.targets_copy(), args)
+        else:
+            out.append(op)
+
+
+def flattened_dem(dem: stim.DetectorErrorModel) -> stim.DetectorErrorModel:
+    """Returns an equivalent detector error model with no repeat blocks and no shift_detectors.
+
+    Detector shifts are applied directly to the detector targets (and coordinate shifts to the
+    coordinates of detector instructions), like `flattened_circuit` does for circuits.
+    """
+    result = stim.DetectorErrorModel()
+    _append_flattened_dem(dem, result, [0], [])
+    return result
+
+
+def _append_flattened_dem(dem: stim.DetectorErrorModel,
+                          out: stim.DetectorErrorModel,
+                          det_shift: List[int],
+                          coord_shift: List[float]) -> None:
+    for inst in dem:
+        if isinstance(inst, stim.DemRepeatBlock):
+            body = inst.body_copy()
+            for _ in range(inst.repeat_count):
+                _append_flattened_dem(body, out, det_shift, coord_shift)
+        elif inst.type == 'shift_detectors':
+            det_shift[0] += inst.targets_copy()[0]
+            for k, v in enumerate(inst.args_copy()):
+                if k < len(coord_shift):
+                    coord_shift[k] += v
+                else:
+                    coord_shift.append(v)
+        else:
+            args = inst.args_copy()
+            if inst.type == 'detector' and any(coord_shift):
+                args = [a + (coord_shift[k] if k < len(coord_shift) else 0) for k, a in enumerate(args)]
+            targets = [
+                stim.DemTarget.relative_detector_id(t.val + det_shift[0]) if t.is_relative_detector_id() else t
+                for t in inst.targets_copy()
+            ]
+            out.append(inst.type, args, targets)
+
+
+class _Segment:
+    """A run of instructions ending in a TICK (or at the end of the circuit).
+
+    The key ignores coordinate arguments, so that segments differing only by a coordinate offset
+    compare equal. The coordinates are kept separately, for checking that the offset is consistent.
+    """
+
+    def __init__(self, ops: List[stim.CircuitInstruction]):
+        self.ops = ops
+        key_parts = []
+        coords = []
+        for op in ops:
+            args = op.gate_args_copy()
+            if op.name in _COORD_ANNOTATIONS:
+                coords.append(args)
+                args_key = len(args)
+            else:
+                args_key = tuple(args)
+            key_parts.append((op.name, tuple(repr(t) for t in op.targets_copy()), args_key))
+        self.key = tuple(key_parts)
+        self.coords: List[List[float]] = coords
+
+
+def _split_segments(circuit: stim.Circuit) -> List[_Segment]:
+    segments = []
+    cur = []
+    for op in circuit:
+        if isinstance(op, stim.CircuitRepeatBlock):
+            raise ValueError('Expected a flattened circuit.')
+        cur.append(op)
+        if op.name == 'TICK':
+            segments.append(_Segment(cur))
+            cur = []
+    if cur:
+        segments.append(_Segment(cur))
+    return segments
+
+
+def _merge_offsets(a: List[float], b: List[float]) -> Optional[List[float]]:
+    """Combines two coordinate offsets that may cover different numbers of dimensions, or returns None if they conflict."""
+    n = min(len(a), len(b))
+    if a[:n] != b[:n]:
+        return None
+    return a if len(a) >= len(b) else b
+
+
+def _coord_offset(a: Sequence[_Segment], b: Sequence[_Segment]) -> Optional[List[float]]:
+    """Returns the constant coordinate offset taking segments a to segments b, or None if there isn't one."""
+    offset: Optional[List[float]] = []
+    for sa, sb in zip(a, b):
+        for ca, cb in zip(sa.coords, sb.coords):
+            offset = _merge_offsets(offset, [y - x for x, y in zip(ca, cb)])
+            if offset is None:
+                return None
+    return offset
+
+
+def _count_repetitions(segments: List[_Segment], start: int, period: int) -> Tuple[int, List[float]]:
+    """Counts how many times segments[start:start+period] repeats back to back, with a fixed coordinate step."""
+    block = segments[start:start + period]
+    reps = 1
+    step: Optional[List[float]] = None
+    while True:
+        k = start + reps * period
+        nxt = segments[k:k + period]
+        if len(nxt) < period or any(x.key != y.key for x, y in zip(block, nxt)):
+            break
+        d = _coord_offset(segments[k - period:k], nxt)
+        if d is None:
+            break
+        if step is None:
+            step = d
+        elif len(d) != len(step) or d != step:
+            break
+        reps += 1
+    return reps, step or []
+
+
+def compress_repeat_blocks(circuit: stim.Circuit, *, max_period: int = 64) -> stim.Circuit:
+    """Rewrites runs of periodic TICK-delimited moments into REPEAT blocks.
+
+    Measurement record targets are relative, so moments that are textually identical (ignoring
+    coordinates) behave identically no matter where they are. Coordinates are allowed to advance by a
+    constant step each period, in which case a SHIFT_COORDS is added to the end of the loop body (and
+    undone after the loop) so that the flattened result keeps the original coordinates.
+
+    Args:
+        circuit: The circuit to compress. REPEAT blocks and SHIFT_COORDS in the input are flattened first.
+        max_period: The longest period (in moments) to look for.
+
+    Returns:
+        A circuit whose `flattened_circuit` equals the `flattened_circuit` of the input.
+    """
+    segments = _split_segments(flattened_circuit(circuit))
+    result = stim.Circuit()
+    k = 0
+    while k < len(segments):
+        best: Any = None
+        best_saved = 0
+        for period in range(1, min(max_period, (len(segments) - k) // 2) + 1):
+            reps, step = _count_repetitions(segments, k, period)
+            saved = (reps - 1) * period
+            if reps >= 2 and saved > best_saved:
+                best = period, reps, step
+                best_saved = saved
+        if best is None:
+            for op in segments[k].ops:
+                result.append(op)
+            k += 1
+            continue
+
+        period, reps, step = best
+        body = stim.Circuit()
+        for seg in segments[k:k + period]:
+            for op in seg.ops:
+                body.append(op)
+        if any(step):
+            body.append('SHIFT_COORDS', [], step)
+        result.append(stim.CircuitRepeatBlock(repeat_count=reps, body=body))
+        if any(step):
+            result.append('SHIFT_COORDS', [], [-s * reps for s in step])
+        k += period * reps
+
+    return result
@@ -0,0 +1,109 @@
+import pytest
+import stim
+
+from parsurf.circuits.chao import chao_memory_experiment_task
+from parsurf.circuits.shingled_pentagonal import shingled_pentagonal_memory_task
+from parsurf.tools._feedback import fold_classical_feedback
+from parsurf.tools._repeat import compress_repeat_blocks, flattened_circuit, flattened_dem
+
+
+def test_flattened_circuit():
+    assert flattened_circuit(stim.Circuit("""
+        QUBIT_COORDS(1, 2) 0
+        REPEAT 2 {
+            M 0
+            DETECTOR(0, 0, 0) rec[-1]
+            SHIFT_COORDS(1, 0, 2)
+        }
+        QUBIT_COORDS(1, 2) 1
+    """)) == stim.Circuit("""
+        QUBIT_COORDS(1, 2) 0
+        M 0
+        DETECTOR(0, 0, 0) rec[-1]
+        M 0
+        DETECTOR(1, 0, 2) rec[-1]
+        QUBIT_COORDS(3, 2) 1
+    """)
+
+
+def test_flattened_dem():
+    assert flattened_dem(stim.DetectorErrorModel("""
+        error(0.125) D0
+        repeat 2 {
+            error(0.25) D0 D1 ^ D2 L0
+            detector(0, 1) D1
+            shift_detectors(0, 2) 2
+        }
+        error(0.125) D1 L1
+    """)) == stim.DetectorErrorModel("""
+        error(0.125) D0
+        error(0.25) D0 D1 ^ D2 L0
+        detector(0, 1) D1
+        error(0.25) D2 D3 ^ D4 L0
+        detector(0, 3) D3
+        error(0.125) D5 L1
+    """)
+    circuit = chao_memory_experiment_task(basis='X', diam=3, rounds=4, noise=0.001).circuit
+    flat = flattened_dem(circuit.detector_error_model(decompose_errors=True))
+    assert 'repeat' not in str(flat) and 'shift_detectors' not in str(flat)
+    assert flat.num_detectors == circuit.num_detectors
+
+
+def test_compress_repeat_blocks_simple():
+    circuit = stim.Circuit("""
+        R 0
+        TICK
+    """)
+    for k in range(5):
+        circuit += stim.Circuit(f"""
+            H 0
+            TICK
+            M 0
+            DETECTOR({k}, 2) rec[-1]
+            TICK
+        """)
+    circuit.append('X', [0])
+
+    compressed = compress_repeat_blocks(circuit)
+    assert compressed == stim.Circuit("""
+        R 0
+        TICK
+        REPEAT 5 {
+            H 0
+            TICK
+            M 0
+            DETECTOR(0, 2) rec[-1]
+            TICK
+            SHIFT_COORDS(1, 0)
+        }
+        SHIFT_COORDS(-5, 0)
+        X 0
+    """)
+    assert flattened_circuit(compressed) == flattened_circuit(circuit)
+
+
+def test_compress_repeat_blocks_inconsistent_coords_not_merged():
+    circuit = stim.Circuit()
+    for k in [0, 1, 3]:
+        circuit += stim.Circuit(f"""
+            M 0
+            DETECTOR({k}) rec[-1]
+            TICK
+        """)
+    compressed = compress_repeat_blocks(circuit)
+    assert flattened_circuit(compressed) == circuit
+    assert sum(isinstance(op, stim.CircuitRepeatBlock) for op in compressed) == 1
+
+
+@pytest.mark.parametrize('make_circuit', [
+    lambda: chao_memory_experiment_task(basis='Z', rounds=9, diam=3, noise=0.001).circuit,
+    lambda: fold_classical_feedback(chao_memory_experiment_task(basis='X', rounds=9, diam=3, noise=0.001).circuit),
+    lambda: shingled_pentagonal_memory_task(basis='X', rounds=9, diam=5, noise=0.001).circuit,
+])
+def test_compress_repeat_blocks_preserves_circuit(make_circuit):
+    circuit = make_circuit()
+    compressed = compress_repeat_blocks(circuit)
+    assert any(isinstance(op, stim.CircuitRepeatBlock) for op in compressed)
+    assert flattened_circuit(compressed) == flattened_circuit(circuit)
+    assert compressed.flattened().detector_error_model(decompose_errors=True) == \
+           circuit.flattened().detector_error_model(decompose_errors=True)
@@ -0,0 +1,374 @@
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple, Union
+
+import dataclasses
+
+import stim
+
+from parsurf.tools._builder import AtLayer, Builder
+from parsurf.tools._surface_code import Tile
+from parsurf.tools._util import sorted_complex
+
+
+@dataclasses.dataclass(frozen=True)
+class Role:
+    """Refers to one of the qubits (or the key) a schedule is bound to for a specific tile.
+
+    Appears in qubit lists and inside measurement key templates. For example, the key template
+    `('a', Role('key'))` becomes `('a', tile.center)` when the tile's 'key' role is its center.
+    """
+    name: str
+
+
+@dataclasses.dataclass(frozen=True)
+class ResetOp:
+    """Resets the given roles. The basis is 'bas' (the tile's basis) or 'opp' (the other one)."""
+    basis: str
+    qubits: Tuple[str, ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class MeasureOp:
+    """Measures the given roles individually.
+
+    If key is None, each result is keyed by the measured qubit. Otherwise every result is stored
+    under the key template (so it only makes sense for a single qubit).
+    """
+    basis: str
+    qubits: Tuple[str, ...]
+    key: Any = None
+
+
+@dataclasses.dataclass(frozen=True)
+class MeasureProductOp:
+    """Measures the product of the basis Pauli over the given (present) roles.
+
+    When require_all is set, the product is measured only if none of the roles are missing. An
+    empty product records an empty measurement group, just like `Builder.measure_pauli_product`.
+    """
+    basis: str
+    qubits: Tuple[str, ...]
+    key: Any
+    require_all: bool = False
+
+
+@dataclasses.dataclass(frozen=True)
+class FeedbackOp:
+    """Applies the basis Pauli to the (present) target roles, controlled by the parity of the given measurements."""
+    basis: str
+    controls: Tuple[Any, ...]
+    targets: Tuple[str, ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class GroupOp:
+    """Stores the parity of several earlier measurements under a new key."""
+    sub_keys: Tuple[Any, ...]
+    key: Any
+
+
+ScheduleOp = Union[ResetOp, MeasureOp, MeasureProductOp, FeedbackOp, GroupOp]
+
+
+@dataclasses.dataclass(frozen=True)
+class DecompositionSchedule:
+    """A declarative description of how a tile's stabilizer measurement is decomposed into steps.
+
+    Attributes:
+        steps: The named steps of one measurement cycle, in order. Each step is a list of operations
+            applied to a tile. Operations refer to the tile's qubits through roles.
+        roles: Binds role names to a tile's qubits (or None when the qubit is missing). Must include
+            a 'key' role, used as the key that the tile's stabilizer measurement result is stored under.
+    """
+    steps: Tuple[Tuple[str, Tuple[ScheduleOp, ...]], ...]
+    roles: Callable[[Tile], Dict[str, Any]]
+
+    @property
+    def step_names(self) -> List[str]:
+        return [name for name, _ in self.steps]
+
+
+def _resolve_key(template: Any, roles: Dict[str, Any]) -> Any:
+    if isinstance(template, Role):
+        return roles[template.name]
+    if isinstance(template, tuple):
+        return tuple(_resolve_key(e, roles) for e in template)
+    return template
+
+
+def _resolve_basis(basis: str, tile_basis: str) -> str:
+    if basis == 'bas':
+        return tile_basis
+    if basis == 'opp':
+        return 'Z' if tile_basis == 'X' else 'X'
+    raise NotImplementedError(f'{basis=}')
+
+
+class _StepPlan:
+    """The precomputed operations of one step, for all tiles of a basis, independent of the layer.
+
+    Entries are:
+        ('ops', [(gate, targets), ...], [recorded keys])
+        ('group', [sub keys], key)
+        ('feedback', gate, [(control keys, target indices), ...])
+    """
+
+    def __init__(self):
+        self.entries: List[Tuple] = []
+        self._appends: List[Tuple[str, List[stim.GateTarget]]] = []
+        self._records: List[Any] = []
+
+    def append_gate(self, gate: str, targets: List[Any]) -> None:
+        if self._appends and self._appends[-1][0] == gate:
+            self._appends[-1][1].extend(targets)
+        else:
+            self._appends.append((gate, list(targets)))
+
+    def record(self, keys: Iterable[Any]) -> None:
+        self._records.extend(keys)
+
+    def _flush(self) -> None:
+        if self._appends or self._records:
+            self.entries.append(('ops', self._appends, self._records))
+            self._appends = []
+            self._records = []
+
+    def group(self, sub_keys: List[Any], key: Any) -> None:
+        self._flush()
+        self.entries.append(('group', sub_keys, key))
+
+    def feedback(self, gate: str, controls: List[Any], targets: List[int]) -> None:
+        self._flush()
+        if self.entries and self.entries[-1][0] == 'feedback' and self.entries[-1][1] == gate:
+            self.entries[-1][2].append((controls, targets))
+        else:
+            self.entries.append(('feedback', gate, [(controls, targets)]))
+
+    def finish(self) -> '_StepPlan':
+        self._flush()
+        return self
+
+
+def _compile_step(ops: Sequence[ScheduleOp], tiles: Sequence[Tile], schedule: DecompositionSchedule, q2i: Dict[complex, int]) -> _StepPlan:
+    plan = _StepPlan()
+    for tile in tiles:
+        roles = schedule.roles(tile)
+        for op in ops:
+            if isinstance(op, GroupOp):
+                plan.group([_resolve_key(k, roles) for k in op.sub_keys], _resolve_key(op.key, roles))
+                continue
+
+            basis = _resolve_basis(op.basis, tile.basis)
+            if isinstance(op, FeedbackOp):
+                qubits = sorted_complex(q for q in (roles[r] for r in op.targets) if q is not None)
+                plan.feedback(f'C{basis}', [_resolve_key(k, roles) for k in op.controls], [q2i[q] for q in qubits])
+                continue
+
+            present = [roles[r] for r in op.qubits if roles[r] is not None]
+            if isinstance(op, ResetOp):
+                plan.append_gate(f'R{basis}', [q2i[q] for q in sorted_complex(present)])
+            elif isinstance(op, MeasureOp):
+                qubits = sorted_complex(present)
+                plan.append_gate(f'M{basis}', [q2i[q] for q in qubits])
+                if op.key is None:
+                    plan.record(qubits)
+                else:
+                    key = _resolve_key(op.key, roles)
+                    plan.record(key for _ in qubits)
+            elif isinstance(op, MeasureProductOp):
+                if op.require_all and len(present) < len(op.qubits):
+                    present = []
+                qubits = sorted_complex(set(present))
+                key = _resolve_key(op.key, roles)
+                if not qubits:
+                    plan.group([], key)
+                    continue
+                pauli_target = {'X': stim.target_x, 'Y': stim.target_y, 'Z': stim.target_z}[basis]
+                targets = []
+                for q in qubits:
+                    targets.append(pauli_target(q2i[q]))
+                    targets.append(stim.target_combiner())
+                targets.pop()
+                plan.append_gate('MPP', targets)
+                plan.record([key])
+            else:
+                raise NotImplementedError(f'{op=}')
+    return plan.finish()
+
+
+class CompiledSchedule:
+    """A decomposition schedule bound to a set of same-basis tiles and a builder.
+
+    Each step of the schedule is compiled once, for all of the tiles together, into a plan of
+    precomputed instruction targets and measurement keys. Appending a step then only has to
+    stamp the current layer onto the keys. The result is identical to advancing one per-tile
+    generator (e.g. `iter_pentagonal_decompose_mpp4`) per tile by one step.
+    """
+
+    def __init__(self,
+                 *,
+                 schedule: DecompositionSchedule,
+                 tiles: Sequence[Tile],
+                 builder: Builder,
+                 layer: int = 0):
+        self.schedule = schedule
+        self.builder = builder
+        self.step_names = schedule.step_names
+        self.plans = [_compile_step(ops, tiles, schedule, builder.q2i) for _, ops in schedule.steps]
+        self.layer = layer
+        self.next_step = 0
+
+    def append_step(self, expected: str) -> None:
+        """Appends the next step of the schedule, checking that it has the expected name."""
+        step = self.step_names[self.next_step]
+        if step != expected:
+            raise ValueError(f"Expected layer {expected} but got {step}")
+        layer = self.layer
+        circuit = self.builder.circuit
+        tracker = self.builder.tracker
+
+        for entry in self.plans[self.next_step].entries:
+            kind = entry[0]
+            if kind == 'ops':
+                _, appends, records = entry
+                for gate, targets in appends:
+                    circuit.append(gate, targets)
+                tracker.record_measurements(AtLayer(k, layer) for k in records)
+            elif kind == 'group':
+                _, sub_keys, key = entry
+                tracker.make_measurement_group([AtLayer(k, layer) for k in sub_keys], key=AtLayer(key, layer))
+            elif kind == 'feedback':
+                _, gate, items = entry
+                targets = []
+                for controls, indices in items:
+                    for rec in tracker.current_measurement_record_targets_for(AtLayer(k, layer) for k in controls):
+                        for i in indices:
+                            targets.append(rec)
+                            targets.append(i)
+                if targets:
+                    circuit.append(gate, targets)
+            else:
+                raise NotImplementedError(f'{kind=}')
+
+        self.next_step += 1
+        if self.next_step == len(self.step_names):
+            self.next_step = 0
+            self.layer += 1
+
+
+@dataclasses.dataclass(frozen=True)
+class _BoundTile:
+    basis: str
+
+
+def compile_for_roles(
+        *,
+        schedule: DecompositionSchedule,
+        roles: Dict[str, Any],
+        basis: str,
+        builder: Builder,
+        layer: int = 0) -> CompiledSchedule:
+    """Compiles a schedule for a single tile whose roles are bound to the given qubits and key.
+
+    Args:
+        schedule: The decomposition to compile.
+        roles: The qubit (or None) bound to each role, and the 'key' the measurement result is stored under.
+        basis: The basis of the measured stabilizer.
+        builder: Where the operations are appended.
+        layer: The time layer that the first cycle stores its measurement keys under.
+    """
+    bound = DecompositionSchedule(steps=schedule.steps, roles=lambda _: roles)
+    return CompiledSchedule(schedule=bound, tiles=[_BoundTile(basis=basis)], builder=builder, layer=layer)
+
+
+def append_schedule_moments(
+        *,
+        builder: Builder,
+        schedules: Dict[str, CompiledSchedule],
+        moments: Sequence[Sequence[Tuple[str, str]]],
+        tick_after_last: bool = True) -> None:
+    """Appends a sequence of moments, each a list of (tile basis, step name) entries run in order.
+
+    A TICK is appended after each moment, except optionally after the last one (so that detectors
+    can be added before the moment ends).
+    """
+    for k, moment in enumerate(moments):
+        for tile_basis, step in moment:
+            schedules[tile_basis].append_step(step)
+        if tick_after_last or k + 1 < len(moments):
+            builder.tick()
+
+
+def compile_schedule_by_basis(
+        *,
+        schedule: DecompositionSchedule,
+        tiles: Iterable[Tile],
+        builder: Builder) -> Dict[str, CompiledSchedule]:
+    """Compiles a schedule separately for the X tiles and for the Z tiles."""
+    tiles = list(tiles)
+    return {
+        b: CompiledSchedule(schedule=schedule, tiles=[tile for tile in tiles if tile.basis == b], builder=builder)
+        for b in 'XZ'
+    }
+
+
+# Maps a tile to the (measurement key, layer offset) pairs compared by its detector. The offsets
+# are relative to the layer the detector is appended for (e.g. -1 for the previous round).
+DetectorStencil = Callable[[Tile], Iterable[Tuple[Any, int]]]
+
+
+class CompiledDetectors:
+    """One detector per tile, compiled from a stencil.
+
+    The stencil is evaluated once per tile, when compiling, so appending the detectors of a layer
+    only has to stamp the layer onto the precomputed keys. Keys that would land before layer 0
+    (e.g. the previous round of the first round) are dropped.
+    """
+
+    def __init__(self,
+                 *,
+                 stencil: DetectorStencil,
+                 tiles: Iterable[Tile],
+                 builder: Builder,
+                 ignore_non_existent: bool = False):
+        """
+        Args:
+            stencil: The measurements compared by each tile's detector.
+            tiles: The tiles to put a detector on, in the order their detectors are appended.
+            builder: Where the detectors are appended.
+            ignore_non_existent: Also drops keys that were never measured (e.g. because a tile's
+                measurement qubit is missing at the boundary of the patch).
+        """
+        self.builder = builder
+        self.ignore_non_existent = ignore_non_existent
+        self.detectors = [(tile.center, tuple(stencil(tile))) for tile in tiles]
+
+    def append_layer(self, layer: int) -> None:
+        """Appends the detectors compared relative to the given layer."""
+        for pos, terms in self.detectors:
+            self.builder.detector(
+                [AtLayer(k, layer + dt) for k, dt in terms if layer + dt >= 0],
+                pos=pos,
+                ignore_non_existent=self.ignore_non_existent)
+
+
+class CompiledObservable:
+    """The measurements an observable includes each time it is appended, relative to a layer."""
+
+    def __init__(self,
+                 *,
+                 terms: Iterable[Tuple[Any, int]],
+                 builder: Builder,
+                 obs_index: int = 0):
+        """
+        Args:
+            terms: The (measurement key, layer offset) pairs included into the observable.
+            builder: Where the observable includes are appended.
+            obs_index: The index of the observable.
+        """
+        self.terms = tuple(terms)
+        self.builder = builder
+        self.obs_index = obs_index
+
+    def append_layer(self, layer: int) -> None:
+        """Appends an observable include of the terms, relative to the given layer."""
+        self.builder.obs_include([AtLayer(k, layer + dt) for k, dt in self.terms], obs_index=self.obs_index)
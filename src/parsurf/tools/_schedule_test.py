@@ -0,0 +1,81 @@
+import pytest
+import stim
+
+from parsurf.tools._builder import AtLayer, Builder, MeasurementTracker
+from parsurf.tools._schedule import CompiledDetectors, CompiledObservable, CompiledSchedule, DecompositionSchedule, FeedbackOp, GroupOp, MeasureOp, \
+    MeasureProductOp, ResetOp, Role
+
+
+def test_compiled_schedule_simple():
+    key = Role('key')
+    schedule = DecompositionSchedule(
+        steps=(
+            ('R', (ResetOp(basis='opp', qubits=('m',)),)),
+            ('P', (
+                MeasureProductOp(basis='bas', qubits=('a', 'm'), key=('a', key)),
+                MeasureProductOp(basis='bas', qubits=('b', 'm'), key=('b', key)),
+            )),
+            ('M', (
+                MeasureOp(basis='opp', qubits=('m',)),
+                FeedbackOp(basis='bas', controls=(Role('m'),), targets=('a',)),
+            )),
+            ('C', (GroupOp(sub_keys=(('a', key), ('b', key)), key=key),)),
+        ),
+        roles=lambda tile: {'a': tile.a, 'b': tile.b, 'm': tile.center, 'key': ('tile', tile.center)},
+    )
+    builder = Builder(q2i={0: 0, 1: 1, 2: 2, 10: 3, 11: 4, 12: 5}, circuit=stim.Circuit(), tracker=MeasurementTracker())
+    tiles = [
+        _FakeTile(a=0, b=1, center=2, basis='X'),
+        _FakeTile(a=10, b=11, center=12, basis='X'),
+    ]
+    compiled = CompiledSchedule(schedule=schedule, tiles=tiles, builder=builder)
+    with pytest.raises(ValueError, match='Expected layer'):
+        compiled.append_step('P')
+    for step in ['R', 'P', 'M', 'C', 'R']:
+        compiled.append_step(step)
+    assert compiled.layer == 1
+
+    assert builder.circuit == stim.Circuit("""
+        RZ 2 5
+        MPP X0*X2 X1*X2 X3*X5 X4*X5
+        MZ 2
+        CX rec[-1] 0
+        MZ 5
+        CX rec[-1] 3
+        RZ 2 5
+    """)
+    assert builder.tracker.measurement_indices([AtLayer(('tile', 12), 0)]) == [2, 3]
+
+
+def test_compiled_detectors_and_observable():
+    builder = Builder(q2i={0: 0, 1: 1}, circuit=stim.Circuit(), tracker=MeasurementTracker())
+    tiles = [_FakeTile(a=None, b=None, center=0, basis='X'), _FakeTile(a=None, b=None, center=1, basis='Z')]
+    detectors = CompiledDetectors(
+        stencil=lambda tile: [(tile.center, 0), (tile.center, -1), (('missing', tile.center), 0)],
+        tiles=tiles,
+        builder=builder,
+        ignore_non_existent=True)
+    observable = CompiledObservable(terms=[(0, 0), (1, -1)], builder=builder, obs_index=2)
+    for layer in range(2):
+        builder.measure([0, 1], basis='Z', layer=layer)
+        detectors.append_layer(layer)
+    observable.append_layer(1)
+
+    assert builder.circuit == stim.Circuit("""
+        M 0 1
+        DETECTOR(0, 0, 0) rec[-2]
+        DETECTOR(1, 0, 0) rec[-1]
+        M 0 1
+        DETECTOR(0, 0, 0) rec[-4] rec[-2]
+        DETECTOR(1, 0, 0) rec[-3] rec[-1]
+        OBSERVABLE_INCLUDE(2) rec[-3] rec[-2]
+    """)
+
+
+class _FakeTile:
+    def __init__(self, *, a: complex, b: complex, center: complex, basis: str):
+        self.a = a
+        self.b = b
+        self.center = center
+        self.basis = basis
+
@@ -0,0 +1,148 @@
+from typing import Any, Dict, Optional, Tuple
+
+import dataclasses
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# The arrays describing a matching graph, with the shape (as a function of the number of edges and
+# observables) and dtype of each. Boundary edges have -1 as their second node.
+_ARRAY_LAYOUT = (
+    ('nodes', lambda e, o: (e, 2), np.int64),
+    ('weights', lambda e, o: (e,), np.float64),
+    ('error_probabilities', lambda e, o: (e,), np.float64),
+    ('observables', lambda e, o: (e, o), np.bool_),
+)
+
+
+def _array_offsets(num_edges: int, num_observables: int) -> Tuple[Dict[str, Tuple[int, Tuple[int, ...], Any]], int]:
+    offsets = {}
+    offset = 0
+    for name, shape_func, dtype in _ARRAY_LAYOUT:
+        shape = shape_func(num_edges, num_observables)
+        offsets[name] = (offset, shape, dtype)
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        # Keep the arrays 8-byte aligned.
+        offset += -offset % 8
+    return offsets, offset
+
+
+def matching_graph_arrays(matching: Any) -> Dict[str, np.ndarray]:
+    """Describes the edges of a `pymatching.Matching` graph as NumPy arrays.
+
+    Returns:
+        A dictionary with 'nodes' (int64, shape (edges, 2), -1 marking the boundary),
+        'weights' and 'error_probabilities' (float64, shape (edges,)), and 'observables' (bool,
+        shape (edges, observables)).
+    """
+    edges = matching.edges()
+    num_observables = matching.num_fault_ids
+    nodes = np.empty((len(edges), 2), dtype=np.int64)
+    weights = np.empty(len(edges), dtype=np.float64)
+    probabilities = np.empty(len(edges), dtype=np.float64)
+    observables = np.zeros((len(edges), num_observables), dtype=np.bool_)
+    for k, (u, v, data) in enumerate(edges):
+        nodes[k] = (u, -1 if v is None else v)
+        weights[k] = data['weight']
+        probabilities[k] = data['error_probability']
+        for obs in data['fault_ids']:
+            observables[k, obs] = True
+    return {
+        'nodes': nodes,
+        'weights': weights,
+        'error_probabilities': probabilities,
+        'observables': observables,
+    }
+
+
+def matching_from_graph_arrays(arrays: Dict[str, np.ndarray], *, num_detectors: int) -> Any:
+    """Builds a `pymatching.Matching` from arrays returned by `matching_graph_arrays`."""
+    import pymatching
+    import stim
+
+    # Start from a graph with every detector as a node, including detectors that no edge touches.
+    matching = pymatching.Matching.from_detector_error_model(
+        stim.DetectorErrorModel(f'detector D{num_detectors - 1}' if num_detectors else ''))
+    nodes = arrays['nodes'].tolist()
+    weights = arrays['weights'].tolist()
+    probabilities = arrays['error_probabilities'].tolist()
+    observables = arrays['observables']
+    for k, (u, v) in enumerate(nodes):
+        fault_ids = set(np.flatnonzero(observables[k]).tolist())
+        if v == -1:
+            matching.add_boundary_edge(u, fault_ids=fault_ids, weight=weights[k], error_probability=probabilities[k])
+        else:
+            matching.add_edge(u, v, fault_ids=fault_ids, weight=weights[k], error_probability=probabilities[k])
+    matching.ensure_num_fault_ids(observables.shape[1])
+    return matching
+
+
+@dataclasses.dataclass(frozen=True)
+class SharedMatchingGraph:
+    """A picklable handle to a matching graph published in shared memory by `publish_matching_graph`.
+
+    Attributes:
+        name: The name of the shared memory block.
+        num_detectors: The number of detectors of the graph's detector error model.
+        num_edges: The number of edges of the graph.
+        num_observables: The number of observables of the graph's detector error model.
+        strong_id: The strong id of the task the graph decodes.
+    """
+    name: str
+    num_detectors: int
+    num_edges: int
+    num_observables: int
+    strong_id: Optional[str] = None
+
+    def attach(self) -> Tuple[shared_memory.SharedMemory, Dict[str, np.ndarray]]:
+        """Maps the shared memory block, returning it and the graph arrays viewing it (without copying).
+
+        The arrays are only valid until the returned block is closed. Attaching doesn't take
+        ownership of the block: it is unlinked by the publishing process. (Attaching from a process
+        that isn't a descendant of the publishing one is unsupported, since the block would be
+        registered with a different resource tracker, which unlinks it when that process exits.)
+        """
+        block = shared_memory.SharedMemory(name=self.name)
+        offsets, _ = _array_offsets(self.num_edges, self.num_observables)
+        arrays = {
+            name: np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+            for name, (offset, shape, dtype) in offsets.items()
+        }
+        return block, arrays
+
+    def matching(self) -> Any:
+        """Builds a `pymatching.Matching` decoder from the shared graph."""
+        block, arrays = self.attach()
+        try:
+            return matching_from_graph_arrays(arrays, num_detectors=self.num_detectors)
+        finally:
+            del arrays
+            block.close()
+
+
+def publish_matching_graph(matching: Any, *, strong_id: Optional[str] = None) -> Tuple[shared_memory.SharedMemory, SharedMatchingGraph]:
+    """Copies a `pymatching.Matching` graph into a new shared memory block, as NumPy arrays.
+
+    Args:
+        matching: The decoder whose graph to publish.
+        strong_id: Recorded in the handle, so processes attaching to the graph don't have to derive
+            the detector error model to identify their stats.
+
+    Returns:
+        The shared memory block (which the caller must close and unlink when the graph is no longer
+        needed) and a picklable handle for attaching to it from other processes.
+    """
+    arrays = matching_graph_arrays(matching)
+    num_edges, num_observables = arrays['observables'].shape
+    offsets, size = _array_offsets(num_edges, num_observables)
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for name, (offset, shape, dtype) in offsets.items():
+        np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)[...] = arrays[name]
+    handle = SharedMatchingGraph(
+        name=block.name,
+        num_detectors=matching.num_detectors,
+        num_edges=num_edges,
+        num_observables=num_observables,
+        strong_id=strong_id,
+    )
+    return block, handle
@@ -0,0 +1,58 @@
+import multiprocessing
+
+import numpy as np
+import pymatching
+import sinter
+import stim
+
+from parsurf.tools import matching_from_graph_arrays, matching_graph_arrays, publish_matching_graph, TaskSampler
+
+
+def _circuit() -> stim.Circuit:
+    return stim.Circuit.generated('surface_code:rotated_memory_x', distance=3, rounds=3, after_clifford_depolarization=0.01)
+
+
+def _num_detectors_of_shared_graph(handle) -> int:
+    return handle.matching().num_detectors
+
+
+def test_graph_arrays_round_trip():
+    circuit = _circuit()
+    matching = pymatching.Matching.from_detector_error_model(sinter.worker.auto_dem(circuit))
+    arrays = matching_graph_arrays(matching)
+    assert arrays['nodes'].shape == (matching.num_edges, 2)
+    assert arrays['observables'].shape == (matching.num_edges, 1)
+
+    rebuilt = matching_from_graph_arrays(arrays, num_detectors=matching.num_detectors)
+    assert rebuilt.num_detectors == matching.num_detectors
+    assert rebuilt.edges() == matching.edges()
+    dets = circuit.compile_detector_sampler().sample(300)
+    np.testing.assert_array_equal(rebuilt.decode_batch(dets), matching.decode_batch(dets))
+
+
+def test_shared_graph_attaches_from_worker_processes():
+    circuit = _circuit()
+    matching = pymatching.Matching.from_detector_error_model(sinter.worker.auto_dem(circuit))
+    block, handle = publish_matching_graph(matching, strong_id='abc')
+    try:
+        _, arrays = handle.attach()
+        np.testing.assert_array_equal(arrays['weights'], matching_graph_arrays(matching)['weights'])
+        del arrays
+        with multiprocessing.Pool(2) as pool:
+            assert pool.map(_num_detectors_of_shared_graph, [handle] * 2) == [matching.num_detectors] * 2
+    finally:
+        block.close()
+        block.unlink()
+
+
+def test_task_sampler_from_shared_graph():
+    task = sinter.Task(circuit=_circuit(), json_metadata={'d': 3})
+    original = TaskSampler(task)
+    block, handle = original.share()
+    try:
+        shared = TaskSampler(task, shared_graph=handle)
+        assert shared.strong_id == original.strong_id
+        assert shared.sample(100).shots == 100
+    finally:
+        block.close()
+        block.unlink()
@@ -0,0 +1,311 @@
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import json
+import pathlib
+import sqlite3
+
+import sinter
+
+from parsurf.tools._collection import DecoderDisagreements, read_stats_csv
+
+# Metadata entries copied into indexed columns, so queries can filter on them without parsing JSON.
+METADATA_COLUMNS = (('c', 'TEXT'), ('b', 'TEXT'), ('d', 'INTEGER'), ('r', 'INTEGER'), ('p', 'REAL'))
+
+STATS_DATABASE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY,
+    strong_id TEXT NOT NULL,
+    decoder TEXT NOT NULL,
+    json_metadata TEXT NOT NULL,
+    {', '.join(f'{name} {kind}' for name, kind in METADATA_COLUMNS)},
+    shots INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    discards INTEGER NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stats_by_metadata ON stats ({', '.join(name for name, _ in METADATA_COLUMNS)});
+CREATE INDEX IF NOT EXISTS stats_by_strong_id ON stats (strong_id);
+CREATE TABLE IF NOT EXISTS disagreements (
+    id INTEGER PRIMARY KEY,
+    decoder TEXT NOT NULL,
+    other_decoder TEXT NOT NULL,
+    json_metadata TEXT NOT NULL,
+    shots INTEGER NOT NULL,
+    disagreements INTEGER NOT NULL
+);
+'''
+
+_SUMS = 'SUM(shots), SUM(errors), SUM(discards), SUM(seconds)'
+
+
+def is_stats_database_path(path: Union[str, pathlib.Path]) -> bool:
+    """Whether stats at the path are stored in a `StatsDatabase` (by suffix) instead of a CSV file."""
+    return pathlib.Path(path).suffix in STATS_DATABASE_SUFFIXES
+
+
+def _metadata_column_values(json_metadata: Any) -> Tuple[Any, ...]:
+    if not isinstance(json_metadata, dict):
+        return (None,) * len(METADATA_COLUMNS)
+    return tuple(json_metadata.get(name) for name, _ in METADATA_COLUMNS)
+
+
+def _stats_from_row(row: Tuple[Any, ...]) -> sinter.TaskStats:
+    strong_id, decoder, json_metadata, shots, errors, discards, seconds = row
+    return sinter.TaskStats(
+        strong_id=strong_id,
+        decoder=decoder,
+        json_metadata=json.loads(json_metadata),
+        shots=shots,
+        errors=errors,
+        discards=discards,
+        seconds=seconds,
+    )
+
+
+class StatsDatabase:
+    """Stores stats in an SQLite file, as an alternative to the append-only CSV files.
+
+    Each appended stats record is a row, written in its own transaction (or a batch of records in
+    one transaction), so an interrupted writer never leaves a partial record behind. The database
+    uses write-ahead logging, so readers (e.g. plot scripts) don't block writers, and several
+    collection processes can append to the same file. The 'c', 'b', 'd', 'r' and 'p' metadata
+    entries are copied into indexed columns, which queries can filter on.
+
+    Rows can be combined by strong id inside the database (like `sinter combine`), and imported from
+    or exported to the CSV format written by `sinter collect`. The disagreements of paired decoders
+    (see `DecoderDisagreements`) are kept in a table of their own.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path], *, timeout: float = 60):
+        """
+        Args:
+            path: The database file. Created if it doesn't exist.
+            timeout: Seconds to wait for other writers' transactions before failing.
+        """
+        self.path = pathlib.Path(path)
+        self._connection = sqlite3.connect(str(self.path), timeout=timeout)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+        self._appended = False
+
+    def close(self) -> None:
+        if self._appended:
+            # Refresh the table statistics, without which SQLite doesn't use the metadata index for
+            # filters that skip its leading columns.
+            self._connection.execute('ANALYZE')
+            self._connection.commit()
+        self._connection.close()
+
+    def __enter__(self) -> 'StatsDatabase':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _insert(self, stats: Iterable[sinter.TaskStats]) -> int:
+        rows = [
+            (
+                stat.strong_id,
+                stat.decoder,
+                json.dumps(stat.json_metadata, separators=(',', ':'), sort_keys=True),
+                *_metadata_column_values(stat.json_metadata),
+                stat.shots,
+                stat.errors,
+                stat.discards,
+                stat.seconds,
+            )
+            for stat in stats
+        ]
+        names = ['strong_id', 'decoder', 'json_metadata', *(name for name, _ in METADATA_COLUMNS),
+                 'shots', 'errors', 'discards', 'seconds']
+        self._connection.executemany(
+            f'INSERT INTO stats ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})', rows)
+        self._appended = True
+        return len(rows)
+
+    def append(self, stats: Iterable[sinter.TaskStats]) -> int:
+        """Appends stats records in one transaction. Returns the number of records appended."""
+        with self._connection:
+            return self._insert(stats)
+
+    def write(self, stats: sinter.TaskStats) -> None:
+        """Appends one stats record (the same interface as a CSV stats writer)."""
+        self.append([stats])
+
+    def append_disagreements(self, disagreements: Iterable[DecoderDisagreements]) -> int:
+        """Appends disagreement records in one transaction. Returns the number of records appended."""
+        rows = [
+            (
+                d.decoder,
+                d.other_decoder,
+                json.dumps(d.json_metadata, separators=(',', ':'), sort_keys=True),
+                d.shots,
+                d.disagreements,
+            )
+            for d in disagreements
+        ]
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO disagreements (decoder, other_decoder, json_metadata, shots, disagreements) '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def write_disagreements(self, disagreements: DecoderDisagreements) -> None:
+        """Appends one disagreement record (the same interface as a CSV disagreements writer)."""
+        self.append_disagreements([disagreements])
+
+    def read_disagreements(self) -> List[DecoderDisagreements]:
+        """Returns the stored disagreement records, without combining them, in the order they were appended."""
+        rows = self._connection.execute(
+            'SELECT decoder, other_decoder, json_metadata, shots, disagreements FROM disagreements ORDER BY id')
+        return [
+            DecoderDisagreements(
+                decoder=decoder,
+                other_decoder=other_decoder,
+                json_metadata=json.loads(json_metadata),
+                shots=shots,
+                disagreements=disagreements)
+            for decoder, other_decoder, json_metadata, shots, disagreements in rows
+        ]
+
+    def _where(self,
+               include: Optional[Dict[str, Iterable[Any]]],
+               exclude: Optional[Dict[str, Iterable[Any]]],
+               decoders: Optional[Iterable[str]]) -> Tuple[str, List[Any]]:
+        columns = {name for name, _ in METADATA_COLUMNS}
+        clauses = []
+        params = []
+        for filters, negate in [(include or {}, False), (exclude or {}, True)]:
+            for name, values in filters.items():
+                if name not in columns:
+                    raise ValueError(f'Can only filter on the {sorted(columns)} metadata entries, not {name!r}.')
+                values = list(values)
+                if not values:
+                    if not negate:
+                        clauses.append('0')
+                    continue
+                marks = ', '.join('?' * len(values))
+                if negate:
+                    clauses.append(f'({name} IS NULL OR {name} NOT IN ({marks}))')
+                else:
+                    clauses.append(f'{name} IN ({marks})')
+                params.extend(values)
+        if decoders is not None:
+            decoders = list(decoders)
+            clauses.append(f'decoder IN ({", ".join("?" * len(decoders))})' if decoders else '0')
+            params.extend(decoders)
+        return (f'WHERE {" AND ".join(clauses)}' if clauses else ''), params
+
+    def read(self,
+             *,
+             include: Optional[Dict[str, Iterable[Any]]] = None,
+             exclude: Optional[Dict[str, Iterable[Any]]] = None,
+             decoders: Optional[Iterable[str]] = None) -> List[sinter.TaskStats]:
+        """Returns the stored records, without combining them, in the order they were appended.
+
+        Args:
+            include: Only return records whose metadata entry has one of the given values, for each
+                of the given metadata columns (e.g. {'d': [3, 5]}).
+            exclude: Skip records whose metadata entry has one of the given values.
+            decoders: Only return records with one of these decoders.
+        """
+        where, params = self._where(include, exclude, decoders)
+        rows = self._connection.execute(
+            f'SELECT strong_id, decoder, json_metadata, shots, errors, discards, seconds FROM stats {where} ORDER BY id',
+            params)
+        return [_stats_from_row(row) for row in rows]
+
+    def combined(self,
+                 *,
+                 include: Optional[Dict[str, Iterable[Any]]] = None,
+                 exclude: Optional[Dict[str, Iterable[Any]]] = None,
+                 decoders: Optional[Iterable[str]] = None) -> List[sinter.TaskStats]:
+        """Returns the records summed per strong id (like `sinter combine`), aggregated inside the database.
+
+        Takes the same filters as `read`. Tasks are ordered by their first appended record.
+        """
+        where, params = self._where(include, exclude, decoders)
+        rows = self._connection.execute(
+            f'SELECT strong_id, MIN(decoder), MIN(json_metadata), {_SUMS} FROM stats {where} '
+            f'GROUP BY strong_id ORDER BY MIN(id)',
+            params)
+        return [_stats_from_row(row) for row in rows]
+
+    def compact(self) -> None:
+        """Replaces the records of each task by their sum, in one transaction."""
+        with self._connection:
+            rows = self._connection.execute(
+                f'SELECT strong_id, MIN(decoder), MIN(json_metadata), {_SUMS} FROM stats '
+                f'GROUP BY strong_id ORDER BY MIN(id)').fetchall()
+            self._connection.execute('DELETE FROM stats')
+            self._insert(_stats_from_row(row) for row in rows)
+        self._connection.execute('VACUUM')
+
+    def import_csv(self, path: Union[str, pathlib.Path]) -> int:
+        """Appends the records of a stats CSV file in one transaction. Returns the number of records."""
+        return self.append(read_stats_csv(path))
+
+    def export_csv(self, path: Union[str, pathlib.Path], *, combine: bool = False) -> int:
+        """Writes the records to a CSV file in the `sinter collect` format. Returns the number of records.
+
+        Args:
+            path: The CSV file to write (overwritten).
+            combine: Write the records summed per strong id, like `sinter combine`.
+        """
+        stats = self.combined() if combine else self.read()
+        with open(path, 'w') as f:
+            print(sinter.CSV_HEADER, file=f)
+            for stat in stats:
+                print(stat.to_csv_line(), file=f)
+        return len(stats)
+
+
+def read_stats_files(paths: Iterable[Union[str, pathlib.Path]],
+                     *,
+                     exclude: Optional[Dict[str, Iterable[Any]]] = None,
+                     decoders: Optional[Sequence[str]] = None) -> List[sinter.TaskStats]:
+    """Reads and combines stats from CSV files and `StatsDatabase` files (by suffix).
+
+    Like `sinter.stats_from_csv_files`, but also reads databases, and doesn't need pandas.
+
+    Args:
+        paths: The files to read. Records with the same strong id are summed, across files too.
+        exclude: Skip records whose metadata entry has one of the given values (e.g. {'d': [3]}).
+            Database files apply the filter in their query.
+        decoders: If not None, the decoders to return stats for, in order of preference. Records of
+            other decoders are skipped, and each task (identified by its metadata) only gets the stats
+            of the first listed decoder that has records for it. For example, ['pymatching:rare_event',
+            'pymatching'] uses the rare event estimates where there are any, and the sampled stats
+            elsewhere, instead of mixing the two.
+    """
+    exclude = {k: list(v) for k, v in (exclude or {}).items()}
+    rank = None if decoders is None else {decoder: k for k, decoder in enumerate(decoders)}
+    totals: Dict[str, sinter.TaskStats] = {}
+    for path in paths:
+        if is_stats_database_path(path):
+            with StatsDatabase(path) as db:
+                stats = db.combined(exclude=exclude, decoders=decoders)
+        else:
+            stats = [
+                stat
+                for stat in read_stats_csv(path)
+                if not any(stat.json_metadata.get(k) in v for k, v in exclude.items())
+                and (rank is None or stat.decoder in rank)
+            ]
+        for stat in stats:
+            prev = totals.get(stat.strong_id)
+            totals[stat.strong_id] = stat if prev is None else prev + stat
+    if rank is None:
+        return list(totals.values())
+
+    def task_key(stat: sinter.TaskStats) -> str:
+        return json.dumps(stat.json_metadata, sort_keys=True)
+
+    best: Dict[str, int] = {}
+    for stat in totals.values():
+        key = task_key(stat)
+        best[key] = min(best.get(key, len(rank)), rank[stat.decoder])
+    return [stat for stat in totals.values() if rank[stat.decoder] == best[task_key(stat)]]
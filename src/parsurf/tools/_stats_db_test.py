@@ -0,0 +1,113 @@
+import sqlite3
+
+import pytest
+import sinter
+
+from parsurf.tools import DecoderDisagreements, read_stats_csv, read_stats_files, StatsDatabase
+
+
+def _stat(strong_id: str, *, shots: int, errors: int, decoder: str = 'pymatching', **metadata) -> sinter.TaskStats:
+    return sinter.TaskStats(
+        strong_id=strong_id,
+        decoder=decoder,
+        json_metadata=metadata,
+        shots=shots,
+        errors=errors,
+        discards=0,
+        seconds=0.5,
+    )
+
+
+def test_stats_database_append_and_query(tmp_path):
+    a1 = _stat('a', shots=100, errors=3, c='chao', b='X', d=3, r=9, p=0.001)
+    b1 = _stat('b', shots=50, errors=1, c='chao', b='X', d=5, r=15, p=0.001)
+    a2 = _stat('a', shots=200, errors=4, c='chao', b='X', d=3, r=9, p=0.001)
+    other = _stat('c', shots=10, errors=0, path='x.stim')
+
+    with StatsDatabase(tmp_path / 'stats.db') as db:
+        assert db.append([a1, b1]) == 2
+        db.write(a2)
+        db.write(other)
+
+    # Records persist, and are combined per strong id in the database.
+    with StatsDatabase(tmp_path / 'stats.db') as db:
+        assert db.read() == [a1, b1, a2, other]
+        assert db.combined() == [a1 + a2, b1, other]
+        assert db.combined(include={'d': [3]}) == [a1 + a2]
+        assert db.combined(exclude={'d': [3]}) == [b1, other]
+        assert db.combined(include={'c': ['chao'], 'p': [0.001]}, exclude={'d': [5]}) == [a1 + a2]
+        assert db.combined(include={'d': []}) == []
+        assert db.read(decoders=['other']) == []
+        with pytest.raises(ValueError):
+            db.read(include={'q': [1]})
+
+        db.compact()
+        assert db.read() == [a1 + a2, b1, other]
+
+
+def test_stats_database_csv_round_trip(tmp_path):
+    stats = [
+        _stat('a', shots=100, errors=3, c='chao', b='X', d=3, r=9, p=0.001),
+        _stat('a', shots=100, errors=2, c='chao', b='X', d=3, r=9, p=0.001),
+        _stat('b', shots=50, errors=1, c='chao', b='Z', d=3, r=9, p=0.002),
+    ]
+    csv_path = tmp_path / 'stats.csv'
+    with open(csv_path, 'w') as f:
+        print(sinter.CSV_HEADER, file=f)
+        for stat in stats:
+            print(stat.to_csv_line(), file=f)
+
+    with StatsDatabase(tmp_path / 'stats.sqlite') as db:
+        assert db.import_csv(csv_path) == 3
+        assert db.export_csv(tmp_path / 'out.csv') == 3
+        assert db.export_csv(tmp_path / 'combined.csv', combine=True) == 2
+    assert read_stats_csv(tmp_path / 'out.csv') == stats
+    assert read_stats_csv(tmp_path / 'combined.csv') == [stats[0] + stats[1], stats[2]]
+
+    # CSV files and databases combine, with the same filters.
+    assert read_stats_files([csv_path, tmp_path / 'stats.sqlite']) == [
+        stats[0] + stats[1] + stats[0] + stats[1],
+        stats[2] + stats[2],
+    ]
+    assert read_stats_files([csv_path, tmp_path / 'stats.sqlite'], exclude={'b': ['X']}) == [stats[2] + stats[2]]
+
+    # The metadata columns are indexed.
+    with sqlite3.connect(str(tmp_path / 'stats.sqlite')) as connection:
+        columns = connection.execute('PRAGMA index_info(stats_by_metadata)').fetchall()
+    assert [name for _, _, name in columns] == ['c', 'b', 'd', 'r', 'p']
+
+
+def test_stats_database_keeps_disagreements_apart(tmp_path):
+    d = DecoderDisagreements(
+        decoder='pymatching',
+        other_decoder='pymatching:window=2+2',
+        json_metadata={'c': 'chao', 'd': 3},
+        shots=100,
+        disagreements=7)
+    with StatsDatabase(tmp_path / 'stats.db') as db:
+        db.write(_stat('a', shots=100, errors=3, c='chao', d=3))
+        assert db.append_disagreements([d, d]) == 2
+    with StatsDatabase(tmp_path / 'stats.db') as db:
+        assert db.read_disagreements() == [d, d]
+        assert [s.strong_id for s in db.read()] == ['a']
+
+
+def test_read_stats_files_prefers_decoders(tmp_path):
+    sampled = _stat('a', shots=100, errors=0, c='chao', b='X', d=3, r=9, p=0.0001)
+    estimated = _stat('a2', shots=10**6, errors=3, decoder='pymatching:rare_event', c='chao', b='X', d=3, r=9, p=0.0001)
+    only_sampled = _stat('b', shots=100, errors=5, c='chao', b='X', d=3, r=9, p=0.001)
+    paired = _stat('b2', shots=100, errors=4, decoder='pymatching:window=3+3', c='chao', b='X', d=3, r=9, p=0.001)
+    stats = [sampled, estimated, only_sampled, paired]
+    csv_path = tmp_path / 'stats.csv'
+    with open(csv_path, 'w') as f:
+        print(sinter.CSV_HEADER, file=f)
+        for stat in stats:
+            print(stat.to_csv_line(), file=f)
+    with StatsDatabase(tmp_path / 'stats.db') as db:
+        db.append(stats)
+
+    for path in [csv_path, tmp_path / 'stats.db']:
+        assert read_stats_files([path]) == stats
+        assert read_stats_files([path], decoders=['pymatching']) == [sampled, only_sampled]
+        assert read_stats_files([path], decoders=['pymatching:rare_event', 'pymatching']) == [estimated, only_sampled]
+        assert read_stats_files([path], decoders=['pymatching:window=3+3']) == [paired]
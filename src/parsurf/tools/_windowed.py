@@ -0,0 +1,337 @@
+from typing import Any, Dict, Generator, List, Optional, Tuple, Union
+
+import dataclasses
+import math
+import re
+
+import numpy as np
+import stim
+
+from parsurf.tools._bit_batch import fit_packed_width, pack_bits, unpack_bits
+
+# Index of the time coordinate in the detector coordinates written by `Builder.detector` (x, y, t).
+TIME_COORDINATE_INDEX = 2
+
+_WINDOWED_DECODER_PATTERN = re.compile(r'^(\w+):window=(\d+)\+(\d+)$')
+
+
+def windowed_decoder_name(decoder: str, *, commit: int, buffer: int) -> str:
+    """The name sliding-window decoding with the given decoder is recorded under (e.g. 'pymatching:window=5+5')."""
+    return f'{decoder}:window={commit}+{buffer}'
+
+
+def parse_windowed_decoder_name(name: str) -> Optional[Tuple[str, int, int]]:
+    """Returns the (decoder, commit, buffer) of a `windowed_decoder_name`, or None for other names."""
+    match = _WINDOWED_DECODER_PATTERN.match(name)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2)), int(match.group(3))
+
+
+def detector_times(circuit: stim.Circuit) -> np.ndarray:
+    """The time coordinate of each detector (as written by `Builder.detector` and `shift_coords(dt=1)`)."""
+    coords = circuit.get_detector_coordinates()
+    times = np.empty(circuit.num_detectors, dtype=np.float64)
+    for k in range(circuit.num_detectors):
+        c = coords.get(k, [])
+        if len(c) <= TIME_COORDINATE_INDEX:
+            raise ValueError(f'Detector {k} has no time coordinate: {c}.')
+        times[k] = c[TIME_COORDINATE_INDEX]
+    return times
+
+
+# An error component of a detector error model: its probability, absolute detectors and observables.
+_Component = Tuple[float, List[int], Tuple[int, ...]]
+
+
+def _parse_dem(dem: stim.DetectorErrorModel) -> List[tuple]:
+    """Splits a detector error model's errors into components, keeping repeat blocks (parsed once) as blocks."""
+    result = []
+    for inst in dem:
+        if isinstance(inst, stim.DemRepeatBlock):
+            result.append(('repeat', inst.repeat_count, _parse_dem(inst.body_copy())))
+        elif inst.type == 'shift_detectors':
+            result.append(('shift', inst.targets_copy()[0]))
+        elif inst.type == 'error':
+            p = inst.args_copy()[0]
+            dets: List[int] = []
+            obs: List[int] = []
+            for t in [*inst.targets_copy(), None]:
+                if t is None or t.is_separator():
+                    result.append(('error', p, tuple(dets), tuple(obs)))
+                    dets, obs = [], []
+                elif t.is_relative_detector_id():
+                    dets.append(t.val)
+                else:
+                    obs.append(t.val)
+    return result
+
+
+def _iter_dem_events(parsed: List[tuple], offset: int = 0) -> Generator[Union[int, _Component], None, int]:
+    """Walks the error components of a `_parse_dem` result, without flattening its repeat blocks.
+
+    Yields:
+        The error components, and the new detector offset after each detector shift. No later
+        error touches a detector below the latest offset.
+
+    Returns:
+        The detector offset after the model.
+    """
+    for item in parsed:
+        if item[0] == 'error':
+            _, p, dets, obs = item
+            yield p, [offset + d for d in dets], obs
+        elif item[0] == 'shift':
+            offset += item[1]
+            yield offset
+        else:
+            _, count, body = item
+            for _ in range(count):
+                offset = yield from _iter_dem_events(body, offset)
+    return offset
+
+
+@dataclasses.dataclass
+class _WindowGraph:
+    """The matching graph of a window, with its detectors numbered from 0 in the order of the full graph.
+
+    Committed edges flip the observables of their fault ids, and fault id `num_observables + k`
+    flips the detector `carries[k]` (relative to the window's first detector) past the commit
+    region. Edges that aren't committed have no fault ids.
+    """
+    matching: Any
+    carries: np.ndarray
+
+    @property
+    def num_fault_ids(self) -> int:
+        return self.matching.num_fault_ids
+
+
+@dataclasses.dataclass
+class _Window:
+    detectors: np.ndarray
+    commit_end: float
+    is_last: bool
+    graph: Optional[_WindowGraph] = None
+    # The absolute detectors flipped by the graph's carry fault ids.
+    carries: Optional[np.ndarray] = None
+
+
+def _add_component(window: _Window,
+                   local: Dict[int, int],
+                   edges: Dict[Tuple[int, int], list],
+                   *,
+                   times: List[float],
+                   p: float,
+                   dets: List[int],
+                   obs: Tuple[int, ...]) -> None:
+    """Adds an error component to the edges of a window's graph (see `SlidingWindowDecoder`).
+
+    Each edge is a [merged probability, kept probability, kept correction] list, where the kept
+    correction is the (observables, carried detectors) of the most likely component (the first one,
+    on ties).
+    """
+    inside = [g for g in dets if g in local]
+    if not inside:
+        return
+    if len(inside) == 2:
+        a, b = local[inside[0]], local[inside[1]]
+        key = (min(a, b), max(a, b))
+    else:
+        key = (local[inside[0]], -1)
+    if window.is_last or min(times[g] for g in inside) < window.commit_end:
+        correction = (obs, tuple(g for g in dets if times[g] >= window.commit_end))
+    else:
+        correction = ((), ())
+    entry = edges.get(key)
+    if entry is None:
+        edges[key] = [p, p, correction]
+    else:
+        merged, kept_p, kept_correction = entry
+        entry[0] = merged * (1 - p) + p * (1 - merged)
+        if correction != kept_correction and p > kept_p:
+            entry[1] = p
+            entry[2] = correction
+
+
+class SlidingWindowDecoder:
+    """Decodes long memory experiments window by window, so decoder memory doesn't grow with the rounds.
+
+    The detectors are split by their time coordinate into overlapping windows of `commit + buffer`
+    time steps, each starting `commit` steps after the previous one. Each window is decoded with a
+    matching graph containing only its detectors: error components leaving the window become
+    boundary edges. Parallel edges are merged like pymatching merges them, except that when they
+    commit to different corrections (e.g. a boundary edge and an edge leaving the window), the most
+    likely one is kept. The matched edges with an endpoint in the window's first `commit` steps are
+    committed: their observables are added to the prediction, and their endpoints' detection events
+    are flipped, which carries corrections crossing into later windows over as detection events
+    there. The last window commits everything.
+
+    The window graphs are built in one pass over the detector error model, without flattening its
+    repeat blocks or building the full matching graph: each window's graph is finished as soon as
+    the pass moves past its detectors. Windows in the bulk of a memory experiment are translations
+    of each other in time, so windows with the same structure (relative to their first detector)
+    share one matching graph, and the number of graphs kept is independent of the number of rounds.
+
+    Decoding goes window by window, with each window decoding the whole batch of shots at once.
+    The committed corrections are predicted as fault ids of the window's graph, so they come out
+    of pymatching's batch decoding instead of a per-shot loop over matched edges.
+    """
+
+    def __init__(self,
+                 dem: stim.DetectorErrorModel,
+                 *,
+                 times: np.ndarray,
+                 commit: float,
+                 buffer: float):
+        """
+        Args:
+            dem: The graphlike (e.g. decomposed) detector error model. Keeping the circuit's loops
+                as repeat blocks (see `looped_auto_dem`) keeps its size independent of the rounds.
+            times: The time coordinate of each detector (see `detector_times`).
+            commit: Number of time steps committed by each window.
+            buffer: Number of further time steps each window looks ahead at.
+        """
+        if commit <= 0 or buffer < 0:
+            raise ValueError(f'Need commit > 0 and buffer >= 0, but got {commit=} and {buffer=}.')
+        self.num_detectors = len(times)
+        self.num_observables = dem.num_observables
+        self.commit = commit
+        self.buffer = buffer
+        self._times = np.asarray(times, dtype=np.float64)
+        self.windows: List[_Window] = []
+
+        t_start = float(np.min(self._times)) if len(self._times) else 0
+        t_max = float(np.max(self._times)) if len(self._times) else 0
+        while True:
+            t_end = t_start + commit + buffer
+            is_last = t_end > t_max
+            self.windows.append(_Window(
+                detectors=np.flatnonzero((self._times >= t_start) & (self._times < t_end)),
+                commit_end=t_end if is_last else t_start + commit,
+                is_last=is_last))
+            if is_last:
+                break
+            t_start += commit
+        self.num_graphs = self._build_graphs(dem)
+
+    def _build_graphs(self, dem: stim.DetectorErrorModel) -> int:
+        # The range of windows containing each detector.
+        first_window = np.zeros(self.num_detectors, dtype=np.int64)
+        last_window = np.zeros(self.num_detectors, dtype=np.int64)
+        for w in reversed(range(len(self.windows))):
+            first_window[self.windows[w].detectors] = w
+        for w, window in enumerate(self.windows):
+            last_window[window.detectors] = w
+        first_window = first_window.tolist()
+        last_window = last_window.tolist()
+        times = self._times.tolist()
+        max_detectors = [int(window.detectors[-1]) if len(window.detectors) else -1 for window in self.windows]
+
+        graphs: Dict[str, _WindowGraph] = {}
+        # The local detector numbers and the edges gathered so far of each unfinished window.
+        pending: Dict[int, Tuple[Dict[int, int], Dict[Tuple[int, int], list]]] = {}
+        finished = 0
+
+        def finish_windows_below(offset: int) -> None:
+            nonlocal finished
+            while finished < len(self.windows) and max_detectors[finished] < offset:
+                _, edges = pending.pop(finished, (None, {}))
+                self._finish_window(self.windows[finished], edges, graphs)
+                finished += 1
+
+        for event in _iter_dem_events(_parse_dem(dem)):
+            if isinstance(event, int):
+                finish_windows_below(event)
+                continue
+            p, dets, obs = event
+            if not dets or p == 0:
+                continue
+            if len(dets) > 2:
+                raise ValueError(f'Sliding-window decoding needs graphlike errors, but got a component with detectors {dets}.')
+            for w in range(min(first_window[g] for g in dets), max(last_window[g] for g in dets) + 1):
+                if w not in pending:
+                    pending[w] = ({g: k for k, g in enumerate(self.windows[w].detectors.tolist())}, {})
+                local, edges = pending[w]
+                _add_component(self.windows[w], local, edges, times=times, p=p, dets=dets, obs=obs)
+        finish_windows_below(self.num_detectors + 1)
+        return len(graphs)
+
+    def _finish_window(self,
+                       window: _Window,
+                       edges: Dict[Tuple[int, int], list],
+                       graphs: Dict[str, _WindowGraph]) -> None:
+        first = int(window.detectors[0]) if len(window.detectors) else 0
+        carries = sorted({g for _, _, (_, carried) in edges.values() for g in carried})
+        carry_ids = {g: self.num_observables + k for k, g in enumerate(carries)}
+        items = [
+            (a, b, p, (*obs, *(carry_ids[g] for g in carried)))
+            for (a, b), (p, _, (obs, carried)) in sorted(edges.items())
+        ]
+        relative_carries = np.array(carries, dtype=np.int64) - first
+        signature = repr(((window.detectors - first).tolist(), relative_carries.tolist(), items))
+        graph = graphs.get(signature)
+        if graph is None:
+            graph = _WindowGraph(
+                matching=self._build_matching(len(window.detectors), items, len(carries)),
+                carries=relative_carries)
+            graphs[signature] = graph
+        window.graph = graph
+        window.carries = graph.carries + first
+
+    def _build_matching(self, num_local_detectors: int, items: List[Tuple[int, int, float, Tuple[int, ...]]], num_carries: int) -> Any:
+        import pymatching
+
+        matching = pymatching.Matching.from_detector_error_model(
+            stim.DetectorErrorModel(f'detector D{num_local_detectors - 1}' if num_local_detectors else ''))
+        matching.ensure_num_fault_ids(self.num_observables + num_carries)
+        for a, b, p, fault_ids in items:
+            weight = math.log((1 - p) / p)
+            if b == -1:
+                matching.add_boundary_edge(a, fault_ids=set(fault_ids), weight=weight, error_probability=p)
+            else:
+                matching.add_edge(a, b, fault_ids=set(fault_ids), weight=weight, error_probability=p)
+        return matching
+
+    def decode(self, dets: np.ndarray) -> np.ndarray:
+        """Predicts the observable flips of one shot. Returns a bool array."""
+        return self.decode_batch(np.asarray(dets, dtype=np.bool_)[np.newaxis])[0]
+
+    def decode_batch(self,
+                     dets: np.ndarray,
+                     *,
+                     bit_packed_shots: bool = False,
+                     bit_packed_predictions: bool = False) -> np.ndarray:
+        """Predicts the observable flips of each shot.
+
+        Args:
+            dets: A (shots, detectors) bool array, or a bit-packed (shots, ceil(detectors / 8))
+                uint8 array when `bit_packed_shots` (see `pack_bits`).
+            bit_packed_shots: Whether `dets` is bit-packed.
+            bit_packed_predictions: Whether to return bit-packed predictions.
+
+        Returns:
+            A (shots, observables) bool array, or a bit-packed (shots, ceil(observables / 8)) uint8
+            array when `bit_packed_predictions`.
+        """
+        # The detection events stay bit-packed; each window reads its own bits out of the packed rows.
+        syndrome = np.array(dets, dtype=np.uint8) if bit_packed_shots else pack_bits(dets)
+        prediction = np.zeros((syndrome.shape[0], self.num_observables), dtype=np.bool_)
+        for window in self.windows:
+            detectors = window.detectors
+            if not len(detectors):
+                continue
+            local = (syndrome[:, detectors >> 3] >> (detectors & 7).astype(np.uint8)) & 1
+            shots = np.flatnonzero(local.any(axis=1))
+            if not len(shots):
+                continue
+            num_fault_ids = window.graph.num_fault_ids
+            flips = window.graph.matching.decode_batch(
+                pack_bits(local[shots]),
+                bit_packed_shots=True,
+                bit_packed_predictions=True)
+            flips = unpack_bits(fit_packed_width(np.asarray(flips, dtype=np.uint8), -(-num_fault_ids // 8)), num_fault_ids)
+            prediction[shots] ^= flips[:, :self.num_observables]
+            for k, g in enumerate(window.carries.tolist()):
+                syndrome[shots, g >> 3] ^= flips[:, self.num_observables + k].astype(np.uint8) << (g & 7)
+        return pack_bits(prediction) if bit_packed_predictions else prediction
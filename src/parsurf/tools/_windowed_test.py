@@ -0,0 +1,87 @@
+import numpy as np
+import pymatching
+import pytest
+import sinter
+
+from parsurf.circuits.task_factory import task_from_description
+from parsurf.tools import (
+    detector_times,
+    looped_auto_dem,
+    parse_windowed_decoder_name,
+    SlidingWindowDecoder,
+    TaskSampler,
+    windowed_decoder_name,
+)
+
+
+def test_windowed_decoder_name():
+    name = windowed_decoder_name('pymatching', commit=5, buffer=3)
+    assert name == 'pymatching:window=5+3'
+    assert parse_windowed_decoder_name(name) == ('pymatching', 5, 3)
+    assert parse_windowed_decoder_name('pymatching') is None
+
+
+def _setup(r: int, p: float):
+    task = task_from_description({'c': 'chao', 'b': 'X', 'd': 3, 'r': r, 'p': p})
+    matching = pymatching.Matching.from_detector_error_model(sinter.worker.auto_dem(task.circuit))
+    times = detector_times(task.circuit)
+    assert times.shape == (task.circuit.num_detectors,)
+    assert np.all(np.diff(times) >= 0)
+    samples = task.circuit.compile_detector_sampler().sample(3000, append_observables=True)
+    dets = samples[:, :task.circuit.num_detectors]
+    obs = samples[:, task.circuit.num_detectors:].astype(np.bool_)
+    return task, matching, times, dets, obs
+
+
+def test_single_window_matches_full_decoding():
+    task, matching, times, dets, _ = _setup(r=6, p=0.01)
+    decoder = SlidingWindowDecoder(looped_auto_dem(task.circuit), times=times, commit=100, buffer=0)
+    assert len(decoder.windows) == 1
+    np.testing.assert_array_equal(decoder.decode_batch(dets), matching.decode_batch(dets).astype(np.bool_))
+    packed = np.packbits(dets, axis=1, bitorder='little')
+    np.testing.assert_array_equal(
+        decoder.decode_batch(packed, bit_packed_shots=True, bit_packed_predictions=True),
+        matching.decode_batch(packed, bit_packed_shots=True, bit_packed_predictions=True))
+
+
+def test_sliding_windows_close_to_full_decoding():
+    task, matching, times, dets, obs = _setup(r=24, p=0.01)
+    dem = looped_auto_dem(task.circuit)
+    decoder = SlidingWindowDecoder(dem, times=times, commit=3, buffer=3)
+    assert len(decoder.windows) > 4
+    # The bulk windows share a graph.
+    assert decoder.num_graphs < len(decoder.windows)
+    full_errors = np.count_nonzero(np.any(matching.decode_batch(dets).astype(np.bool_) != obs, axis=1))
+    windowed_errors = np.count_nonzero(np.any(decoder.decode_batch(dets) != obs, axis=1))
+    assert 0 < full_errors
+    assert full_errors * 0.8 < windowed_errors < full_errors * 1.3
+
+    # Flattening the detector error model doesn't change the windows.
+    flat = SlidingWindowDecoder(sinter.worker.auto_dem(task.circuit), times=times, commit=3, buffer=3)
+    np.testing.assert_array_equal(flat.decode_batch(dets[:300]), decoder.decode_batch(dets[:300]))
+
+    with pytest.raises(ValueError):
+        SlidingWindowDecoder(dem, times=times, commit=0, buffer=3)
+
+
+def test_window_graphs_dont_grow_with_rounds():
+    decoders = []
+    for r in [30, 90]:
+        task = task_from_description({'c': 'chao', 'b': 'X', 'd': 3, 'r': r, 'p': 0.01})
+        dem = looped_auto_dem(task.circuit)
+        assert 'repeat' in str(dem)
+        decoders.append(SlidingWindowDecoder(dem, times=detector_times(task.circuit), commit=3, buffer=3))
+    assert len(decoders[1].windows) > len(decoders[0].windows)
+    assert decoders[1].num_graphs == decoders[0].num_graphs
+
+
+def test_task_sampler_windowed():
+    task = task_from_description({'c': 'chao', 'b': 'X', 'd': 3, 'r': 6, 'p': 0.01})
+    sampler = TaskSampler(task, decoder='pymatching:window=3+3')
+    stats = sampler.task_stats(sampler.sample(500))
+    assert stats.shots == 500
+    assert stats.decoder == 'pymatching:window=3+3'
+    assert 0 < stats.errors < 250
+    assert stats.strong_id != TaskSampler(task).strong_id
+    with pytest.raises(NotImplementedError):
+        sampler.share()
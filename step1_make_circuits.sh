@@ -4,6 +4,7 @@ set -e
 
 CIRCUIT_DIR=$1
 HCB_PATH=$2
+PROCESSES=${3:-1}
 
 if [ -z "${CIRCUIT_DIR}" ]; then
   echo "First arg must be output directory for circuits."
@@ -27,4 +28,5 @@ PYTHONPATH="${pypath}" python3 src/parsurf/scripts/generate_circuit_files.py \
     --noise 0.0001 0.0002 0.0003 0.0005 0.0008 0.001 0.002 0.003 0.004 0.005 0.006 0.007 0.008 0.009 0.01 \
     --round_factors 3 \
     --honeycomb "${honeycomb_switch}" \
+    --processes "${PROCESSES}" \
     --out_dir "${CIRCUIT_DIR}"
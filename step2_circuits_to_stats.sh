@@ -8,7 +8,7 @@ PROCESSES=$3
 DECODER=$4
 
 if [ -z "${CIRCUIT_DIR}" ]; then
-  echo "First arg must be the circuits directory."
+  echo "First arg must be the circuits directory (or a circuit archive)."
   exit 1
 fi
 if [ -z "${OUT_CSV}" ]; then
@@ -24,11 +24,60 @@ if [ -z "${DECODER}" ]; then
   exit 1
 fi
 
-sinter collect \
-    --circuits "${CIRCUIT_DIR}"/*.stim \
-    --metadata_func "sinter.comma_separated_key_values(path)" \
-    --decoders "${DECODER}" \
-    --max_shots 100_000_000 \
-    --max_errors 10_000 \
-    --save_resume_filepath "${OUT_CSV}" \
-    --processes "${PROCESSES}"
+if [ -f "${CIRCUIT_DIR}" ]; then
+  # A circuit archive (see generate_circuit_files.py --archive). Any further args are KEY=VALUE
+  # metadata values selecting which of its circuits to sample (e.g. c=chao d=5).
+  if [ "${DECODER}" != "pymatching" ]; then
+    echo "Circuit archives are sampled by collect_stats.py, which only supports the pymatching decoder (not ${DECODER})."
+    exit 1
+  fi
+  select_args=()
+  if [ $# -gt 4 ]; then
+    select_args=(--select "${@:5}")
+  fi
+  PYTHONPATH=src python3 src/parsurf/scripts/collect_stats.py \
+      --archive "${CIRCUIT_DIR}" \
+      "${select_args[@]}" \
+      --decoder "${DECODER}" \
+      --max_shots 100_000_000 \
+      --max_errors 10_000 \
+      --out_csv "${OUT_CSV}" \
+      --processes "${PROCESSES}"
+  exit 0
+fi
+
+shopt -s nullglob
+plain_files=("${CIRCUIT_DIR}"/*.stim)
+compressed_files=("${CIRCUIT_DIR}"/*.stim.gz "${CIRCUIT_DIR}"/*.stim.zst)
+shopt -u nullglob
+
+if [ ${#plain_files[@]} -eq 0 ] && [ ${#compressed_files[@]} -eq 0 ]; then
+  echo "No circuit files (*.stim, *.stim.gz or *.stim.zst) in ${CIRCUIT_DIR}."
+  exit 1
+fi
+if [ ${#compressed_files[@]} -gt 0 ] && [ "${DECODER}" != "pymatching" ]; then
+  # sinter collect only reads plain .stim files.
+  echo "${CIRCUIT_DIR} has compressed circuit files (see generate_circuit_files.py --compression), which are"
+  echo "sampled by collect_stats.py. It only supports the pymatching decoder (not ${DECODER})."
+  exit 1
+fi
+
+if [ ${#plain_files[@]} -gt 0 ]; then
+  sinter collect \
+      --circuits "${plain_files[@]}" \
+      --metadata_func "sinter.comma_separated_key_values(path)" \
+      --decoders "${DECODER}" \
+      --max_shots 100_000_000 \
+      --max_errors 10_000 \
+      --save_resume_filepath "${OUT_CSV}" \
+      --processes "${PROCESSES}"
+fi
+if [ ${#compressed_files[@]} -gt 0 ]; then
+  PYTHONPATH=src python3 src/parsurf/scripts/collect_stats.py \
+      --circuit_files "${compressed_files[@]}" \
+      --decoder "${DECODER}" \
+      --max_shots 100_000_000 \
+      --max_errors 10_000 \
+      --out_csv "${OUT_CSV}" \
+      --processes "${PROCESSES}"
+fi
@@ -6,6 +6,8 @@ readonly IN_CSV=$1
 readonly OUT_DIR=$2
 readonly BASIS=$3
 readonly CHUNKING=$4
+# The decoder whose stats are plotted (optional). Its rare event estimates are used where there are any.
+readonly DECODER=${5:-pymatching}
 
 if [ -z "${IN_CSV}" ]; then
   echo "First arg must be input stats csv file path."
@@ -32,30 +34,35 @@ PYTHONPATH=src python3 src/parsurf/scripts/plot_error_rate.py \
     --csv "${IN_CSV}" \
     --chunking "${CHUNKING}" \
     --save "${OUT_DIR}/error_rate_plot.png" \
-    --skip_b "${SKIP_BASIS}"
+    --skip_b "${SKIP_BASIS}" \
+    --decoders "${DECODER}:rare_event" "${DECODER}"
 
 PYTHONPATH=src python3 src/parsurf/scripts/plot_extrapolation.py \
     --csv "${IN_CSV}" \
     --chunking "${CHUNKING}" \
     --save "${OUT_DIR}/extrapolation_plot.png" \
-    --skip_b "${SKIP_BASIS}"
+    --skip_b "${SKIP_BASIS}" \
+    --decoders "${DECODER}:rare_event" "${DECODER}"
 
 PYTHONPATH=src python3 src/parsurf/scripts/plot_footprint.py \
     --csv "${IN_CSV}" \
     --chunking "${CHUNKING}" \
     --save "${OUT_DIR}/footprint_plot.png" \
-    --skip_b "${SKIP_BASIS}"
+    --skip_b "${SKIP_BASIS}" \
+    --decoders "${DECODER}:rare_event" "${DECODER}"
 
 PYTHONPATH=src python3 src/parsurf/scripts/plot_extrapolation.py \
     --csv "${IN_CSV}" \
     --chunking "${CHUNKING}" \
     --semi_systemic_bayesian \
     --save "${OUT_DIR}/semi_systemic_bayesian_extrapolation_plot.png" \
-    --skip_b "${SKIP_BASIS}"
+    --skip_b "${SKIP_BASIS}" \
+    --decoders "${DECODER}:rare_event" "${DECODER}"
 
 PYTHONPATH=src python3 src/parsurf/scripts/plot_footprint.py \
     --csv "${IN_CSV}" \
     --chunking "${CHUNKING}" \
     --semi_systemic_bayesian \
     --save "${OUT_DIR}/semi_systemic_bayesian_footprint_plot.png" \
-    --skip_b "${SKIP_BASIS}"
+    --skip_b "${SKIP_BASIS}" \
+    --decoders "${DECODER}:rare_event" "${DECODER}"